@@ -14,6 +14,7 @@ __version__ = "2024.07.01"
 
 from .api import (bro_host_default, pub_host_default, sub_host_default,
                   sub_urlbase_default)
-from .api import (get_roots, subscribe, get_list, get_info, fetch, download,
-                  lazyexpr)
+from .api import (get_roots, subscribe, get_list, get_info, fetch, reduce,
+                  download, lazyexpr)
 from .api import Root, File, Dataset
+from .api import AsyncRoot, AsyncFile, AsyncDataset
@@ -13,6 +13,9 @@ This module provides a Python API to Caterva2.
 import functools
 import pathlib
 
+# Requirements
+import httpx
+
 from caterva2 import api_utils, utils
 
 
@@ -69,7 +72,8 @@ def get_roots(urlbase=sub_urlbase_default, auth_cookie=None):
     return api_utils.get(f'{urlbase}api/roots', auth_cookie=auth_cookie)
 
 
-def subscribe(root, urlbase=sub_urlbase_default, auth_cookie=None):
+def subscribe(root, urlbase=sub_urlbase_default, auth_cookie=None,
+              wait=True):
     """
     Subscribe to a root.
 
@@ -81,15 +85,25 @@ def subscribe(root, urlbase=sub_urlbase_default, auth_cookie=None):
         The base of URLs (slash-terminated) of the subscriber to query.
     auth_cookie : str
         An optional HTTP cookie for authorizing access.
+    wait : bool
+        Whether to wait until all datasets in the root are available.
+        Otherwise, they become available progressively (see
+        ``/api/subscribe/{root}/status`` in the subscriber).
 
     Returns
     -------
     str
         The response from the server.
+
+    Raises
+    ------
+    httpx.HTTPStatusError
+        If waiting and the datasets in the root could not be brought up to
+        date (e.g. because its publisher is not available).
     """
     urlbase, root = _format_paths(urlbase, root)
     return api_utils.post(f'{urlbase}api/subscribe/{root}',
-                          auth_cookie=auth_cookie)
+                          params={'wait': wait}, auth_cookie=auth_cookie)
 
 
 def get_list(root, urlbase=sub_urlbase_default, auth_cookie=None):
@@ -140,7 +154,7 @@ def get_info(path, urlbase=sub_urlbase_default, auth_cookie=None):
 
 
 def fetch(path, urlbase=sub_urlbase_default, slice_=None,
-          auth_cookie=None):
+          auth_cookie=None, out=None, lazy=False):
     """
     Fetch (a slice of) the data in a dataset.
 
@@ -154,20 +168,64 @@ def fetch(path, urlbase=sub_urlbase_default, slice_=None,
         The slice to fetch (the whole dataset if missing).
     auth_cookie : str
         An optional HTTP cookie for authorizing access.
+    out : numpy.ndarray or writable buffer
+        A preallocated buffer (with the shape and dtype of the slice) to
+        decompress the data into, instead of a new array.  Chunks whose
+        layout does not match that of the buffer (see
+        `api_utils.read_chunk_stream()`) are copied into it.
+    lazy : bool
+        Whether to return the compressed data in a Blosc2 container
+        (`blosc2.NDArray` or `blosc2.SChunk`) without decompressing it.
 
     Returns
     -------
     numpy.ndarray
-        The slice of the dataset.
+        The slice of the dataset (`out` if given).
     """
     urlbase, path = _format_paths(urlbase, path)
     data = api_utils.fetch_data(path, urlbase,
                                 {'slice_': slice_},
-                                auth_cookie=auth_cookie)
+                                auth_cookie=auth_cookie, out=out, lazy=lazy)
     return data
 
 
-def download(path, urlbase=sub_urlbase_default, auth_cookie=None):
+def reduce(path, op, urlbase=sub_urlbase_default, axis=None, slice_=None,
+           auth_cookie=None):
+    """
+    Reduce (a slice of) the data in a dataset in the subscriber.
+
+    Only the (usually small) result is sent back, instead of all the data.
+
+    Parameters
+    ----------
+    path : str
+        The path of the dataset.
+    op : str
+        The reduction, one of ``'sum'``, ``'mean'``, ``'std'``, ``'min'``
+        and ``'max'``.
+    urlbase : str
+        The base of URLs (slash-terminated) of the subscriber to query.
+    axis : int or tuple of ints
+        The axes of the (sliced) data to reduce (all of them if missing).
+    slice_ : str
+        The slice to reduce (the whole dataset if missing).
+    auth_cookie : str
+        An optional HTTP cookie for authorizing access.
+
+    Returns
+    -------
+    numpy.ndarray
+        The result of the reduction.
+    """
+    urlbase, path = _format_paths(urlbase, path)
+    params = {'op': op, 'axis': api_utils.axis_to_string(axis),
+              'slice_': slice_}
+    return api_utils.reduce_data(path, urlbase, params,
+                                 auth_cookie=auth_cookie)
+
+
+def download(path, urlbase=sub_urlbase_default, auth_cookie=None,
+             resume=False, nranges=1):
     """
     Download a dataset to storage.
 
@@ -184,6 +242,10 @@ def download(path, urlbase=sub_urlbase_default, auth_cookie=None):
         The base of URLs (slash-terminated) of the subscriber to query.
     auth_cookie : str
         An optional HTTP cookie for authorizing access.
+    resume : bool
+        Whether to resume an interrupted download of the same dataset.
+    nranges : int
+        The number of byte ranges to download in parallel.
 
     Returns
     -------
@@ -193,7 +255,8 @@ def download(path, urlbase=sub_urlbase_default, auth_cookie=None):
     urlbase, path = _format_paths(urlbase, path)
     url = api_utils.get_download_url(path, urlbase)
     return api_utils.download_url(url, path, try_unpack=api_utils.blosc2_is_here,
-                                  auth_cookie=auth_cookie)
+                                  auth_cookie=auth_cookie,
+                                  resume=resume, nranges=nranges)
 
 
 def lazyexpr(name, expression, operands,
@@ -243,11 +306,17 @@ class Root:
         An optional mapping of fields and values to be used as data to be
         posted for authenticating the user and get an authorization token for
         further requests.
+    cache : str or pathlib.Path
+        An optional directory where to keep the chunks of datasets fetched
+        from the root, so that they are not requested again (see
+        :class:`Dataset`).
     """
-    def __init__(self, name, urlbase=sub_urlbase_default, user_auth=None):
+    def __init__(self, name, urlbase=sub_urlbase_default, user_auth=None,
+                 cache=None):
         urlbase, name = _format_paths(urlbase, name)
         self.name = name
         self.urlbase = utils.urlbase_type(urlbase)
+        self.cache = cache
         self.auth_cookie = (
             api_utils.get_auth_cookie(urlbase, user_auth)
             if user_auth else None)
@@ -258,12 +327,46 @@ class Root:
             roots = get_roots(urlbase)
             raise ValueError(f'Could not subscribe to root {name}'
                              f' (only {roots.keys()} available)')
-        self.node_list = api_utils.get(f'{urlbase}api/list/{name}',
-                                       auth_cookie=self.auth_cookie)
+        # A snapshot of all paths; iterate over the root for current ones
+        self.node_list = list(self.iter_nodes())
 
     def __repr__(self):
         return f'<Root: {self.name}>'
 
+    def __iter__(self):
+        return self.iter_nodes()
+
+    def iter_nodes(self, prefix='', recursive=True, page_size=1000):
+        """
+        Iterate over the paths of nodes in the root.
+
+        Paths are requested in pages, as iteration proceeds.
+
+        Parameters
+        ----------
+        prefix : str
+            Only iterate over paths starting with this (e.g. ``dir1/``).
+        recursive : bool
+            If false, only iterate over the nodes and directories (with a
+            trailing slash) right under the prefix.
+        page_size : int
+            The maximum number of paths requested at a time.
+
+        Yields
+        ------
+        str
+            The path of each node, in order.
+        """
+        params = {'prefix': prefix, 'recursive': recursive,
+                  'limit': page_size}
+        while True:
+            page = api_utils.get(f'{self.urlbase}api/list/{self.name}',
+                                 params=params, auth_cookie=self.auth_cookie)
+            yield from page
+            if len(page) < page_size:
+                break
+            params['cursor'] = page[-1]
+
     def __getitem__(self, node):
         """
         Get a file or dataset from the root.
@@ -280,7 +383,7 @@ class Root:
         """
         if node.endswith((".b2nd", ".b2frame")):
             return Dataset(node, root=self.name, urlbase=self.urlbase,
-                           auth_cookie=self.auth_cookie)
+                           auth_cookie=self.auth_cookie, cache=self.cache)
         else:
             return File(node, root=self.name, urlbase=self.urlbase,
                         auth_cookie=self.auth_cookie)
@@ -395,36 +498,64 @@ class File:
         array([0])
         >>> ds[0:10]
         array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+        >>> ds[0:1000:250]
+        array([  0, 250, 500, 750])
         """
         data = self.fetch(slice_=slice_)
         return data
 
-    def fetch(self, slice_=None):
+    def fetch(self, slice_=None, out=None, lazy=False):
         """
         Fetch a slice of a dataset.
 
-        Equivalent to `__getitem__()`.
+        Equivalent to `__getitem__()` without `out` nor `lazy`.
 
         Parameters
         ----------
         slice_ : int, slice, tuple of ints and slices, or None
             The slice to fetch.
+        out : numpy.ndarray or writable buffer
+            A preallocated buffer (with the shape and dtype of the slice) to
+            decompress the data into, instead of a new array.  Chunks whose
+            layout does not match that of the buffer (see
+            `api_utils.read_chunk_stream()`) are copied into it.
+        lazy : bool
+            Whether to return the compressed data in a Blosc2 container
+            (`blosc2.NDArray` or `blosc2.SChunk`) without decompressing it.
 
         Returns
         -------
         numpy.ndarray
-            The slice of the dataset.
+            The slice of the dataset (`out` if given).
+
+        Examples
+        --------
+        >>> root = cat2.Root('foo')
+        >>> ds = root['ds-1d.b2nd']
+        >>> out = np.empty(10, dtype=ds.dtype)
+        >>> ds.fetch(slice(0, 10), out=out) is out
+        True
+        >>> ds.fetch(lazy=True)[0:10]
+        array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
         """
         slice_ = api_utils.slice_to_string(slice_)
         data = api_utils.fetch_data(self.path, self.urlbase,
                                     {'slice_': slice_},
-                                    auth_cookie=self.auth_cookie)
+                                    auth_cookie=self.auth_cookie,
+                                    out=out, lazy=lazy)
         return data
 
-    def download(self):
+    def download(self, resume=False, nranges=1):
         """
         Download a file to storage.
 
+        Parameters
+        ----------
+        resume : bool
+            Whether to resume an interrupted download of the same file.
+        nranges : int
+            The number of byte ranges to download in parallel.
+
         Returns
         -------
         pathlib.PosixPath
@@ -439,7 +570,8 @@ class File:
         """
         urlpath = self.get_download_url()
         return api_utils.download_url(urlpath, str(self.path),
-                                      auth_cookie=self.auth_cookie)
+                                      auth_cookie=self.auth_cookie,
+                                      resume=resume, nranges=nranges)
 
 
 class Dataset(File):
@@ -459,6 +591,11 @@ class Dataset(File):
         The base of URLs (slash-terminated) of the subscriber to query.
     auth_cookie: str
         An optional cookie to authorize requests via HTTP.
+    cache : str or pathlib.Path
+        An optional directory where to keep the chunks of the dataset that
+        are fetched.  Slices are then read from there, and only the chunks
+        missing are requested to the subscriber.  Chunks are kept while the
+        dataset does not change.  Only arrays not in scratch space are kept.
 
     Examples
     --------
@@ -469,9 +606,303 @@ class Dataset(File):
     >>> ds[1:10]
     array([1, 2, 3, 4, 5, 6, 7, 8, 9])
     """
-    def __init__(self, name, root, urlbase, auth_cookie=None):
+    def __init__(self, name, root, urlbase, auth_cookie=None, cache=None):
         super().__init__(name, root, urlbase, auth_cookie)
+        self.cache = cache
 
     def __repr__(self):
         # TODO: add more info about dims, types, etc.
         return f'<Dataset: {self.path}>'
+
+    def reduce(self, op, axis=None, slice_=None):
+        """
+        Reduce (a slice of) the dataset in the subscriber.
+
+        The reduction is computed chunk by chunk by the subscriber, which
+        only gets the chunks that it needs from the publisher, and only the
+        result is sent back.
+
+        Parameters
+        ----------
+        op : str
+            The reduction, one of ``'sum'``, ``'mean'``, ``'std'``,
+            ``'min'`` and ``'max'``.
+        axis : int or tuple of ints, or None
+            The axes of the (sliced) dataset to reduce (all of them if
+            missing).
+        slice_ : int, slice, tuple of ints and slices, or None
+            The slice to reduce.
+
+        Returns
+        -------
+        numpy.ndarray
+            The result of the reduction.
+
+        Examples
+        --------
+        >>> root = cat2.Root('foo')
+        >>> ds = root['dir1/ds-2d.b2nd']
+        >>> ds.reduce('max', axis=1, slice_=slice(0, 2))
+        array([19, 39])
+        >>> ds.reduce('sum', slice_=(0, slice(0, 10)))
+        array(45)
+        """
+        slice_ = api_utils.slice_to_string(slice_)
+        params = {'op': op, 'axis': api_utils.axis_to_string(axis),
+                  'slice_': slice_}
+        return api_utils.reduce_data(self.path, self.urlbase, params,
+                                     auth_cookie=self.auth_cookie)
+
+    def fetch(self, slice_=None, out=None, lazy=False):
+        """
+        Fetch a slice of a dataset.
+
+        Equivalent to `__getitem__()` without `out` nor `lazy`.  If the
+        dataset has a cache, the slice is read from it, after getting the
+        chunks missing there.  Lazy slices are never read from the cache.
+
+        Parameters
+        ----------
+        slice_ : int, slice, tuple of ints and slices, or None
+            The slice to fetch.
+        out : numpy.ndarray
+            A preallocated array (with the shape and dtype of the slice) to
+            decompress the data into, instead of a new array.  Slices read
+            from the cache are copied into it, unless they cover the whole
+            dataset.
+        lazy : bool
+            Whether to return the compressed data in a `blosc2.NDArray`
+            without decompressing it.
+
+        Returns
+        -------
+        numpy.ndarray
+            The slice of the dataset (`out` if given).
+        """
+        if self.cache is not None and not lazy:
+            data = api_utils.fetch_cached(self.path, self.urlbase, slice_,
+                                          self.cache,
+                                          auth_cookie=self.auth_cookie,
+                                          out=out)
+            if data is not None:
+                return data
+        return super().fetch(slice_, out=out, lazy=lazy)
+
+
+class AsyncRoot:
+    """
+    Async version of :class:`Root`, to be used as an async context manager.
+
+    All requests are sent with a single ``httpx.AsyncClient``, so that many
+    of them (e.g. to fetch slices of datasets) can run concurrently with
+    ``asyncio.gather()``.  Subscribing and authenticating happen when
+    entering the context.
+
+    Parameters
+    ----------
+    name : str
+        The name of the root to subscribe to.
+    urlbase : str
+        The base of URLs (slash-terminated) of the subscriber to query.
+    user_auth : dict
+        An optional mapping of fields and values to be used as data to be
+        posted for authenticating the user and get an authorization token for
+        further requests.
+    client : httpx.AsyncClient
+        An optional client to send requests with, which is left open when
+        leaving the context.  If missing, a new one is used, and closed when
+        leaving the context.
+
+    Examples
+    --------
+    >>> async with cat2.AsyncRoot('foo') as root:
+    ...     ds = root['ds-1d.b2nd']
+    ...     await asyncio.gather(ds.fetch(slice(0, 3)), ds.fetch(slice(3, 6)))
+    [array([0, 1, 2]), array([3, 4, 5])]
+    """
+    def __init__(self, name, urlbase=sub_urlbase_default, user_auth=None,
+                 client=None):
+        urlbase, name = _format_paths(urlbase, name)
+        self.name = name
+        self.urlbase = utils.urlbase_type(urlbase)
+        self.user_auth = user_auth
+        self.auth_cookie = None
+        self.client = client if client is not None else httpx.AsyncClient()
+        self._owns_client = client is None
+
+    def __repr__(self):
+        return f'<AsyncRoot: {self.name}>'
+
+    async def __aenter__(self):
+        await self.subscribe()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def subscribe(self):
+        """Authenticate the user (if needed) and subscribe to the root."""
+        client, urlbase = self.client, self.urlbase
+        if self.user_auth:
+            self.auth_cookie = await api_utils.aget_auth_cookie(
+                client, urlbase, self.user_auth)
+
+        ret = await api_utils.apost(client,
+                                    f'{urlbase}api/subscribe/{self.name}',
+                                    auth_cookie=self.auth_cookie)
+        if ret != 'Ok':
+            roots = await api_utils.aget(client, f'{urlbase}api/roots',
+                                         auth_cookie=self.auth_cookie)
+            raise ValueError(f'Could not subscribe to root {self.name}'
+                             f' (only {roots.keys()} available)')
+
+    async def aclose(self):
+        """Close the client used for requests, if it was created here."""
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def iter_nodes(self, prefix='', recursive=True, page_size=1000):
+        """
+        Iterate asynchronously over the paths of nodes in the root.
+
+        See :meth:`Root.iter_nodes` for the parameters.
+        """
+        params = {'prefix': prefix, 'recursive': recursive,
+                  'limit': page_size}
+        while True:
+            page = await api_utils.aget(
+                self.client, f'{self.urlbase}api/list/{self.name}',
+                params=params, auth_cookie=self.auth_cookie)
+            for path in page:
+                yield path
+            if len(page) < page_size:
+                break
+            params['cursor'] = page[-1]
+
+    def __getitem__(self, node):
+        """
+        Get a file or dataset from the root.
+
+        No request is sent, so the node is not checked to exist.
+
+        Parameters
+        ----------
+        node : str
+            The path of the file or dataset.
+
+        Returns
+        -------
+        AsyncFile
+            An :class:`AsyncFile` or :class:`AsyncDataset` instance.
+        """
+        if node.endswith((".b2nd", ".b2frame")):
+            cls = AsyncDataset
+        else:
+            cls = AsyncFile
+        return cls(node, root=self.name, urlbase=self.urlbase,
+                   client=self.client, auth_cookie=self.auth_cookie)
+
+
+class AsyncFile:
+    """
+    Async version of :class:`File`.
+
+    This is not intended to be instantiated directly, but accessed via an
+    :class:`AsyncRoot` instance instead.  Unlike :class:`File`, metadata is
+    not requested on creation, but by :meth:`get_info`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the file.
+    root : str
+        The name of the root.
+    urlbase : str
+        The base of URLs (slash-terminated) of the subscriber to query.
+    client : httpx.AsyncClient
+        The client to send requests with.
+    auth_cookie: str
+        An optional cookie to authorize requests via HTTP.
+    """
+    def __init__(self, name, root, urlbase, client, auth_cookie=None):
+        urlbase, name = _format_paths(urlbase, name)
+        _, root = _format_paths(None, root)
+        self.root = root
+        self.name = name
+        self.urlbase = urlbase
+        self.path = pathlib.Path(f'{self.root}/{self.name}')
+        self.client = client
+        self.auth_cookie = auth_cookie
+        self.meta = None
+
+    def __repr__(self):
+        return f'<AsyncFile: {self.path}>'
+
+    async def get_info(self):
+        """
+        Get the metadata of the file, also kept as its ``meta`` attribute.
+
+        Returns
+        -------
+        dict
+            The metadata of the file.
+        """
+        self.meta = await api_utils.aget(
+            self.client, f'{self.urlbase}api/info/{self.path}',
+            auth_cookie=self.auth_cookie)
+        return self.meta
+
+    def get_download_url(self):
+        """Get the download URL for the file (see :meth:`File`)."""
+        return api_utils.get_download_url(self.path, self.urlbase)
+
+    async def fetch(self, slice_=None, out=None, lazy=False):
+        """
+        Fetch a slice of the file.
+
+        See :meth:`File.fetch` for the parameters and the result.
+        """
+        slice_ = api_utils.slice_to_string(slice_)
+        return await api_utils.afetch_data(self.client, self.path,
+                                           self.urlbase, {'slice_': slice_},
+                                           auth_cookie=self.auth_cookie,
+                                           out=out, lazy=lazy)
+
+    async def download(self):
+        """
+        Download the file to storage.
+
+        Returns
+        -------
+        pathlib.PosixPath
+            The path to the downloaded file.
+        """
+        return await api_utils.adownload_url(self.client,
+                                             self.get_download_url(),
+                                             str(self.path),
+                                             auth_cookie=self.auth_cookie)
+
+
+class AsyncDataset(AsyncFile):
+    """
+    Async version of :class:`Dataset`.
+
+    This is not intended to be instantiated directly, but accessed via an
+    :class:`AsyncRoot` instance instead.  See :class:`AsyncFile` for the
+    parameters.
+    """
+    def __repr__(self):
+        return f'<AsyncDataset: {self.path}>'
+
+    async def reduce(self, op, axis=None, slice_=None):
+        """
+        Reduce (a slice of) the dataset in the subscriber.
+
+        See :meth:`Dataset.reduce` for the parameters and the result.
+        """
+        slice_ = api_utils.slice_to_string(slice_)
+        params = {'op': op, 'axis': api_utils.axis_to_string(axis),
+                  'slice_': slice_}
+        return await api_utils.areduce_data(self.client, self.path,
+                                            self.urlbase, params,
+                                            auth_cookie=self.auth_cookie)
@@ -6,12 +6,21 @@
 # License: GNU Affero General Public License v3.0
 # See LICENSE.txt for details about copyright and rights to use.
 ###############################################################################
+import ast
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import math
 import os
 import pathlib
 import re
+import struct
+import threading
 
 # Requirements
 import httpx
+import numpy as np
 
 # Optional requirements
 try:
@@ -31,12 +40,12 @@ def slice_to_string(slice_):
         if isinstance(index, int):
             slice_parts.append(str(index))
         elif isinstance(index, slice):
-            start = index.start or ''
-            stop = index.stop or ''
-            if index.step not in (1, None):
-                raise IndexError('Only step=1 is supported')
-            # step = index.step or ''
-            slice_parts.append(f"{start}:{stop}")
+            start = '' if index.start is None else index.start
+            stop = '' if index.stop is None else index.stop
+            if index.step in (1, None):
+                slice_parts.append(f"{start}:{stop}")
+            else:
+                slice_parts.append(f"{start}:{stop}:{index.step}")
     return ", ".join(slice_parts)
 
 
@@ -54,6 +63,222 @@ def parse_slice(string):
     return tuple(obj)
 
 
+def normalize_slice(slice_, shape):
+    """
+    Get `slice_` with an integer or a ``slice(start, stop, step)`` per
+    dimension in `shape`, along with the shape of the sliced data.
+    """
+    slice_ = () if slice_ is None else slice_
+    if not isinstance(slice_, tuple):
+        slice_ = (slice_,)
+    if len(slice_) > len(shape):
+        raise IndexError('Too many indices')
+    slice_ += (slice(None),) * (len(shape) - len(slice_))
+
+    index = []
+    newshape = []
+    for sl, n in zip(slice_, shape):
+        if isinstance(sl, slice):
+            sl = slice(*sl.indices(n))
+            newshape.append(len(range(sl.start, sl.stop, sl.step)))
+        elif -n <= sl < n:
+            sl = sl % n
+        else:
+            raise IndexError(f'Index {sl} out of range')
+        index.append(sl)
+
+    return tuple(index), tuple(newshape)
+
+
+def slice_nchunks(slice_, shape, chunks):
+    """
+    Get the numbers of the chunks of an array containing items in a slice.
+
+    Unlike ``blosc2.get_slice_nchunks()``, slices with steps are supported,
+    and chunks between selected items are skipped.
+    """
+    index, _ = normalize_slice(slice_, shape)
+    coords = []
+    for sl, c in zip(index, chunks):
+        if not isinstance(sl, slice):
+            coords.append([sl // c])
+            continue
+        items = range(sl.start, sl.stop, sl.step)
+        if not items:
+            return []
+        if abs(sl.step) <= c:
+            coords.append(range(min(items) // c, max(items) // c + 1))
+        else:
+            coords.append(sorted({i // c for i in items}))
+
+    grid = [math.ceil(n / c) for n, c in zip(shape, chunks)]
+    return [int(np.ravel_multi_index(coord, grid))
+            for coord in itertools.product(*coords)]
+
+
+def strided_getitem(getitem, index, shape, chunks):
+    """
+    Read the data at `index` with `getitem`, which need not support steps.
+
+    `index` is as accepted by `normalize_slice()` for an array with `shape`
+    and `chunks`.  Along dimensions with a step other than one, the data is
+    read in pieces not crossing chunk boundaries, from which selected items
+    are taken, so that no more than a chunk of unselected items is ever
+    read.
+    """
+    index, _ = normalize_slice(index, shape)
+    if all(not isinstance(sl, slice) or sl.step == 1 for sl in index):
+        return np.asarray(getitem(index))
+    shape = [len(range(sl.start, sl.stop, sl.step))
+             for sl in index if isinstance(sl, slice)]
+    if 0 in shape:
+        data = getitem(tuple(slice(sl.start, sl.start)
+                             if isinstance(sl, slice) else sl
+                             for sl in index))
+        return np.empty(shape, dtype=data.dtype)
+
+    # Per dimension: the pieces to read, the items to take from them, and
+    # where to put those in the result
+    pieces = []
+    for sl, c in zip(index, chunks):
+        if not isinstance(sl, slice):
+            pieces.append([(slice(sl, sl + 1), 0, None)])
+            continue
+        if sl.step == 1:
+            pieces.append([(sl, slice(None), slice(None))])
+            continue
+        items = range(sl.start, sl.stop, sl.step)
+        dim = []
+        k = 0
+        while k < len(items):
+            first = items[k]
+            if sl.step > 0:
+                m = math.ceil(((first // c + 1) * c - first) / sl.step)
+            else:
+                m = (first - first // c * c) // -sl.step + 1
+            sub = items[k:k + m]
+            lo = min(sub[0], sub[-1])
+            dim.append((slice(lo, max(sub[0], sub[-1]) + 1),
+                        slice(sub[0] - lo, None, sl.step),
+                        slice(k, k + len(sub))))
+            k += len(sub)
+        pieces.append(dim)
+
+    result = None
+    for piece in itertools.product(*pieces):
+        source, take, target = zip(*piece)
+        data = np.asarray(getitem(source))[take]
+        if result is None:
+            result = np.empty(shape, dtype=data.dtype)
+        result[tuple(t for t in target if t is not None)] = data
+    return result
+
+
+def chunks_to_string(nchunks):
+    """
+    Encode chunk indices as a string of comma-separated indices and ranges.
+
+    Consecutive indices are collapsed into inclusive ranges, e.g. ``[0, 1, 2,
+    5, 7, 8]`` is encoded as ``'0-2,5,7-8'``.
+    """
+    parts = []
+    start = stop = None
+    for nchunk in nchunks:
+        if stop is not None and nchunk == stop + 1:
+            stop = nchunk
+            continue
+        if start is not None:
+            parts.append(str(start) if start == stop else f'{start}-{stop}')
+        start = stop = nchunk
+    if start is not None:
+        parts.append(str(start) if start == stop else f'{start}-{stop}')
+    return ','.join(parts)
+
+
+def parse_chunks(string):
+    """
+    Decode chunk indices encoded by `chunks_to_string()` into a list.
+    """
+    nchunks = []
+    for segment in string.split(','):
+        segment = segment.strip()
+        if not segment:
+            continue
+        start, _, stop = segment.partition('-')
+        start = int(start)
+        stop = int(stop) if stop else start
+        if start < 0 or stop < start:
+            raise ValueError(f'Invalid chunk range: {segment}')
+        nchunks.extend(range(start, stop + 1))
+    return nchunks
+
+
+#
+# Framed streams
+#
+# A framed stream is a sequence of frames, each one made of a header with an
+# integer index and the length of its payload (in bytes), followed by the
+# payload itself.
+#
+
+_frame_header = struct.Struct('<qQ')
+
+
+def iter_frame(index, data):
+    """Yield the parts of a frame with the given `index` and `data`."""
+    yield _frame_header.pack(index, len(data))
+    yield data
+
+
+class FrameReader:
+    """Incrementally split a framed stream into ``(index, data)`` pairs."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add `data` to the stream and return the frames completed by it."""
+        buffer = self._buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        hsize = _frame_header.size
+        while len(buffer) - offset >= hsize:
+            index, length = _frame_header.unpack_from(buffer, offset)
+            start = offset + hsize
+            stop = start + length
+            if len(buffer) < stop:
+                break
+            frames.append((index, bytes(buffer[start:stop])))
+            offset = stop
+
+        del buffer[:offset]
+        return frames
+
+    def close(self):
+        """Check that the stream did not end in the middle of a frame."""
+        if self._buffer:
+            raise ValueError('Framed stream ended with an incomplete frame')
+
+
+def iter_frames(stream):
+    """Iterate over the ``(index, data)`` frames in a stream of bytes."""
+    reader = FrameReader()
+    for data in stream:
+        yield from reader.feed(data)
+    reader.close()
+
+
+async def aiter_frames(stream):
+    """Async version of `iter_frames()`."""
+    reader = FrameReader()
+    async for data in stream:
+        for frame in reader.feed(data):
+            yield frame
+    reader.close()
+
+
 def get_auth_cookie(urlbase, user_auth):
     """
     Authenticate to a subscriber as a user and get an authorization cookie.
@@ -82,18 +307,340 @@ def get_auth_cookie(urlbase, user_auth):
     return auth_cookie
 
 
-def fetch_data(path, urlbase, params, auth_cookie=None):
-    response = _xget(f'{urlbase}api/fetch/{path}', params=params,
-                     auth_cookie=auth_cookie)
-    data = response.content
-    # Try different deserialization methods
-    try:
+async def aget_auth_cookie(client, urlbase, user_auth):
+    """Async version of `get_auth_cookie()`, sending requests with `client`."""
+    if hasattr(user_auth, '_asdict'):  # named tuple (from tests)
+        user_auth = user_auth._asdict()
+    resp = await client.post(f'{urlbase}auth/jwt/login', data=user_auth)
+    resp.raise_for_status()
+    return '='.join(list(resp.cookies.items())[0])
+
+
+chunks_media_type = 'application/x-caterva2-chunks'
+"""The media type of chunk streams (see `read_chunk_stream()`)."""
+
+cframe_type_header = 'Caterva2-Cframe-Type'
+"""The header telling the kind of container (``ndarray`` or ``schunk``) in a
+serialized Blosc2 frame, so that clients need not guess it."""
+
+
+def chunks_to_b2(meta, chunks, urlpath=None):
+    """
+    Assemble the data with the given metadata and chunks in a Blosc2 container.
+
+    `chunks` yields ``(nchunk, chunk)`` pairs, and chunks are stored in the
+    container as they are, with no decompression nor recompression.  The
+    container is kept in memory, unless `urlpath` is given to store it as a
+    contiguous frame on disk.
+
+    Returns
+    -------
+    blosc2.NDArray or blosc2.SChunk
+        An array if the metadata has a shape, else a super-chunk.
+    """
+    kwargs = ({} if urlpath is None else
+              {'urlpath': str(urlpath), 'contiguous': True, 'mode': 'w'})
+    if 'shape' in meta:
+        dtype = np.lib.format.descr_to_dtype(meta['dtype'])
+        b2array = blosc2.uninit(tuple(meta['shape']), dtype,
+                                chunks=tuple(meta['chunks']),
+                                blocks=tuple(meta['blocks']), **kwargs)
+        for nchunk, chunk in chunks:
+            b2array.schunk.update_chunk(nchunk, chunk)
+        return b2array
+
+    schunk = blosc2.SChunk(chunksize=meta['chunksize'],
+                           cparams={'typesize': meta['typesize']}, **kwargs)
+    for nchunk, chunk in chunks:
+        schunk.insert_chunk(nchunk, chunk)
+    return schunk
+
+
+def _decompress_array(chunks, shape, chunkshape, blocks, dtype, out=None):
+    if out is None:
+        out = np.empty(shape, dtype)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError(f"Output buffer must have shape {shape} "
+                         f"and dtype {dtype}")
+    # Chunks are stored block by block.  If blocks and chunks span whole
+    # rows (as in one dimension), chunks are laid out like the NumPy array,
+    # so whole ones are decompressed straight into the output buffer, unless
+    # they are padded to a whole number of blocks (as told by the size in
+    # the chunk header).  Other chunks are decompressed into a single-chunk
+    # container, then copied.
+    direct = (len(shape) > 0 and out.flags.c_contiguous
+              and tuple(blocks[1:]) == tuple(chunkshape[1:]) == shape[1:])
+    buffer = None
+    grid = [math.ceil(n / c) for n, c in zip(shape, chunkshape)]
+    for nchunk, chunk in chunks:
+        coords = np.unravel_index(nchunk, grid)
+        region = tuple(slice(i * c, min((i + 1) * c, n))
+                       for i, c, n in zip(coords, chunkshape, shape))
+        if direct:
+            dst = out[region]
+            # Uncompressed size is at offset 4 of the chunk header
+            if int.from_bytes(chunk[4:8], 'little') == dst.nbytes:
+                blosc2.decompress2(chunk, dst=dst)
+                continue
+        if buffer is None:
+            buffer = blosc2.uninit(chunkshape, dtype, chunks=chunkshape,
+                                   blocks=blocks)
+        buffer.schunk.update_chunk(0, chunk)
+        out[region] = buffer[tuple(slice(0, r.stop - r.start)
+                                   for r in region)]
+    return out
+
+
+def _decompress_schunk(chunks, nbytes, chunksize, out=None):
+    data = bytearray(nbytes) if out is None else out
+    view = memoryview(data).cast('B')
+    if view.readonly or len(view) != nbytes:
+        raise ValueError(f"Output buffer must be writable with {nbytes} bytes")
+    for nchunk, chunk in chunks:
+        blosc2.decompress2(chunk, dst=view[nchunk * chunksize:])
+    return bytes(data) if out is None else out
+
+
+def read_chunk_stream(frames, out=None, lazy=False):
+    """
+    Assemble the data in a chunk stream from its ``(index, data)`` frames.
+
+    The first frame holds the metadata of the data as JSON, and the rest hold
+    its compressed chunks, which are decompressed in place as they arrive.
+
+    Parameters
+    ----------
+    frames : iterable of tuples
+        The frames in the stream.
+    out : numpy.ndarray or writable buffer
+        Where to decompress the data, with its same shape and dtype (or size
+        for byte data).  A new buffer is allocated if missing.  Chunks are
+        only decompressed straight into it for byte data, or if blocks and
+        chunks span whole rows of the array (as in one dimension) and chunks
+        are not padded to a whole number of blocks; other chunks are
+        decompressed into a single-chunk buffer and copied.
+    lazy : bool
+        Whether to keep the data compressed in a Blosc2 container.
+
+    Returns
+    -------
+    numpy.ndarray, bytes, blosc2.NDArray or blosc2.SChunk
+        The data in the stream, or `out` if given.
+    """
+    frames = iter(frames)
+    _, meta = next(frames)
+    meta = json.loads(meta)
+
+    if lazy:
+        return chunks_to_b2(meta, frames)
+    if 'shape' not in meta:
+        return _decompress_schunk(frames, meta['nbytes'], meta['chunksize'],
+                                  out)
+    return _decompress_array(frames, tuple(meta['shape']),
+                             tuple(meta['chunks']), tuple(meta['blocks']),
+                             np.lib.format.descr_to_dtype(meta['dtype']), out)
+
+
+def chunk_is_available(schunk, nchunk):
+    # Blosc2 flags are at offset 31
+    # (see https://github.com/Blosc/c-blosc2/blob/main/README_CHUNK_FORMAT.rst)
+    flag = (schunk.get_lazychunk(nchunk)[31] & 0b01110000) >> 4
+    return flag != blosc2.SpecialValue.UNINIT.value
+
+
+_fetch_headers = {'Accept': f'{chunks_media_type}, application/octet-stream'}
+
+
+def _decode_cframe(data, kind, out=None, lazy=False):
+    if kind == 'ndarray':
         data = blosc2.ndarray_from_cframe(data)
-        data = data[:] if data.ndim == 1 else data[()]
-    except RuntimeError:
+    elif kind == 'schunk':
         data = blosc2.schunk_from_cframe(data)
-        data = data[:]
-    return data
+    else:  # try different deserialization methods
+        try:
+            data = blosc2.ndarray_from_cframe(data)
+        except RuntimeError:
+            data = blosc2.schunk_from_cframe(data)
+    if lazy:
+        return data
+
+    if isinstance(data, blosc2.NDArray):
+        if out is None:
+            return data[:] if data.ndim == 1 else data[()]
+        schunk = data.schunk
+        chunks = ((n, schunk.get_chunk(n)) for n in range(schunk.nchunks))
+        return _decompress_array(chunks, data.shape, data.chunks,
+                                 data.blocks, data.dtype, out)
+    if out is None:
+        return data[:]
+    chunks = ((n, data.get_chunk(n)) for n in range(data.nchunks))
+    return _decompress_schunk(chunks, data.nbytes, data.chunksize, out)
+
+
+def fetch_data(path, urlbase, params, auth_cookie=None, out=None,
+               lazy=False):
+    with _xstream(f'{urlbase}api/fetch/{path}', params=params,
+                  headers=_fetch_headers,
+                  auth_cookie=auth_cookie) as response:
+        ctype = response.headers.get('Content-Type', '')
+        if ctype.startswith(chunks_media_type):
+            return read_chunk_stream(iter_frames(response.iter_bytes()),
+                                     out=out, lazy=lazy)
+        kind = response.headers.get(cframe_type_header)
+        data = response.read()
+    return _decode_cframe(data, kind, out, lazy)
+
+
+async def afetch_data(client, path, urlbase, params, auth_cookie=None,
+                      out=None, lazy=False):
+    """Async version of `fetch_data()`, sending requests with `client`."""
+    async with _axstream(client, f'{urlbase}api/fetch/{path}', params=params,
+                         headers=_fetch_headers,
+                         auth_cookie=auth_cookie) as response:
+        ctype = response.headers.get('Content-Type', '')
+        if ctype.startswith(chunks_media_type):
+            frames = [frame async for frame
+                      in aiter_frames(response.aiter_bytes())]
+            return read_chunk_stream(frames, out=out, lazy=lazy)
+        kind = response.headers.get(cframe_type_header)
+        data = await response.aread()
+    return _decode_cframe(data, kind, out, lazy)
+
+
+_cache_locks = {}  # mirror path: lock
+_cache_locks_lock = threading.Lock()
+
+
+def _cache_lock(cachepath):
+    # Get the lock for accessing the mirror at `cachepath`
+    with _cache_locks_lock:
+        return _cache_locks.setdefault(cachepath, threading.Lock())
+
+
+def _read_etag(cachepath, etagpath):
+    return (etagpath.read_text()
+            if cachepath.is_file() and etagpath.is_file() else None)
+
+
+def fetch_cached(path, urlbase, slice_, cachedir, auth_cookie=None,
+                 out=None):
+    """
+    Fetch a slice of a dataset, keeping its chunks in a local cache.
+
+    The dataset is mirrored under `cachedir` (with the same path as in the
+    subscriber) as a Blosc2 array where only the chunks fetched so far are
+    available, along with the ETag of the dataset metadata in the subscriber
+    (which changes with the version of the dataset in the publisher).
+    Chunks covered by the slice which are missing are requested to the
+    subscriber, then the slice is read locally.  The mirror is replaced when
+    the dataset changes, according to its ETag.
+
+    Each mirror is only locked while it is read or written, not during
+    requests to the subscriber.
+
+    If given, the slice is stored in `out` (see `read_chunk_stream()`); its
+    chunks are decompressed straight into it if the slice covers the whole
+    dataset, otherwise the slice is read and copied into it.
+
+    Return `None` if the dataset can not be cached (e.g. if it is not an
+    array, or it is in scratch space).
+    """
+    path = pathlib.Path(path)
+    if not blosc2_is_here or path.parts[0] == '@scratch':
+        return None
+    cachepath = pathlib.Path(cachedir).resolve() / path
+    etagpath = cachepath.with_name(f'{cachepath.name}.etag')
+    lock = _cache_lock(cachepath)
+
+    with lock:
+        etag = _read_etag(cachepath, etagpath)
+    headers = {'If-None-Match': etag} if etag else {}
+    if auth_cookie:
+        headers['Cookie'] = auth_cookie
+    response = httpx.get(f'{urlbase}api/info/{path}', headers=headers)
+    if response.status_code != 304:
+        response.raise_for_status()
+        meta = response.json()
+        if 'chunks' not in meta:
+            return None
+        dtype = meta['dtype']
+        dtype = np.dtype(ast.literal_eval(dtype) if dtype.startswith('[')
+                         else dtype)
+        etag = response.headers['ETag']
+        with lock:
+            # Another fetch may have replaced the mirror meanwhile
+            if _read_etag(cachepath, etagpath) != etag:
+                cachepath.parent.mkdir(parents=True, exist_ok=True)
+                etagpath.unlink(missing_ok=True)
+                blosc2.uninit(tuple(meta['shape']), dtype,
+                              chunks=tuple(meta['chunks']),
+                              blocks=tuple(meta['blocks']),
+                              urlpath=str(cachepath), mode='w')
+                etagpath.write_text(etag)
+
+    with lock:
+        array = blosc2.open(str(cachepath))
+        nchunks = slice_nchunks(slice_, array.shape, array.chunks)
+        missing = [n for n in nchunks
+                   if not chunk_is_available(array.schunk, n)]
+    if missing:
+        params = {'nchunks': chunks_to_string(missing)}
+        with _xstream(f'{urlbase}api/chunks/{path}', params=params,
+                      auth_cookie=auth_cookie) as response:
+            frames = list(iter_frames(response.iter_bytes()))
+
+    with lock:
+        if _read_etag(cachepath, etagpath) != etag:
+            # Replaced by a newer version meanwhile, start anew
+            return fetch_cached(path, urlbase, slice_, cachedir, auth_cookie,
+                                out)
+        array = blosc2.open(str(cachepath), mode='a')
+        if missing:
+            for nchunk, chunk in frames:
+                array.schunk.update_chunk(nchunk, chunk)
+
+        index, _ = normalize_slice(slice_, array.shape)
+        if out is not None and all(sl == slice(0, n, 1)
+                                   for sl, n in zip(index, array.shape)):
+            schunk = array.schunk
+            chunks = ((n, schunk.get_chunk(n)) for n in range(schunk.nchunks))
+            return _decompress_array(chunks, array.shape, array.chunks,
+                                     array.blocks, array.dtype, out)
+        data = strided_getitem(array.__getitem__, slice_, array.shape,
+                               array.chunks)
+
+    if out is None:
+        return data
+    if out.shape != data.shape or out.dtype != data.dtype:
+        raise ValueError(f"Output buffer must have shape {data.shape} "
+                         f"and dtype {data.dtype}")
+    out[...] = data
+    return out
+
+
+def reduce_data(path, urlbase, params, auth_cookie=None):
+    # Reductions may take a while, and nothing is sent until they finish
+    response = _xget(f'{urlbase}api/reduce/{path}', params=params,
+                     timeout=None, auth_cookie=auth_cookie)
+    data = blosc2.ndarray_from_cframe(response.content)
+    return data[:] if data.ndim == 1 else data[()]
+
+
+async def areduce_data(client, path, urlbase, params, auth_cookie=None):
+    """Async version of `reduce_data()`, sending requests with `client`."""
+    response = await _axget(client, f'{urlbase}api/reduce/{path}',
+                            params=params, timeout=None,
+                            auth_cookie=auth_cookie)
+    data = blosc2.ndarray_from_cframe(response.content)
+    return data[:] if data.ndim == 1 else data[()]
+
+
+def axis_to_string(axis):
+    if axis is None:
+        return None
+    if not isinstance(axis, tuple):
+        axis = (axis,)
+    return ','.join(str(a) for a in axis)
 
 
 def get_download_url(path, urlbase):
@@ -117,25 +664,181 @@ def b2_unpack(filepath):
 _attachment_b2fname_rx = re.compile(r';\s*filename\*?\s*=\s*"([^"]+\.b2)"')
 
 
-def download_url(url, localpath, try_unpack=True, auth_cookie=None):
-    headers = {'Cookie': auth_cookie} if auth_cookie else None
-    with httpx.stream("GET", url, headers=headers) as r:
+_content_range_rx = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def _load_download_state(statepath):
+    try:
+        with open(statepath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_download_state(statepath, state):
+    with open(statepath, 'w') as f:
+        json.dump(state, f)
+
+
+def _update_download_state(state, response, start):
+    # Get the properties of the whole file from a response to a request for
+    # the bytes from `start`.
+    state['etag'] = response.headers.get('etag')
+    cdisp = response.headers.get('content-disposition', '')
+    state['is_b2'] = bool(_attachment_b2fname_rx.findall(cdisp))
+    if response.status_code == 206:
+        match = _content_range_rx.match(response.headers['content-range'])
+        size = match.group(3)
+        state['size'] = None if size == '*' else int(size)
+    elif 'content-length' in response.headers:
+        state['size'] = start + int(response.headers['content-length'])
+
+
+def _download_range(client, url, partpath, state, range_, stop):
+    # Download the missing range ``[start, end)`` (the end may be `None`) of
+    # the file into `partpath`, updating `range_` as data is written.
+    # Return false if the file on the server changed (or ranges are not
+    # supported), so that the whole file needs to be downloaded again.
+    start, end = range_
+    headers = {'Range': f'bytes={start}-{"" if end is None else end - 1}'}
+    if state['etag']:
+        headers['If-Range'] = state['etag']
+    with client.stream('GET', url, headers=headers) as r:
+        if r.status_code == 416:  # nothing left to download
+            range_[:] = [start, start]
+            return True
         r.raise_for_status()
-        # Build the local filepath
-        cdisp = r.headers.get('content-disposition', '')
-        is_b2 = bool(_attachment_b2fname_rx.findall(cdisp))
-        if is_b2:
-            localpath += '.b2'
-        localpath = pathlib.Path(localpath)
-        localpath.parent.mkdir(parents=True, exist_ok=True)
-        with open(localpath, "wb") as f:
+        if r.status_code == 200 and (start > 0 or state['etag']):
+            if state['etag'] and r.headers.get('etag') == state['etag']:
+                raise RuntimeError('Range requests are not supported')
+            return False
+
+        if state['etag'] is None:
+            _update_download_state(state, r, start)
+        with open(partpath, 'r+b') as f:
+            f.seek(start)
             for data in r.iter_bytes():
+                if stop.is_set():
+                    break
                 f.write(data)
-        if is_b2 and try_unpack:
-            localpath = b2_unpack(localpath)
+                range_[0] += len(data)
+    return True
+
+
+def download_url(url, localpath, try_unpack=True, auth_cookie=None,
+                 resume=False, nranges=1):
+    """
+    Download the file at `url` to `localpath`.
+
+    Data is written to a ``.part`` file, renamed to `localpath` when complete.
+    If `resume` is true and an interrupted download left such a file, only
+    the missing data is downloaded, as long as the file on the server did not
+    change since (as told by its ETag).
+
+    If `nranges` is greater than one, the file is split in that many byte
+    ranges, which are downloaded in parallel.
+    """
+    localpath = pathlib.Path(localpath)
+    localpath.parent.mkdir(parents=True, exist_ok=True)
+    partpath = localpath.with_name(f'{localpath.name}.part')
+    statepath = localpath.with_name(f'{localpath.name}.part.json')
+
+    state = (_load_download_state(statepath)
+             if resume and partpath.exists() else None)
+    if state is None:
+        state = {'etag': None, 'is_b2': False, 'size': None,
+                 'missing': [[0, None]]}
+        partpath.write_bytes(b'')
+
+    headers = {'Cookie': auth_cookie} if auth_cookie else None
+    stop = threading.Event()
+    with httpx.Client(headers=headers) as client:
+        # Learn the size of the file to split it in ranges
+        if nranges > 1 and state['size'] is None:
+            with client.stream('GET', url, headers={'Range': 'bytes=0-0'}) as r:
+                r.raise_for_status()
+                if r.status_code == 206:
+                    _update_download_state(state, r, 0)
+                    state['missing'] = [[0, state['size']]]
+        if nranges > 1 and state['size'] is not None:
+            missing = [[start, state['size'] if end is None else end]
+                       for start, end in state['missing']]
+            state['missing'] = _split_ranges(missing, nranges)
+            with open(partpath, 'r+b') as f:
+                f.truncate(state['size'])
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(nranges) as executor:
+                futures = [executor.submit(_download_range, client, url,
+                                           partpath, state, range_, stop)
+                           for range_ in state['missing']
+                           if range_[1] is None or range_[0] < range_[1]]
+                try:
+                    unchanged = all(f.result() for f in futures)
+                except BaseException:
+                    stop.set()
+                    raise
+        finally:
+            # Save the progress, for resuming later
+            _save_download_state(statepath, state)
+
+    if not unchanged:
+        # Start anew (only once)
+        os.unlink(statepath)
+        if not resume:
+            raise RuntimeError(f'{url} changed while downloading')
+        return download_url(url, localpath, try_unpack, auth_cookie,
+                            resume=False, nranges=nranges)
+
+    if state['is_b2']:
+        localpath = localpath.with_name(f'{localpath.name}.b2')
+    os.replace(partpath, localpath)
+    os.unlink(statepath)
+    if state['is_b2'] and try_unpack:
+        localpath = b2_unpack(localpath)
     return localpath
 
 
+async def adownload_url(client, url, localpath, try_unpack=True,
+                        auth_cookie=None):
+    """
+    Async version of `download_url()`, sending requests with `client`.
+
+    The whole file is downloaded in a single request, with no resuming.
+    """
+    localpath = pathlib.Path(localpath)
+    localpath.parent.mkdir(parents=True, exist_ok=True)
+    partpath = localpath.with_name(f'{localpath.name}.part')
+
+    async with _axstream(client, url, auth_cookie=auth_cookie) as response:
+        cdisp = response.headers.get('content-disposition', '')
+        is_b2 = bool(_attachment_b2fname_rx.findall(cdisp))
+        with open(partpath, 'wb') as f:
+            async for data in response.aiter_bytes():
+                f.write(data)
+
+    if is_b2:
+        localpath = localpath.with_name(f'{localpath.name}.b2')
+    os.replace(partpath, localpath)
+    if is_b2 and try_unpack:
+        localpath = b2_unpack(localpath)
+    return localpath
+
+
+def _split_ranges(ranges, n):
+    # Split the largest ranges until there are `n` of them
+    ranges = [range_ for range_ in ranges if range_[0] < range_[1]]
+    while ranges and len(ranges) < n:
+        largest = max(ranges, key=lambda r: r[1] - r[0])
+        start, end = largest
+        if end - start < 2:
+            break
+        middle = (start + end) // 2
+        largest[1] = middle
+        ranges.append([middle, end])
+    return sorted(ranges)
+
+
 #
 # HTTP client helpers
 #
@@ -148,6 +851,40 @@ def _xget(url, params=None, headers=None, timeout=5, auth_cookie=None):
     return response
 
 
+@contextlib.contextmanager
+def _xstream(url, params=None, headers=None, timeout=5, auth_cookie=None):
+    if auth_cookie:
+        headers = headers.copy() if headers else {}
+        headers['Cookie'] = auth_cookie
+    with httpx.stream('GET', url, params=params, headers=headers,
+                      timeout=timeout) as response:
+        response.raise_for_status()
+        yield response
+
+
+async def _axget(client, url, params=None, headers=None, timeout=5,
+                 auth_cookie=None):
+    if auth_cookie:
+        headers = headers.copy() if headers else {}
+        headers['Cookie'] = auth_cookie
+    response = await client.get(url, params=params, headers=headers,
+                                timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+@contextlib.asynccontextmanager
+async def _axstream(client, url, params=None, headers=None, timeout=5,
+                    auth_cookie=None):
+    if auth_cookie:
+        headers = headers.copy() if headers else {}
+        headers['Cookie'] = auth_cookie
+    async with client.stream('GET', url, params=params, headers=headers,
+                             timeout=timeout) as response:
+        response.raise_for_status()
+        yield response
+
+
 def get(url, params=None, headers=None, timeout=5, model=None,
         auth_cookie=None):
     response = _xget(url, params, headers, timeout, auth_cookie)
@@ -155,8 +892,26 @@ def get(url, params=None, headers=None, timeout=5, model=None,
     return json if model is None else model(**json)
 
 
-def post(url, json=None, auth_cookie=None):
+def post(url, json=None, params=None, auth_cookie=None):
+    headers = {'Cookie': auth_cookie} if auth_cookie else None
+    response = httpx.post(url, json=json, params=params, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+async def aget(client, url, params=None, headers=None, timeout=5,
+               model=None, auth_cookie=None):
+    """Async version of `get()`, sending requests with `client`."""
+    response = await _axget(client, url, params, headers, timeout,
+                            auth_cookie)
+    json = response.json()
+    return json if model is None else model(**json)
+
+
+async def apost(client, url, json=None, params=None, auth_cookie=None):
+    """Async version of `post()`, sending requests with `client`."""
     headers = {'Cookie': auth_cookie} if auth_cookie else None
-    response = httpx.post(url, json=json, headers=headers)
+    response = await client.post(url, json=json, params=params,
+                                 headers=headers)
     response.raise_for_status()
     return response.json()
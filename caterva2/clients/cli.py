@@ -145,7 +145,8 @@ def cmd_show(args, auth_cookie):
 @handle_errors
 @with_auth_cookie
 def cmd_download(args, auth_cookie):
-    path = cat2.download(args.dataset, args.urlbase, auth_cookie=auth_cookie)
+    path = cat2.download(args.dataset, args.urlbase, auth_cookie=auth_cookie,
+                         resume=args.resume, nranges=args.ranges)
 
     print(f'Dataset saved to {path}')
 
@@ -206,6 +207,10 @@ def main():
     help = 'Download a dataset and save it in the local system'
     subparser = subparsers.add_parser('download', help=help)
     subparser.add_argument('--json', action='store_true')
+    subparser.add_argument('--resume', action='store_true',
+                           help='Resume an interrupted download.')
+    subparser.add_argument('--ranges', type=int, default=1, metavar='N',
+                           help='Download N byte ranges in parallel.')
     subparser.add_argument('dataset', type=str)
     subparser.add_argument('output_dir', nargs='?', default='.', type=pathlib.Path)
     subparser.set_defaults(func=cmd_download)
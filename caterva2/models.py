@@ -58,6 +58,14 @@ class NewLazyExpr(pydantic.BaseModel):
     operands: typing.Dict[str, str]
 
 
+class Compute(pydantic.BaseModel):
+    expression: str
+    operands: typing.Dict[str, str]
+    op: str
+    axis: typing.Optional[typing.List[int]] = None
+    slice_: typing.Optional[str] = None
+
+
 class File(pydantic.BaseModel):
     mtime: float
     size: int
@@ -58,7 +58,8 @@ def main():
     # roots = {name: <Root>}
     statedir = args.statedir.resolve()
     global database
-    database = srv_utils.Database(statedir / 'db.json', models.Broker(roots={}))
+    database = srv_utils.open_database(statedir, models.Broker(roots={}),
+                                       conf.get('.database', 'json'))
     print(database.data)
 
     # Run
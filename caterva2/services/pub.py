@@ -7,13 +7,18 @@
 # See LICENSE.txt for details about copyright and rights to use.
 ###############################################################################
 
+import argparse
 import asyncio
 import contextlib
+import json
 import logging
+import typing
 
 # Requirements
 import blosc2
-from fastapi import FastAPI, Response, responses
+from fastapi import FastAPI, HTTPException, Response, responses
+import numexpr as ne
+import numpy as np
 import uvicorn
 
 # Project
@@ -33,11 +38,13 @@ broker = None
 name = None
 proot = None
 nworkers = 1
+compute = False  # whether to evaluate expressions and reductions
 
 # State
 cache = None
 client = None
 database = None  # <Database> instance
+index = None     # <DatasetIndex> instance
 
 
 async def worker(queue):
@@ -60,11 +67,13 @@ async def worker(queue):
                     metadata = srv_utils.read_metadata(b2path)
 
                 # Publish
+                etag = proot.get_dset_etag(relpath)
                 metadata = metadata.model_dump()
-                data = {'path': str(relpath), 'metadata': metadata}
+                data = {'path': str(relpath), 'metadata': metadata,
+                        'etag': etag}
                 await client.publish(name, data=data)
                 # Update database
-                database.etags[key] = proot.get_dset_etag(relpath)
+                database.etags[key] = etag
                 database.save()
             else:
                 print('DELETE', relpath)
@@ -82,7 +91,7 @@ async def watch_root(queue):
     # On start, notify the network about changes to the datasets, changes done since the
     # last run.
     etags = database.etags.copy()
-    for relpath in proot.walk_dsets():
+    for relpath in index:
         key = str(relpath)
         val = etags.pop(key, None)
         if val != proot.get_dset_etag(relpath):
@@ -98,6 +107,7 @@ async def watch_root(queue):
     # Watch root for changes
     async for changes in proot.awatch_dsets():
         for relpath in changes:
+            index.update(relpath)
             queue.put_nowait(relpath)
 
     print('THIS SHOULD BE PRINTED ON CTRL+C')
@@ -116,6 +126,10 @@ async def lifespan(app: FastAPI):
         task = asyncio.create_task(worker(queue))
         tasks.append(task)
 
+    # Index datasets
+    global index
+    index = pubroot.DatasetIndex(proot)
+
     # Watch dataset files (must wait before publishing)
     await client.wait_until_ready()
     watch_task = asyncio.create_task(watch_root(queue))
@@ -138,8 +152,16 @@ app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/api/list")
-async def get_list():
-    return list(proot.walk_dsets())
+async def get_list(prefix: str = '', limit: int = None, cursor: str = None,
+                   recursive: bool = True):
+    """
+    List the paths of datasets in the root, in order.
+
+    Only paths starting with `prefix` are listed, and at most `limit` of them,
+    all after `cursor`.  To get the next page of results, use the last path
+    as the cursor.  See `srv_utils.PathIndex.list()` for `recursive`.
+    """
+    return index.list(prefix, limit, cursor, recursive)
 
 
 @app.get("/api/info/{path:path}")
@@ -156,17 +178,57 @@ async def get_info(
     if if_none_match == etag:
         return Response(status_code=304)
 
-    if relpath.suffix in {'.b2frame', '.b2nd'}:
-        meta = proot.get_dset_meta(relpath)
-    else:
-        b2path = srv_utils.get_abspath(cache, '%s.b2' % relpath)
-        meta = srv_utils.read_metadata(b2path)
+    meta = get_dset_meta(relpath)
 
     # Return
     response.headers['Etag'] = etag
     return meta
 
 
+@app.post("/api/info")
+def post_info(etags: typing.Dict[str, typing.Optional[str]]):
+    """
+    Get the metadata of many datasets in a single response.
+
+    The body maps dataset paths to the etags known by the client (or null).
+    Only datasets whose etag differs are included in the response, which
+    streams one JSON object per line with the ``path``, ``etag`` and
+    ``metadata`` of each dataset.  Paths of unknown datasets are skipped.
+    """
+    def iter_infos():
+        for path, known in etags.items():
+            etag = database.etags.get(path)
+            if etag is None or etag == known:
+                continue
+            try:
+                meta = get_dset_meta(proot.Path(path))
+            except (FileNotFoundError, HTTPException):  # removed meanwhile
+                continue
+            info = {'path': path, 'etag': etag,
+                    'metadata': meta.model_dump(mode='json')}
+            yield json.dumps(info) + '\n'
+
+    return responses.StreamingResponse(iter_infos(),
+                                       media_type='application/x-ndjson')
+
+
+def get_dset_meta(relpath):
+    if relpath.suffix in {'.b2frame', '.b2nd'}:
+        return proot.get_dset_meta(relpath)
+
+    b2path = srv_utils.get_abspath(cache, '%s.b2' % relpath)
+    return srv_utils.read_metadata(b2path)
+
+
+def get_chunk_getter(relpath):
+    if relpath.suffix in {'.b2frame', '.b2nd'}:
+        return lambda nchunk: proot.get_dset_chunk(relpath, nchunk)
+
+    b2path = cache / ('%s.b2' % relpath)
+    schunk = blosc2.open(b2path)
+    return schunk.get_chunk
+
+
 @app.get("/api/download/{path:path}")
 async def get_download(path: str, nchunk: int = -1):
     if nchunk < 0:
@@ -175,17 +237,104 @@ async def get_download(path: str, nchunk: int = -1):
     relpath = proot.Path(path)
     srv_utils.check_dset_path(proot, relpath)
 
-    if relpath.suffix in {'.b2frame', '.b2nd'}:
-        chunk = proot.get_dset_chunk(relpath, nchunk)
-    else:
-        b2path = cache / ('%s.b2' % relpath)
-        schunk = blosc2.open(b2path)
-        chunk = schunk.get_chunk(nchunk)
+    chunk = get_chunk_getter(relpath)(nchunk)
 
     downloader = srv_utils.iterchunk(chunk)
     return responses.StreamingResponse(downloader)
 
 
+@app.get("/api/download-chunks/{path:path}")
+async def get_download_chunks(path: str, nchunks: str = ''):
+    """
+    Download several chunks of a dataset in a single response.
+
+    The `nchunks` parameter holds comma-separated chunk indices and inclusive
+    ranges of them (like ``0-9,15,20-30``).  Chunks are streamed in the given
+    order as a framed stream (see `api_utils.iter_frames()`), with the chunk
+    index as the index of each frame.
+    """
+    try:
+        nchunks = api_utils.parse_chunks(nchunks)
+    except ValueError:
+        srv_utils.raise_bad_request(f'Invalid chunk numbers {nchunks}')
+    if not nchunks:
+        srv_utils.raise_bad_request('Chunk numbers required')
+
+    relpath = proot.Path(path)
+    srv_utils.check_dset_path(proot, relpath)
+
+    get_chunk = get_chunk_getter(relpath)
+
+    def downloader():
+        for nchunk in nchunks:
+            yield from api_utils.iter_frame(nchunk, get_chunk(nchunk))
+
+    return responses.StreamingResponse(downloader())
+
+
+@app.post("/api/compute")
+def post_compute(request: models.Compute):
+    """
+    Reduce (a slice of) an expression of datasets in the root.
+
+    The ``expression`` is evaluated with NumExpr over the ``operands``, which
+    map the variables in it to the paths of arrays in the root, all with the
+    same shape.  Only the operations allowed by `srv_utils.check_expression()`
+    may be used.  The result of the reduction ``op`` (see
+    `srv_utils.reduce_array()`) is returned as a serialized NDArray.
+
+    The expression is evaluated chunk by chunk, and only the chunks of
+    operands covered by ``slice_`` are read.
+    """
+    if not compute:
+        raise HTTPException(status_code=403, detail='Computation disabled')
+    if request.op not in srv_utils.reductions:
+        srv_utils.raise_bad_request(f'Unsupported reduction {request.op}')
+    try:
+        srv_utils.check_expression(request.expression, request.operands)
+    except ValueError as exc:
+        srv_utils.raise_bad_request(str(exc))
+
+    getitems = {}
+    dtypes = {}
+    shape = chunks = None
+    for name, path in request.operands.items():
+        relpath = proot.Path(path)
+        srv_utils.check_dset_path(proot, relpath)
+        if relpath.suffix != '.b2nd':
+            srv_utils.raise_bad_request(f'Not an array {path}')
+        meta = proot.get_dset_meta(relpath)
+        if shape is None:
+            shape, chunks = meta.shape, meta.chunks
+        elif meta.shape != shape:
+            srv_utils.raise_bad_request('Operands must have the same shape')
+        dtypes[name] = np.dtype(meta.dtype)
+        getitems[name] = srv_utils.chunked_getitem(
+            lambda nchunk, relpath=relpath: proot.get_dset_chunk(relpath,
+                                                                 nchunk),
+            meta.shape, meta.chunks, meta.blocks, meta.dtype)
+    if shape is None:
+        srv_utils.raise_bad_request('Operands required')
+
+    def getitem(index):
+        data = {name: getitem_(index) for name, getitem_ in getitems.items()}
+        return ne.evaluate(request.expression, local_dict=data)
+
+    try:
+        dtype = ne.evaluate(request.expression, local_dict={
+            name: np.zeros(1, dtype) for name, dtype in dtypes.items()}).dtype
+        axis = tuple(request.axis) if request.axis is not None else None
+        slice_ = api_utils.parse_slice(request.slice_)
+        result = srv_utils.reduce_array(getitem, shape, chunks, dtype,
+                                        request.op, axis, slice_)
+    except (IndexError, KeyError, NotImplementedError, TypeError,
+            ValueError) as exc:
+        srv_utils.raise_bad_request(str(exc))
+
+    return Response(blosc2.asarray(result).to_cframe(),
+                    media_type='application/octet-stream')
+
+
 def main():
     conf = utils.get_conf('publisher', allow_id=True)
     _stdir = '_caterva2/pub' + (f'.{conf.id}' if conf.id else '')
@@ -196,16 +345,20 @@ def main():
                               id=conf.id)
     parser.add_argument('name', nargs='?', default=conf.get('.name'))
     parser.add_argument('root', nargs='?', default=conf.get('.root', 'data'))
+    parser.add_argument('--compute', action=argparse.BooleanOptionalAction,
+                        default=conf.get('.compute', False),
+                        help="compute reductions for subscribers")
     args = utils.run_parser(parser)
     if args.name is None:  # because optional positional arg w/o conf default
         raise RuntimeError(
             "root name was not specified in configuration nor in arguments")
 
     # Global configuration
-    global broker, name, proot
+    global broker, name, proot, compute
     broker = args.broker
     name = args.name
     proot = pubroot.make_root(args.root)
+    compute = args.compute
 
     # Init cache
     global cache
@@ -216,7 +369,8 @@ def main():
     # Init database
     global database
     model = models.Publisher(etags={})
-    database = srv_utils.Database(statedir / 'db.json', model)
+    database = srv_utils.open_database(statedir, model,
+                                       conf.get('.database', 'json'))
 
     # Register
     host, port = args.http
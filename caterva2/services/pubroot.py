@@ -31,6 +31,9 @@ except ImportError:  # Python < 3.11
 # Requirements
 import pydantic
 
+# Project
+from caterva2.services import srv_utils
+
 
 class NoSuchDatasetError(LookupError):
     """The given dataset does not exist."""
@@ -97,6 +100,37 @@ class PubRoot(ABC):
         """Yield a set of datasets that have been modified."""
 
 
+class DatasetIndex(srv_utils.PathIndex):
+    """A sorted index of the datasets in a publisher root.
+
+    It is built once by walking the root, then kept current by calling
+    `update()` with the paths of modified datasets (as yielded by
+    `PubRoot.awatch_dsets()`).
+    """
+
+    def __init__(self, root: PubRoot):
+        super().__init__(root.walk_dsets())
+        self.root = root
+
+    def __iter__(self) -> Iterator[PubRoot.Path]:
+        return (self.root.Path(path) for path in self.paths.copy())
+
+    def update(self, relpath: PubRoot.Path) -> None:
+        """Add or remove the given dataset, depending on whether it exists.
+
+        If it does not exist, datasets under it (as a directory) which do not
+        exist any longer are removed too.
+        """
+        if self.root.exists_dset(relpath):
+            self.add(relpath)
+            return
+
+        self.remove(relpath)
+        for path in self.list(prefix=f'{relpath}/'):
+            if not self.root.exists_dset(self.root.Path(path)):
+                self.remove(path)
+
+
 _registered_classes = []
 
 
@@ -7,9 +7,21 @@
 # See LICENSE.txt for details about copyright and rights to use.
 ###############################################################################
 
+import array
+import ast
 import asyncio
+import bisect
+import collections
+import collections.abc
+import fnmatch
+import functools
+import itertools
 import json
+import math
+import os
 import pathlib
+import sqlite3
+import threading
 import typing
 
 # Requirements
@@ -17,10 +29,11 @@ import blosc2
 import fastapi
 import fastapi_websocket_pubsub
 import numpy as np
+import pydantic
 import safer
 
 # Project
-from caterva2 import models
+from caterva2 import api_utils, models, utils
 
 
 def cache_lookup(cachedir, path):
@@ -162,6 +175,22 @@ def get_abspath(root, path):
     return abspath
 
 
+class CallbackFileResponse(fastapi.responses.FileResponse):
+    """
+    A file response which calls ``on_done()`` after being sent (or failing to).
+    """
+    def __init__(self, *args, on_done=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_done = on_done
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+
 def check_dset_path(proot, path):
     try:
         exists = proot.exists_dset(path)
@@ -277,16 +306,913 @@ def open_b2(abspath):
     return array, schunk
 
 
-def chunk_is_available(schunk, nchunk):
-    # Blosc2 flags are at offset 31
-    # (see https://github.com/Blosc/c-blosc2/blob/main/README_CHUNK_FORMAT.rst)
-    flag = (schunk.get_lazychunk(nchunk)[31] & 0b01110000) >> 4
-    return flag != blosc2.SpecialValue.UNINIT.value
+def chunk_cbytes(schunk, nchunk):
+    # Compressed size is at offset 12 of the chunk header
+    return int.from_bytes(schunk.get_lazychunk(nchunk)[12:16], 'little')
+
+
+@functools.lru_cache
+def uninit_chunk(nbytes, typesize):
+    """Get a chunk with `nbytes` of uninitialized special values."""
+    schunk = blosc2.SChunk(chunksize=nbytes, cparams={'typesize': typesize})
+    schunk.fill_special(nbytes // typesize,
+                        special_value=blosc2.SpecialValue.UNINIT)
+    return schunk.get_chunk(0)
+
+
+def reset_chunks(abspath, nchunks):
+    """
+    Reset the given chunks of the cached dataset at `abspath` in place.
+
+    The chunks are replaced with uninitialized special values, so that
+    `api_utils.chunk_is_available()` reports them as missing.  The space
+    taken by their data in the file is not reclaimed (see `compact_b2()`).
+    """
+    _, schunk = open_b2(abspath)
+    for nchunk in nchunks:
+        # Uncompressed size and type size are at offsets 4 and 3 of the header
+        header = schunk.get_lazychunk(nchunk)[:32]
+        nbytes = int.from_bytes(header[4:8], 'little')
+        schunk.update_chunk(nchunk, uninit_chunk(nbytes, header[3]))
+
+
+def compact_b2(abspath, tmppath, evict=()):
+    """
+    Rewrite the cached dataset at `abspath`, leaving the chunks in `evict` out.
+
+    Since contiguous frames never reclaim the space of replaced chunks, the
+    available chunks (except evicted ones) are copied into a new file at
+    `tmppath`, which then replaces the original one.  Handles to the original
+    file remain valid, but they do not see the new one.
+    """
+    array, schunk = open_b2(abspath)
+    metadata = read_metadata(abspath)
+    if array is not None:
+        newarray = init_b2nd(metadata, tmppath)
+        newschunk = newarray.schunk
+    else:
+        newschunk = init_b2frame(metadata, tmppath)
+
+    for nchunk in range(schunk.nchunks):
+        if (nchunk not in evict
+                and api_utils.chunk_is_available(schunk, nchunk)):
+            newschunk.update_chunk(nchunk, schunk.get_chunk(nchunk))
+
+    del array, schunk, newschunk
+    os.replace(tmppath, abspath)
+
+
+def iterchunk(chunk, size=2**20):
+    """Yield the bytes of `chunk` in pieces of at most `size` bytes."""
+    view = memoryview(chunk)
+    for start in range(0, len(view), size):
+        yield view[start:start + size]
+
+
+def dataset_opener(abspath):
+    """
+    Get a function which opens the dataset at `abspath` like `open_b2()`.
+
+    The dataset is only opened again if its file changed since the last
+    call, as handles go stale when other handles add chunks to the file.  The
+    file must not change between getting handles and using them (e.g. by
+    holding a lock meanwhile).  If the file is replaced by another one,
+    `FileNotFoundError` is raised instead, so that data from both files is
+    not mixed.
+    """
+    last = {}
+
+    def open_dataset():
+        stat = abspath.stat()
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if last and last['key'][0] != stat.st_ino:
+            raise FileNotFoundError(f'{abspath} was replaced')
+        if last.get('key') != key:
+            last['key'] = key
+            last['handles'] = open_b2(abspath)
+        return last['handles']
+
+    return open_dataset
+
+
+def operand_slice(slice_, shape, opshape):
+    """
+    Get the slice of an operand needed to compute a slice of an expression.
+
+    `shape` is the shape of the expression, and `opshape` that of the
+    operand, which is broadcast to the former.  Negative steps are turned
+    into positive ones, so the resulting slice selects the same items as the
+    original one, in ascending order.
+
+    If the operand does not broadcast to the expression (e.g. because it is
+    reduced), return `None`, as all of the operand may be needed.
+    """
+    shape, opshape = tuple(shape), tuple(opshape)
+    try:
+        if np.broadcast_shapes(opshape, shape) != shape:
+            return None
+    except ValueError:
+        return None
+
+    slice_ = slice_ if isinstance(slice_, tuple) else (slice_,)
+    slice_ += (slice(None),) * (len(shape) - len(slice_))
+    # Dimensions of the operand match the last ones of the expression
+    opslice = []
+    for sl, n in zip(slice_[len(shape) - len(opshape):], opshape):
+        if n == 1:  # broadcast
+            opslice.append(slice(None))
+        elif isinstance(sl, slice):
+            items = range(*sl.indices(n))
+            if not items:
+                opslice.append(slice(0, 0))
+                continue
+            if items.step < 0:
+                items = items[::-1]
+            step = items.step if items.step != 1 else None
+            opslice.append(slice(items.start, items[-1] + 1, step))
+        else:
+            opslice.append(slice(sl % n, sl % n + 1))
+    return tuple(opslice)
+
+
+def slice_shift(previous, index):
+    """
+    Get how `index` is shifted with respect to the `previous` one.
+
+    Both indices are as returned by `api_utils.normalize_slice()`.  If
+    `index` is like `previous` but shifted along a single axis (with the same
+    extent and positive step), return a tuple with that axis and the shift.
+    Otherwise, return `None`.
+    """
+    if previous is None or len(previous) != len(index):
+        return None
+
+    shift = None
+    for axis, (prev, cur) in enumerate(zip(previous, index)):
+        if prev == cur:
+            continue
+        if shift is not None:
+            return None
+        if isinstance(prev, int) and isinstance(cur, int):
+            delta = cur - prev
+        elif (isinstance(prev, slice) and isinstance(cur, slice)
+              and prev.step == cur.step and cur.step > 0
+              and prev.stop - prev.start == cur.stop - cur.start):
+            delta = cur.start - prev.start
+        else:
+            return None
+        shift = (axis, delta)
+
+    return shift
+
+
+def scan_chunks(index, axis, delta, shape, chunks, maxchunks):
+    """
+    Get the numbers of the chunks to be read next by a scan.
+
+    The scan continues after `index` (as returned by
+    `api_utils.normalize_slice()`) with indices shifted by `delta` along
+    `axis`, until the end of `shape`.  The numbers of at most `maxchunks`
+    chunks are returned in scan order, excluding those chunks covered by
+    `index`.
+    """
+    ranges = []
+    for sl, c in zip(index, chunks):
+        if isinstance(sl, int):
+            sl = slice(sl, sl + 1)
+        if sl.start >= sl.stop:
+            return []
+        ranges.append(range(sl.start // c, (sl.stop - 1) // c + 1))
+
+    n, c, sl = shape[axis], chunks[axis], index[axis]
+    start, stop = ((sl, sl + 1) if isinstance(sl, int)
+                   else (sl.start, sl.stop))
+    grid = [math.ceil(n_ / c_) for n_, c_ in zip(shape, chunks)]
+    seen = set(ranges[axis])
+    nchunks = []
+    while len(nchunks) < maxchunks:
+        start, stop = start + delta, stop + delta
+        if not 0 <= start < n:
+            break
+        for coord in range(start // c, (min(stop, n) - 1) // c + 1):
+            if coord in seen:
+                continue
+            seen.add(coord)
+            ranges[axis] = [coord]
+            nchunks.extend(int(np.ravel_multi_index(coords, grid))
+                           for coords in itertools.product(*ranges))
+
+    return nchunks[:maxchunks]
+
+
+def sliced_array(getitem, shape, dtype, slice_=None):
+    """
+    Get the metadata and compressed chunks of a slice of an array.
+
+    `getitem` is called with the index of each region of the array to be read
+    (as a NumPy array), so that the sliced data is never materialized as a
+    whole: it is read and compressed chunk by chunk, while the returned
+    iterator is consumed.
+
+    The metadata is a dictionary with the ``shape``, ``chunks``, ``blocks``
+    and ``dtype`` (as a descriptor) of the sliced data.
+    """
+    index, shape = api_utils.normalize_slice(slice_, shape)
+    dtype = np.dtype(dtype)
+    chunks, blocks = blosc2.compute_chunks_blocks(shape, dtype=dtype)
+    meta = {
+        'shape': shape,
+        'chunks': chunks,
+        'blocks': blocks,
+        'dtype': np.lib.format.dtype_to_descr(dtype),
+    }
+
+    def get_source_index(start):
+        # Map the chunk starting at `start` in the sliced data to the source
+        starts = iter(start)
+        chunk_shape = iter(chunks)
+        source = []
+        for sl in index:
+            if isinstance(sl, slice):
+                i = next(starts)
+                n = next(chunk_shape)
+                sl = range(sl.start, sl.stop, sl.step)[i:i + n]
+                stop = sl.start + len(sl) * sl.step
+                sl = slice(sl.start, stop if stop >= 0 else None, sl.step)
+            source.append(sl)
+        return tuple(source)
+
+    def iterchunks():
+        starts = [range(0, n, c) for n, c in zip(shape, chunks)]
+        for start in itertools.product(*starts):
+            data = np.asarray(getitem(get_source_index(start)))
+            b2array = blosc2.asarray(data, chunks=chunks, blocks=blocks)
+            yield b2array.schunk.get_chunk(0)
+
+    return meta, iterchunks()
+
+
+reductions = {'sum', 'mean', 'std', 'min', 'max'}
+
+
+def reduce_array(getitem, shape, chunks, dtype, op, axis=None, slice_=None):
+    """
+    Reduce (a slice of) an array with operation `op` along some axes.
+
+    `getitem` is called with the index of each region of the array to be read
+    (as a NumPy array), which match the chunks of the array if possible, so
+    that the data is never materialized as a whole.  Partial results of each
+    region are combined as they are computed.
+
+    `op` is one of `reductions`, and `axis` an integer or a tuple of them with
+    the axes of the sliced data to reduce (all of them if `None`), as in
+    NumPy.  Return the result as a NumPy array (with no dimensions if all
+    axes are reduced).
+    """
+    if op not in reductions:
+        raise ValueError(f'Unsupported reduction {op!r}')
+    index, newshape = api_utils.normalize_slice(slice_, shape)
+    ndim = len(newshape)
+    if axis is None:
+        axes = tuple(range(ndim))
+    else:
+        axes = axis if isinstance(axis, tuple) else (axis,)
+        if not all(-ndim <= a < ndim for a in axes):
+            raise ValueError(f'Axis out of range in {axis}')
+        axes = tuple(a % ndim for a in axes)
+        if len(set(axes)) != len(axes):
+            raise ValueError(f'Repeated axis in {axis}')
+
+    if 0 in newshape:  # let NumPy handle empty data
+        data = np.empty(newshape, dtype=dtype)
+        return np.asarray(getattr(np, op)(data, axis=axes))
+
+    # Split each sliced dimension into ranges, along the chunks of the array
+    # for contiguous slices
+    ranges = []
+    sources = [(sl, c) for sl, c in zip(index, chunks)
+               if isinstance(sl, slice)]
+    for (sl, c), n in zip(sources, newshape):
+        first = (-sl.start % c) if sl.step == 1 else 0
+        starts = sorted({0, *range(first or c, n, c)})
+        ranges.append(list(zip(starts, starts[1:] + [n])))
+
+    def get_source_index(region):
+        regions = iter(region)
+        source = []
+        for sl in index:
+            if isinstance(sl, slice):
+                start, stop = next(regions)
+                stop = sl.start + stop * sl.step
+                sl = slice(sl.start + start * sl.step,
+                           stop if stop >= 0 else None, sl.step)
+            source.append(sl)
+        return tuple(source)
+
+    result = count = m2 = None
+    for region in itertools.product(*ranges):
+        data = np.asarray(getitem(get_source_index(region)))
+        target = tuple(slice(0, 1) if i in axes else slice(*r)
+                       for i, r in enumerate(region))
+        if op in {'sum', 'min', 'max'}:
+            partial = getattr(np, op)(data, axis=axes, keepdims=True)
+            if result is None:
+                result = np.empty(
+                    tuple(1 if i in axes else n
+                          for i, n in enumerate(newshape)), partial.dtype)
+                seen = np.zeros(result.shape, dtype=bool)
+            if seen[target].all():
+                combine = {'sum': np.add, 'min': np.minimum,
+                           'max': np.maximum}[op]
+                result[target] = combine(result[target], partial)
+            else:
+                result[target] = partial
+                seen[target] = True
+            continue
+
+        # Means and standard deviations are combined with the parallel
+        # algorithm by Chan et al.
+        n = math.prod(data.shape[i] for i in axes)
+        mean = np.mean(data, axis=axes, keepdims=True)
+        if result is None:
+            shape_ = tuple(1 if i in axes else n_
+                           for i, n_ in enumerate(newshape))
+            result = np.zeros(shape_, dtype=mean.dtype)
+            count = np.zeros(shape_, dtype=np.int64)
+            m2 = np.zeros(shape_, dtype=mean.dtype)
+        prev = count[target]
+        total = prev + n
+        delta = mean - result[target]
+        result[target] += delta * (n / total)
+        if op == 'std':
+            m2[target] += (np.sum(np.abs(data - mean) ** 2, axis=axes,
+                                  keepdims=True)
+                           + np.abs(delta) ** 2 * (prev * n / total))
+        count[target] = total
+
+    if op == 'std':
+        result = np.sqrt(m2 / count)
+    return np.asarray(result.squeeze(axis=axes))
+
+
+def chunked_getitem(getchunk, shape, chunks, blocks, dtype):
+    """
+    Get a function reading regions of an array from its compressed chunks.
+
+    The function is called with the index of a region (as accepted by
+    `api_utils.normalize_slice()`) and returns its data as a NumPy array.
+    Only the chunks covered by the index are got, by calling
+    ``getchunk(nchunk)``.
+    """
+    dtype = np.dtype(dtype)
+    grid = [math.ceil(n / c) for n, c in zip(shape, chunks)]
+    buffer = blosc2.uninit(chunks, dtype, chunks=chunks, blocks=blocks)
+
+    def getitem(index):
+        index, newshape = api_utils.normalize_slice(index, shape)
+        if 0 in newshape:
+            return np.empty(newshape, dtype=dtype)
+
+        # The bounding box of the index, read chunk by chunk
+        bounds = []
+        for sl in index:
+            if isinstance(sl, slice):
+                r = range(sl.start, sl.stop, sl.step)
+                bounds.append((min(r), max(r) + 1))
+            else:
+                bounds.append((sl, sl + 1))
+        data = np.empty([stop - start for start, stop in bounds], dtype=dtype)
+        coords = [range(start // c, (stop - 1) // c + 1)
+                  for (start, stop), c in zip(bounds, chunks)]
+        for coord in itertools.product(*coords):
+            nchunk = int(np.ravel_multi_index(coord, grid))
+            buffer.schunk.update_chunk(0, getchunk(nchunk))
+            chunk = buffer[()]
+            src, dst = [], []
+            for i, (start, stop), c in zip(coord, bounds, chunks):
+                lo, hi = max(start, i * c), min(stop, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - start, hi - start))
+            data[tuple(dst)] = chunk[tuple(src)]
+
+        # Apply the index to the bounding box
+        local = []
+        for sl, (start, _) in zip(index, bounds):
+            if isinstance(sl, slice):
+                stop = sl.stop - start
+                sl = slice(sl.start - start, stop if stop >= 0 else None,
+                           sl.step)
+            else:
+                sl = sl - start
+            local.append(sl)
+        return data[tuple(local)]
+
+    return getitem
+
+
+expression_functions = {
+    'abs', 'sqrt', 'exp', 'expm1', 'log', 'log10', 'log1p',
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2',
+    'sinh', 'cosh', 'tanh', 'arcsinh', 'arccosh', 'arctanh',
+    'real', 'imag', 'conj', 'where',
+}
+
+
+def check_expression(expression, names):
+    """
+    Check that `expression` is safe to be evaluated with NumExpr.
+
+    Only arithmetic, bitwise and comparison operators, numeric constants,
+    the given variable `names` and calls to `expression_functions` are
+    allowed.  Otherwise, raise `ValueError`.
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as exc:
+        raise ValueError(f'Invalid expression: {exc.msg}') from exc
+
+    allowed = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare,
+               ast.operator, ast.unaryop, ast.cmpop, ast.Load)
+    functions = {node.func for node in ast.walk(tree)
+                 if isinstance(node, ast.Call)
+                 and isinstance(node.func, ast.Name)
+                 and node.func.id in expression_functions
+                 and not node.keywords}
+    for node in ast.walk(tree):
+        if isinstance(node, allowed) or node in functions:
+            continue
+        if isinstance(node, ast.Call) and node.func in functions:
+            continue
+        if (isinstance(node, ast.Constant)
+                and isinstance(node.value, (int, float, complex))
+                and not isinstance(node.value, bool)):
+            continue
+        if isinstance(node, ast.Name) and node.id in names:
+            continue
+        raise ValueError(f'Forbidden element in expression: '
+                         f'{ast.unparse(node)}')
+
+
+def aligned_array(getchunk, shape, chunks, blocks, dtype, slice_=None):
+    """
+    Get the metadata and compressed chunks of a chunk-aligned array slice.
+
+    If `slice_` only covers whole chunks of the array, the sliced data has
+    the same chunk and block shapes as the array, and its chunks are those of
+    the array, as returned by ``getchunk(nchunk)``, with no decompression nor
+    recompression.  Otherwise, return `None`.
+
+    The metadata is like that returned by `sliced_array()`.
+    """
+    index, newshape = api_utils.normalize_slice(slice_, shape)
+    for sl, n, c in zip(index, shape, chunks):
+        if not isinstance(sl, slice) or sl.step != 1:
+            return None
+        if sl.start % c != 0 or (sl.stop % c != 0 and sl.stop != n):
+            return None
+    # Blosc2 rejects such geometries, so the slice needs recompression
+    if any(n == 1 and b > 1 for n, b in zip(newshape, blocks)):
+        return None
+
+    meta = {
+        'shape': newshape,
+        'chunks': tuple(chunks),
+        'blocks': tuple(blocks),
+        'dtype': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+    }
+    grid = [math.ceil(n / c) for n, c in zip(shape, chunks)]
+
+    def iterchunks():
+        ranges = [range(sl.start // c, math.ceil(sl.stop / c))
+                  for sl, c in zip(index, chunks)]
+        for coords in itertools.product(*ranges):
+            yield getchunk(int(np.ravel_multi_index(coords, grid)))
+
+    return meta, iterchunks()
+
+
+def sliced_schunk(getitem, nitems, typesize, chunkitems, slice_=None):
+    """
+    Get the metadata and compressed chunks of a slice of a SChunk.
+
+    `getitem` is called with each slice of items to be read (as bytes), each
+    one spanning up to `chunkitems` items.
+
+    The metadata is a dictionary with the ``nbytes``, ``chunksize`` and
+    ``typesize`` of the sliced data.
+    """
+    slice_ = slice(None) if slice_ is None else slice_
+    if isinstance(slice_, int):
+        # TODO: make SChunk support integer as slice
+        slice_ = slice(slice_, slice_ + 1)
+    items = range(*slice_.indices(nitems))
+    meta = {
+        'nbytes': len(items) * typesize,
+        'chunksize': chunkitems * typesize,
+        'typesize': typesize,
+    }
+
+    def getitems(index):
+        return np.frombuffer(getitem(index[0]), dtype=f'V{typesize}')
+
+    def iterchunks():
+        for i in range(0, len(items), chunkitems):
+            sub = items[i:i + chunkitems]
+            if sub.step == 1:
+                data = getitem(slice(sub.start, sub.stop))
+            else:
+                sl = slice(sub.start, sub.stop if sub.stop >= 0 else None,
+                           sub.step)
+                data = api_utils.strided_getitem(
+                    getitems, (sl,), (nitems,), (chunkitems,)).tobytes()
+            yield blosc2.compress2(data, typesize=typesize)
+
+    return meta, iterchunks()
+
+
+def aligned_schunk(getchunk, nitems, typesize, chunkitems, slice_=None):
+    """
+    Get the metadata and compressed chunks of a chunk-aligned SChunk slice.
+
+    Like `aligned_array()`, but for the arguments of `sliced_schunk()`.
+    """
+    slice_ = slice(None) if slice_ is None else slice_
+    if not isinstance(slice_, slice):
+        return None
+    start, stop, step = slice_.indices(nitems)
+    if step != 1 or start >= stop:
+        return None
+    if start % chunkitems != 0 or (stop % chunkitems != 0 and stop != nitems):
+        return None
+
+    meta = {
+        'nbytes': (stop - start) * typesize,
+        'chunksize': chunkitems * typesize,
+        'typesize': typesize,
+    }
+
+    def iterchunks():
+        for nchunk in range(start // chunkitems, math.ceil(stop / chunkitems)):
+            yield getchunk(nchunk)
+
+    return meta, iterchunks()
+
+
+def iter_chunk_stream(meta, chunks):
+    """
+    Yield the parts of a chunk stream with the given metadata and chunks.
+
+    A chunk stream is a framed stream (see `api_utils.iter_frames()`) whose
+    first frame (with index -1) holds the metadata as JSON, and the rest hold
+    the compressed chunks of the data (with the chunk number as index).
+    """
+    yield from api_utils.iter_frame(-1, json.dumps(meta).encode())
+    for nchunk, chunk in enumerate(chunks):
+        yield from api_utils.iter_frame(nchunk, chunk)
+
+
+def chunks_to_cframe(meta, chunks):
+    """
+    Serialize the data with the given metadata and chunks as a Blosc2 frame.
+
+    Chunks are stored in an in-memory container as they are, with no
+    decompression nor recompression.
+    """
+    return api_utils.chunks_to_b2(meta, enumerate(chunks)).to_cframe()
+
+
+def chunks_to_file(meta, chunks, urlpath):
+    """
+    Store the data with the given metadata and chunks as a Blosc2 frame file.
+
+    Like `chunks_to_cframe()`, but the frame is written to `urlpath` instead
+    of being kept in memory.
+    """
+    api_utils.chunks_to_b2(meta, enumerate(chunks), urlpath)
+
+
+#
+# Path indexes
+#
+
+class PathIndex:
+    """
+    A sorted index of (slash-separated) paths, supporting prefix queries and
+    pagination.
+    """
+
+    def __init__(self, paths=()):
+        self.paths = sorted(str(path) for path in paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths.copy())
+
+    def __contains__(self, path):
+        i = bisect.bisect_left(self.paths, path)
+        return i < len(self.paths) and self.paths[i] == path
+
+    def add(self, path):
+        path = str(path)
+        i = bisect.bisect_left(self.paths, path)
+        if i == len(self.paths) or self.paths[i] != path:
+            self.paths.insert(i, path)
+
+    def remove(self, path):
+        path = str(path)
+        i = bisect.bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            del self.paths[i]
+
+    def list(self, prefix='', limit=None, cursor=None, recursive=True):
+        """
+        Get the sorted paths starting with `prefix`.
+
+        Parameters
+        ----------
+        prefix : str
+            The prefix of paths, like a directory path ending with a slash.
+        limit : int
+            The maximum number of paths to return (no limit if `None`).
+        cursor : str
+            If given, only paths after it are returned (e.g. the last path of
+            a previous call, to get the next page).
+        recursive : bool
+            If false, paths under a directory after the prefix are replaced
+            by the directory, with a trailing slash (only once).
+
+        Returns
+        -------
+        list of str
+        """
+        start = bisect.bisect_left(self.paths, prefix)
+        if cursor is not None:
+            start = max(start, self._after(cursor))
+
+        end = len(self.paths)
+        if prefix:
+            # Paths with the prefix come before those with the next one
+            end = bisect.bisect_left(self.paths, _next_prefix(prefix))
+        if recursive:
+            stop = end if limit is None else min(end, start + limit)
+            return self.paths[start:stop]
+
+        paths = []
+        while start < end and len(paths) != limit:
+            path = self.paths[start]
+            subdir, slash, _ = path[len(prefix):].partition('/')
+            if slash:
+                path = f'{prefix}{subdir}/'
+            paths.append(path)
+            start = self._after(path)
+        return paths
+
+    def _after(self, path):
+        # Index of the first path after the given one (or its contents)
+        if path.endswith('/'):
+            return bisect.bisect_left(self.paths, _next_prefix(path))
+        return bisect.bisect_right(self.paths, path)
+
+
+def _next_prefix(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SearchIndex:
+    """
+    An index of paths to search for substrings in them.
+
+    Each path is indexed by its trigrams (substrings of length 3).  Paths
+    containing a text are looked up among those having the rarest trigram in
+    it.
+    """
+
+    def __init__(self, paths=()):
+        self.paths = []  # path id: path (None if removed)
+        self.ids = {}    # path: path id
+        self.postings = {}  # trigram: array of ids of paths containing it
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, path):
+        path = str(path)
+        if path in self.ids:
+            return
+        pid = len(self.paths)
+        self.paths.append(path)
+        self.ids[path] = pid
+        for gram in _trigrams(path):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array.array('I')
+            posting.append(pid)
+
+    def remove(self, path):
+        pid = self.ids.pop(str(path), None)
+        if pid is None:
+            return
+        self.paths[pid] = None
+        # Drop removed paths from postings when they are too many
+        if len(self.ids) < len(self.paths) // 2:
+            self.__init__(list(self.ids))
+
+    def search(self, text, limit=None):
+        """
+        Get the sorted paths containing `text`, at most `limit` of them.
+        """
+        grams = _trigrams(text)
+        if grams:
+            postings = [self.postings.get(gram, ()) for gram in grams]
+            candidates = (self.paths[pid] for pid in min(postings, key=len))
+        else:
+            candidates = iter(self.paths)
+        found = sorted(path for path in candidates
+                       if path is not None and text in path)
+        return found[:limit]
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
 
-def iterchunk(chunk):
-    # TODO Yield block by block
-    yield chunk
+#
+# Cache management
+#
+
+class CacheManager:
+    """
+    Keep the chunks stored in a cache directory within a size budget.
+
+    The budget (in compressed bytes) may be given for the whole cache and per
+    root (the first component of paths under `cachedir`).  When it is
+    exceeded, chunks are evicted in least recently used order, by resetting
+    them to uninitialized special values (so that
+    `api_utils.chunk_is_available()` reports them as missing).  The space of
+    evicted chunks in a dataset file is only reclaimed by compacting the
+    dataset once it exceeds the `compact_ratio` of the file size.
+
+    The chunks of datasets in use (see `acquire()`) or whose path under
+    `cachedir` matches any of the `pinned` glob patterns are never evicted.
+    """
+
+    def __init__(self, cachedir, budget=None, root_budgets=None, pinned=(),
+                 compact_ratio=0.5):
+        self.cachedir = cachedir
+        self.tmppath = cachedir.with_name(f'{cachedir.name}.tmp')
+        self.budget = budget
+        self.root_budgets = root_budgets or {}
+        self.pinned = list(pinned)
+        self.compact_ratio = compact_ratio
+        self.chunks = collections.OrderedDict()  # (abspath, nchunk): nbytes
+        self.files = collections.defaultdict(set)  # abspath: {nchunk}
+        self.nbytes = 0
+        self.root_nbytes = collections.Counter()
+        self.inuse = collections.Counter()  # abspath: number of users
+        self.dead = collections.Counter()  # abspath: bytes of evicted chunks
+
+    def _root(self, abspath):
+        return abspath.relative_to(self.cachedir).parts[0]
+
+    def scan(self):
+        """
+        Register the chunks already in the cache.
+
+        Since their access times are unknown, chunks of datasets modified
+        earlier are considered less recently used.
+        """
+        paths = [path for path, _ in utils.walk_files(self.cachedir)]
+        paths.sort(key=lambda path: path.stat().st_mtime)
+        for abspath in paths:
+            try:
+                _, schunk = open_b2(abspath)
+            except (NotImplementedError, RuntimeError, ValueError):
+                continue
+            if schunk is None:  # lazy expression
+                continue
+            for nchunk in range(schunk.nchunks):
+                if api_utils.chunk_is_available(schunk, nchunk):
+                    self.add(abspath, nchunk, chunk_cbytes(schunk, nchunk))
+
+    def add(self, abspath, nchunk, nbytes):
+        """Register a chunk just stored in the cache."""
+        oldbytes = self.chunks.pop((abspath, nchunk), 0)
+        self.chunks[(abspath, nchunk)] = nbytes
+        self.files[abspath].add(nchunk)
+        self.nbytes += nbytes - oldbytes
+        self.root_nbytes[self._root(abspath)] += nbytes - oldbytes
+
+    def _remove(self, abspath, nchunk):
+        nbytes = self.chunks.pop((abspath, nchunk))
+        self.files[abspath].discard(nchunk)
+        if not self.files[abspath]:
+            del self.files[abspath]
+        self.nbytes -= nbytes
+        self.root_nbytes[self._root(abspath)] -= nbytes
+
+    def touch(self, abspath, nchunks):
+        """Mark the given chunks of a dataset as recently used."""
+        for nchunk in nchunks:
+            key = (abspath, int(nchunk))
+            if key in self.chunks:
+                self.chunks.move_to_end(key)
+
+    def forget(self, abspath):
+        """Forget the chunks of a dataset which was removed or reset."""
+        for nchunk in list(self.files.get(abspath, ())):
+            self._remove(abspath, nchunk)
+        self.dead.pop(abspath, None)
+
+    def acquire(self, abspaths):
+        """
+        Mark the given datasets as in use, so that they are not evicted.
+
+        Return a function to release them, which may be called many times.
+        """
+        abspaths = list(abspaths)
+        for abspath in abspaths:
+            self.inuse[abspath] += 1
+
+        def release():
+            while abspaths:
+                abspath = abspaths.pop()
+                self.inuse[abspath] -= 1
+                if self.inuse[abspath] <= 0:
+                    del self.inuse[abspath]
+
+        return release
+
+    def is_pinned(self, abspath):
+        if self.inuse.get(abspath):
+            return True
+        relpath = abspath.relative_to(self.cachedir).as_posix()
+        return any(fnmatch.fnmatch(relpath, pattern)
+                   for pattern in self.pinned)
+
+    def _over_budget(self, root=None):
+        if root is None:
+            return self.budget is not None and self.nbytes > self.budget
+        budget = self.root_budgets.get(root)
+        return budget is not None and self.root_nbytes[root] > budget
+
+    def evict(self):
+        """
+        Evict least recently used chunks until the cache is within budget.
+
+        Return a dictionary mapping the path of each affected dataset to the
+        set of its evicted chunks.  The caller must then remove the chunks
+        from the datasets with `reclaim()`, in any order and maybe from other
+        threads.
+        """
+        evicted = collections.defaultdict(set)
+        over_roots = {root for root in self.root_budgets
+                      if self._over_budget(root)}
+        if not self._over_budget() and not over_roots:
+            return evicted
+
+        for (abspath, nchunk) in list(self.chunks):
+            root = self._root(abspath)
+            if not self._over_budget() and root not in over_roots:
+                if not over_roots:
+                    break
+                continue
+            if self.is_pinned(abspath):
+                continue
+            self.dead[abspath] += self.chunks[(abspath, nchunk)]
+            self._remove(abspath, nchunk)
+            evicted[abspath].add(nchunk)
+            if not self._over_budget(root):
+                over_roots.discard(root)
+
+        return evicted
+
+    def reclaim(self, abspath, nchunks):
+        """
+        Remove evicted chunks from a dataset.
+
+        The chunks are reset in place, and the dataset is only compacted
+        (which rewrites its whole file) if the space taken by evicted chunks
+        exceeds the `compact_ratio` of the file size.
+
+        Return whether the dataset was compacted.
+        """
+        reset_chunks(abspath, nchunks)
+        if self.dead[abspath] <= self.compact_ratio * abspath.stat().st_size:
+            return False
+        self.compact(abspath)
+        return True
+
+    def compact(self, abspath, nchunks=()):
+        """Compact a dataset, leaving its evicted chunks out."""
+        # Use a different temporary file per thread
+        tmppath = self.tmppath.with_name(
+            f'{self.tmppath.name}.{threading.get_ident()}')
+        compact_b2(abspath, tmppath, nchunks)
+        self.dead.pop(abspath, None)
 
 
 #
@@ -317,3 +1243,163 @@ class Database:
 
     def __getattr__(self, name):
         return getattr(self.data, name)
+
+
+class _TrackedDict(collections.abc.MutableMapping):
+    """
+    A dictionary which remembers the keys changed since the last save.
+
+    If `track_reads` is true, keys whose values are read are also remembered,
+    as values may be changed in place.
+    """
+
+    def __init__(self, data, track_reads=False):
+        self.data = data
+        self.dirty = set()
+        self.track_reads = track_reads
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        if self.track_reads:
+            self.dirty.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return repr(self.data)
+
+    def copy(self):
+        return dict(self.items())
+
+
+class SQLiteDatabase:
+    """
+    Like `Database`, but stored in SQLite (in WAL mode).
+
+    Every field of the model must be a dictionary.  Each entry is kept in a
+    separate row, so that saving only writes the entries changed since the
+    last save (in a single transaction).
+    """
+
+    def __init__(self, path, initial):
+        self.path = path
+        self.model = initial.__class__
+        self.adapters = {}
+        self.track_reads = {}  # values may be changed in place
+        for name, field in self.model.model_fields.items():
+            _, vtype = typing.get_args(field.annotation)
+            self.adapters[name] = pydantic.TypeAdapter(vtype)
+            self.track_reads[name] = vtype not in {str, int, float, bool}
+
+        exists = path.exists()
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                          'field TEXT, key TEXT, value TEXT, '
+                          'PRIMARY KEY (field, key))')
+        if exists:
+            self.load()
+        else:
+            self.set_data(initial)
+            self.save()
+
+    def set_data(self, data):
+        self.dicts = {}
+        for name in self.adapters:
+            tracked = _TrackedDict(dict(getattr(data, name)),
+                                   self.track_reads[name])
+            tracked.dirty.update(tracked.data)
+            self.dicts[name] = tracked
+
+    def load(self):
+        data = {name: {} for name in self.adapters}
+        with self.lock:
+            rows = self.conn.execute('SELECT field, key, value FROM state')
+            for name, key, value in rows:
+                if name in data:
+                    data[name][key] = value
+        for name, adapter in self.adapters.items():
+            data[name] = {key: adapter.validate_json(value)
+                          for key, value in data[name].items()}
+        self.dicts = {name: _TrackedDict(values, self.track_reads[name])
+                      for name, values in data.items()}
+
+    def save(self):
+        with self.lock, self.conn:
+            for name, tracked in self.dicts.items():
+                adapter = self.adapters[name]
+                dirty, tracked.dirty = tracked.dirty, set()
+                upserts = [
+                    (name, key, adapter.dump_json(tracked.data[key],
+                                                  exclude_none=True).decode())
+                    for key in dirty if key in tracked.data]
+                deletes = [(name, key) for key in dirty
+                           if key not in tracked.data]
+                self.conn.executemany(
+                    'INSERT INTO state VALUES (?, ?, ?) '
+                    'ON CONFLICT (field, key) DO UPDATE SET value=excluded.value',
+                    upserts)
+                self.conn.executemany(
+                    'DELETE FROM state WHERE field = ? AND key = ?', deletes)
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def data(self):
+        return self.model(**{name: dict(tracked.data)
+                             for name, tracked in self.dicts.items()})
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['dicts'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def open_database(statedir, initial, backend='json'):
+    """
+    Open the database of a service in its state directory.
+
+    Parameters
+    ----------
+    statedir : pathlib.Path
+        The state directory of the service.
+    initial : pydantic.BaseModel
+        The initial contents of the database, if it does not exist.
+    backend : str
+        Either ``json`` (`Database`) or ``sqlite`` (`SQLiteDatabase`).  An
+        existing JSON database is imported into a new SQLite one.
+
+    Returns
+    -------
+    Database or SQLiteDatabase
+    """
+    jsonpath = statedir / 'db.json'
+    if backend == 'json':
+        return Database(jsonpath, initial)
+    if backend == 'sqlite':
+        path = statedir / 'db.sqlite'
+        if not path.exists() and jsonpath.exists():
+            initial = Database(jsonpath, initial).data
+        return SQLiteDatabase(path, initial)
+    raise ValueError(f'unknown database backend: {backend!r}')
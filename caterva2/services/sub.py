@@ -8,18 +8,29 @@
 ###############################################################################
 
 import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import hashlib
 import itertools
+import json
 import logging
+import math
 import os
 import pathlib
+import shutil
 import string
+import tempfile
+import threading
+import time
 import typing
+import weakref
 from collections.abc import Awaitable, Callable
 
 # FastAPI
 from fastapi import Depends, FastAPI, Form, Request, UploadFile, responses
-from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, RedirectResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import fastapi
@@ -33,6 +44,13 @@ import numexpr as ne
 import numpy as np
 import uvicorn
 
+# Optional requirements
+try:
+    import h2  # noqa: F401
+    http2_is_here = True
+except ImportError:
+    http2_is_here = False
+
 # Project
 from caterva2 import utils, api_utils, models
 from caterva2.services import srv_utils
@@ -46,14 +64,56 @@ logger = logging.getLogger('sub')
 
 # Configuration
 broker = None
+download_concurrency = 32
+dataset_download_concurrency = 8
+download_batch_size = 64
+http_max_connections = 100
+http_max_keepalive_connections = 32
+http_timeout = 5
+follow_concurrency = 4
+follow_batch_size = 1000
+prefetch_chunks = 0
+prefetch_roots = {}  # root name: chunks to prefetch (overrides the above)
+prefetch_budget = 256 * 2**20
+prefetch_concurrency = 2
+cache_budget = None
+cache_root_budgets = {}  # root name: cache budget for the root
+cache_pinned = []  # glob patterns of paths never evicted from cache
+cache_compact_ratio = 0.5  # evicted fraction of a file before compacting it
+worker_threads = None  # use the default of ThreadPoolExecutor
+cache_expr_results = True
+pushdown = True  # compute reductions of uncached data in publishers
+pushdown_timeout = 60
 
 # State
 statedir = None
 cache = None
 scratch = None
+results = None  # directory of lazy expression results
+tmpdir = None  # directory of temporary files
 clients = {}       # topic: <PubSubClient>
 database = None    # <Database> instance
-locks = {}
+cache_manager = None  # <CacheManager> instance
+inflight = {}      # (path, nchunk): <asyncio.Future> of chunk being downloaded
+download_tasks = set()
+download_semaphore = None  # <asyncio.Semaphore> limiting all chunk downloads
+dataset_semaphores = weakref.WeakValueDictionary()  # path: <asyncio.Semaphore>
+httpclients = {}   # host: <httpx.AsyncClient>
+scans = collections.OrderedDict()  # (path, client): (index, shift)
+max_scans = 1024
+prefetch_nbytes = 0  # estimated bytes of chunks being prefetched
+prefetch_semaphore = None  # <asyncio.Semaphore> limiting chunk prefetches
+executor = None    # <ThreadPoolExecutor> running blocking operations
+path_locks = [threading.Lock() for _ in range(64)]  # see `locked()`
+blocking_stats = {'calls': 0, 'queued': 0.0, 'max_queued': 0.0}
+expr_stats = {'computed': 0, 'reused': 0}
+reduce_stats = {'pushed': 0, 'local': 0}
+metadata_cache = {}  # path: (publisher etag, JSON body, etag of body)
+metadata_epoch = 0   # increased on every invalidation of the above
+follow_tasks = {}  # root name: <asyncio.Task> bringing its datasets up to date
+follow_status = {}  # root name: progress of the above (see `follow()`)
+indexes = {}       # root name: <PathIndex> of its datasets (see `get_index()`)
+search_indexes = {}  # root name: <SearchIndex> of its datasets
 urlbase = None
 
 
@@ -67,19 +127,297 @@ def make_url(request, name, query=None, **path_params):
     return url
 
 
-async def download_chunk(path, schunk, nchunk):
+def http_client_args():
+    limits = httpx.Limits(
+        max_connections=http_max_connections,
+        max_keepalive_connections=http_max_keepalive_connections,
+    )
+    return dict(limits=limits, timeout=http_timeout, http2=http2_is_here)
+
+
+def get_http_client(host):
+    """
+    Get the pooled HTTP client used to talk to the publisher at `host`.
+
+    The client is created on first use and kept alive (along with its
+    connections) until the subscriber shuts down.
+    """
+    client = httpclients.get(host)
+    if client is None:
+        client = httpx.AsyncClient(**http_client_args())
+        httpclients[host] = client
+
+    return client
+
+
+async def close_http_clients():
+    clients = list(httpclients.values())
+    httpclients.clear()
+    await asyncio.gather(*[client.aclose() for client in clients])
+
+
+async def blocking(func, *args, **kwargs):
+    """
+    Run ``func(*args, **kwargs)`` in a worker thread and return its result.
+
+    CPU and disk bound operations (like opening, reading or writing Blosc2
+    datasets) must run this way, so that they do not block the event loop.
+    Since Blosc2 releases the GIL while working, they also run in parallel.
+
+    The number of workers is limited, and the time that operations wait for a
+    free worker is accounted in `blocking_stats`.
+    """
+    def run():
+        return time.perf_counter(), func(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    queued = time.perf_counter()
+    started, result = await loop.run_in_executor(executor, run)
+
+    queued = started - queued
+    blocking_stats['calls'] += 1
+    blocking_stats['queued'] += queued
+    blocking_stats['max_queued'] = max(blocking_stats['max_queued'], queued)
+    return result
+
+
+@contextlib.contextmanager
+def locked(abspaths):
+    """
+    Lock the datasets at the given paths for exclusive use by this thread.
+
+    Blosc2 handles to a dataset become invalid when it is written through
+    other handles, so datasets must be opened anew and used while locked.
+    There is a fixed set of locks, shared by paths with the same hash, which
+    are taken in order to avoid deadlocks.  Thus, do not nest calls.
+    """
+    stripes = sorted({hash(str(path)) % len(path_locks) for path in abspaths})
+    with contextlib.ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(path_locks[stripe])
+        yield
+
+
+@contextlib.contextmanager
+def open_locked(abspath):
+    """
+    Open the dataset at `abspath` and keep it locked while in use.
+
+    If it is a lazy expression, the datasets of its operands are locked too.
+    """
+    with locked([abspath]):
+        array, schunk = srv_utils.open_b2(abspath)
+        if schunk is not None:  # not lazy expr
+            yield array, schunk
+            return
+        abspaths = [abspath] + [pathlib.Path(op.schunk.urlpath)
+                                for op in array.operands.values()]
+
+    with locked(abspaths):
+        yield srv_utils.open_b2(abspath)
+
+
+def read_metadata_locked(abspath, **kwargs):
+    with locked([abspath]):
+        return srv_utils.read_metadata(abspath, **kwargs)
+
+
+def write_chunk(abspath, nchunk, chunk):
+    with locked([abspath]):
+        _, schunk = srv_utils.open_b2(abspath)
+        schunk.update_chunk(nchunk, chunk)
+
+
+async def store_chunk(path, abspath, nchunk, chunk):
+    """
+    Store a downloaded chunk in cache and wake up those waiting for it.
+    """
+    await blocking(write_chunk, abspath, nchunk, chunk)
+    cache_manager.add(abspath, nchunk, len(chunk))
+    release_chunk(path, nchunk)
+
+
+async def evict_chunks():
+    """
+    Evict chunks from the cache if it exceeds its budget.
+
+    Evicted chunks are reset in place, and datasets are only rewritten to
+    reclaim their space once it is large enough (see `CacheManager`).
+    """
+    def reclaim(abspath, nchunks):
+        with locked([abspath]):
+            cache_manager.reclaim(abspath, nchunks)
+
+    evicted = cache_manager.evict()
+    await asyncio.gather(*[blocking(reclaim, abspath, nchunks)
+                           for abspath, nchunks in evicted.items()])
+
+
+def release_chunk(path, nchunk, exc=None):
+    future = inflight.pop((path, nchunk), None)
+    if future is None or future.done():
+        return
+
+    if exc is None:
+        future.set_result(None)
+    elif isinstance(exc, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(exc)
+
+
+async def download_chunk(path, abspath, nchunk):
     root, name = path.split('/', 1)
     host = database.roots[root].http
     url = f'http://{host}/api/download/{name}'
     params = {'nchunk': nchunk}
 
-    client = httpx.AsyncClient()
-    async with client.stream('GET', url, params=params, timeout=5) as resp:
+    client = get_http_client(host)
+    async with client.stream('GET', url, params=params) as resp:
+        resp.raise_for_status()
         buffer = []
         async for chunk in resp.aiter_bytes():
             buffer.append(chunk)
         chunk = b''.join(buffer)
-        schunk.update_chunk(nchunk, chunk)
+        await store_chunk(path, abspath, nchunk, chunk)
+
+
+async def download_chunks(path, abspath, nchunks):
+    """
+    Download several chunks of a dataset in a single request.
+
+    Each chunk is stored in cache as soon as it arrives.
+    """
+    root, name = path.split('/', 1)
+    host = database.roots[root].http
+    url = f'http://{host}/api/download-chunks/{name}'
+    params = {'nchunks': api_utils.chunks_to_string(nchunks)}
+
+    pending = set(nchunks)
+    client = get_http_client(host)
+    async with client.stream('GET', url, params=params) as resp:
+        resp.raise_for_status()
+        async for nchunk, chunk in api_utils.aiter_frames(resp.aiter_bytes()):
+            await store_chunk(path, abspath, nchunk, chunk)
+            pending.discard(nchunk)
+
+    if pending:
+        raise RuntimeError(f'Chunks {sorted(pending)} of {path} '
+                           f'were not received from publisher')
+
+
+async def download_batch(path, abspath, nchunks, prefetch=False):
+    """
+    Download the given chunks of a dataset, which must be in `inflight`.
+
+    When finished, all the chunks have been released, either because they
+    were stored or because of an error (which is passed to their waiters).
+
+    Prefetches have low priority: they do not take the download slots of
+    requested chunks, but only a few slots of their own (see
+    `prefetch_concurrency`), so that requested chunks need not wait for them.
+    """
+    semaphore = dataset_semaphores.get(path)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(dataset_download_concurrency)
+        dataset_semaphores[path] = semaphore
+
+    error = None
+    try:
+        async with (prefetch_semaphore if prefetch else semaphore):
+            async with (contextlib.nullcontext() if prefetch
+                        else download_semaphore):
+                # The publisher may close an idle connection just when it is
+                # being reused, so try again (once) in that case.
+                for retry in (True, False):
+                    try:
+                        if len(nchunks) == 1:
+                            await download_chunk(path, abspath, nchunks[0])
+                        else:
+                            await download_chunks(path, abspath, nchunks)
+                        break
+                    except httpx.RemoteProtocolError:
+                        if not retry:
+                            raise
+    except Exception as exc:
+        error = exc
+    finally:
+        # Chunks not stored yet get the error (or the cancellation)
+        for nchunk in nchunks:
+            release_chunk(path, nchunk, error or asyncio.CancelledError())
+
+
+async def prefetch_batch(path, abspath, nchunks, nbytes):
+    global prefetch_nbytes
+    try:
+        await download_batch(path, abspath, nchunks, prefetch=True)
+    finally:
+        prefetch_nbytes -= nbytes
+
+
+async def prefetch(path, abspath, slice_, client, shape, chunks, chunksize):
+    """
+    Start downloading the chunks to be read next if `client` scans a dataset.
+
+    A scan is detected when the last slices of the dataset fetched by the
+    client are shifted by the same amount along the same axis (like when
+    iterating over the frames of a stack, or over every other row).  Then,
+    the missing chunks covered by the next slices are downloaded in the
+    background, with low priority.  Nothing is prefetched while all download
+    slots for requested chunks are taken.
+
+    The number of chunks to prefetch is configured globally or per root, and
+    the total size of the chunks being prefetched is limited.  The `shape`,
+    `chunks` and `chunksize` (in bytes) of the dataset are needed.
+    """
+    maxchunks = prefetch_roots.get(path.split('/', 1)[0], prefetch_chunks)
+    if not maxchunks or not slice_ or download_semaphore.locked():
+        return
+
+    index, _ = api_utils.normalize_slice(slice_, shape)
+
+    key = (path, client)
+    previous, prevshift = scans.pop(key, (None, None))
+    shift = srv_utils.slice_shift(previous, index)
+    scans[key] = (index, shift)
+    if len(scans) > max_scans:
+        scans.popitem(last=False)
+    if shift is None or shift != prevshift:
+        return
+
+    def get_missing(nchunks):
+        with locked([abspath]):
+            _, schunk = srv_utils.open_b2(abspath)
+            return [n for n in nchunks
+                    if not api_utils.chunk_is_available(schunk, n)]
+
+    nchunks = srv_utils.scan_chunks(index, *shift, shape, chunks, maxchunks)
+    nchunks = [n for n in nchunks if (path, n) not in inflight]
+    missing = await blocking(get_missing, nchunks)
+    missing = [n for n in missing if (path, n) not in inflight]
+    # The size of compressed chunks is not known in advance
+    global prefetch_nbytes
+    allowed = (prefetch_budget - prefetch_nbytes) // chunksize
+    missing = missing[:max(allowed, 0)]
+    if not missing:
+        return
+
+    logger.debug(f'Prefetching {len(missing)} chunks of {path}')
+    loop = asyncio.get_running_loop()
+    for n in missing:
+        future = loop.create_future()
+        # Nobody may wait for the chunk, so ignore download errors
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        inflight[(path, n)] = future
+
+    for i in range(0, len(missing), download_batch_size):
+        batch = missing[i:i + download_batch_size]
+        nbytes = len(batch) * chunksize
+        prefetch_nbytes += nbytes
+        task = asyncio.create_task(prefetch_batch(path, abspath, batch,
+                                                  nbytes))
+        download_tasks.add(task)
+        task.add_done_callback(download_tasks.discard)
 
 
 async def new_root(data, topic):
@@ -96,20 +434,189 @@ async def updated_dataset(data, topic):
     rootdir = cache / name
     abspath = rootdir / relpath
     metadata = data.get('metadata')
-    if metadata is None:
-        if abspath.suffix not in {'.b2nd', '.b2frame'}:
-            abspath = pathlib.Path(f'{abspath}.b2')
-        if abspath.is_file():
-            abspath.unlink()
+    if abspath.suffix not in {'.b2nd', '.b2frame'}:
+        cachepath = pathlib.Path(f'{abspath}.b2')
     else:
-        srv_utils.init_b2(abspath, metadata)
+        cachepath = abspath
+    cache_manager.forget(cachepath)
+
+    def update():
+        with locked([cachepath]):
+            if metadata is None:
+                if cachepath.is_file():
+                    cachepath.unlink()
+            else:
+                srv_utils.init_b2(abspath, metadata)
+
+    await blocking(update)
+
+    # Save etag (the publisher may not send it)
+    key = f'{name}/{relpath}'
+    etag = data.get('etag')
+    if etag is None:
+        database.etags.pop(key, None)
+    else:
+        database.etags[key] = etag
+    database.save()
+    forget_metadata(key)
+    await index_dataset(name, relpath, exists=metadata is not None)
+
+
+def walk_datasets(rootdir):
+    return [
+        relpath.with_suffix('') if relpath.suffix == '.b2' else relpath
+        for path, relpath in utils.walk_files(rootdir)
+    ]
+
+
+async def get_index(name):
+    """
+    Get the index of the datasets of a root in the cache.
+
+    The index is built from the cache on first use, then kept current as
+    datasets are added, updated or removed.
+    """
+    index = indexes.get(name)
+    if index is None:
+        paths = await blocking(walk_datasets, cache / name)
+        index = indexes.setdefault(name, srv_utils.PathIndex(paths))
+
+    return index
+
+
+async def get_search_index(name):
+    """
+    Get the index to search for datasets in a root by their paths.
+
+    Like `get_index()`, it is built on first use and kept current.
+    """
+    index = search_indexes.get(name)
+    if index is None:
+        paths = list(await get_index(name))
+        index = await blocking(srv_utils.SearchIndex, paths)
+        index = search_indexes.setdefault(name, index)
+
+    return index
+
+
+async def index_dataset(name, relpath, exists=True):
+    """
+    Add a dataset of a root to its indexes, or remove it if not `exists`.
+    """
+    for index in [await get_index(name), search_indexes.get(name)]:
+        if index is None:  # search index not built yet
+            continue
+        if exists:
+            index.add(relpath)
+        else:
+            index.remove(relpath)
+
+
+def forget_metadata(path):
+    """
+    Drop the cached metadata of the dataset at `path` (with its root name).
+    """
+    global metadata_epoch
+    metadata_epoch += 1
+    metadata_cache.pop(path, None)
 
 
 #
 # Internal API
 #
 
-def follow(name: str):
+def init_dataset(abspath, cachepath, metadata):
+    with locked([cachepath]):
+        srv_utils.init_b2(abspath, metadata)
+
+
+async def follow_batch(client, name, host, etags, status):
+    """
+    Initialize the datasets in a batch whose etag changed.
+
+    `etags` maps the paths of datasets in the root to their known etags.
+    Datasets are ready to be queried as soon as each one is initialized.
+    """
+    rootdir = cache / name
+    async with client.stream('POST', f'http://{host}/api/info',
+                             json=etags) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            info = json.loads(line)
+            relpath = info['path']
+
+            # Save metadata
+            abspath = rootdir / relpath
+            if abspath.suffix not in {'.b2nd', '.b2frame'}:
+                cachepath = pathlib.Path(f'{abspath}.b2')
+            else:
+                cachepath = abspath
+            cache_manager.forget(cachepath)
+            await blocking(init_dataset, abspath, cachepath, info['metadata'])
+
+            # Save etag
+            key = f'{name}/{relpath}'
+            database.etags[key] = info['etag']
+            forget_metadata(key)
+            await index_dataset(name, relpath)
+            status['updated'] += 1
+
+    database.save()
+    status['done'] += len(etags)
+
+
+async def resync(name, host, status):
+    """
+    Bring the datasets of a root in the cache up to date with its publisher.
+
+    Progress is reported in the `status` dictionary.
+    """
+    try:
+        # Get list of datasets
+        client = get_http_client(host)
+        response = await client.get(f'http://{host}/api/list')
+        response.raise_for_status()
+        data = response.json()
+
+        # Initialize the datasets in the cache, getting the metadata of those
+        # which changed in batches (several at the same time)
+        etags = {relpath: database.etags.get(f'{name}/{relpath}')
+                 for relpath in data}
+        status.update(state='running', total=len(etags))
+        semaphore = asyncio.Semaphore(follow_concurrency)
+
+        async def run_batch(batch):
+            async with semaphore:
+                await follow_batch(client, name, host, batch, status)
+
+        await asyncio.gather(*[
+            run_batch(dict(itertools.islice(etags.items(),
+                                            i, i + follow_batch_size)))
+            for i in range(0, len(etags), follow_batch_size)
+        ])
+    except Exception as exc:
+        logger.warning(f'Failed to follow {name}: {exc!r}')
+        status.update(state='failed', error=str(exc) or repr(exc))
+        return
+
+    # Subscribe to changes in the dataset
+    if name not in clients:
+        client = srv_utils.start_client(f'ws://{broker}/pubsub')
+        client.subscribe(name, updated_dataset)
+        clients[name] = client
+
+    status['state'] = 'done'
+
+
+async def follow(name: str, wait: bool = True):
+    """
+    Subscribe to a root and bring its datasets up to date in the background.
+
+    If `wait` is true, return when done.  Progress is available in
+    `follow_status`.
+    """
     root = database.roots.get(name)
     if root is None:
         errors = {name: 'This dataset does not exist in the network'}
@@ -123,41 +630,19 @@ def follow(name: str):
     rootdir = cache / name
     if not rootdir.exists():
         rootdir.mkdir(exist_ok=True)
+    await get_index(name)
 
-    # Get list of datasets
-    try:
-        data = api_utils.get(f'http://{root.http}/api/list')
-    except httpx.ConnectError:
-        return
-
-    # Initialize the datasets in the cache
-    for relpath in data:
-        # If-None-Match header
-        key = f'{name}/{relpath}'
-        val = database.etags.get(key)
-        headers = None if val is None else {'If-None-Match': val}
-
-        # Call API
-        response = httpx.get(f'http://{root.http}/api/info/{relpath}', headers=headers)
-        if response.status_code == 304:
-            continue
-
-        response.raise_for_status()
-        metadata = response.json()
-
-        # Save metadata
-        abspath = rootdir / relpath
-        srv_utils.init_b2(abspath, metadata)
-
-        # Save etag
-        database.etags[key] = response.headers['etag']
-        database.save()
+    task = follow_tasks.get(name)
+    if task is None or task.done():
+        status = {'state': 'pending', 'total': None, 'done': 0,
+                  'updated': 0, 'error': None}
+        follow_status[name] = status
+        task = asyncio.create_task(resync(name, root.http, status))
+        follow_tasks[name] = task
 
-    # Subscribe to changes in the dataset
-    if name not in clients:
-        client = srv_utils.start_client(f'ws://{broker}/pubsub')
-        client.subscribe(name, updated_dataset)
-        clients[name] = client
+    if wait:
+        # Do not cancel resync if the caller is cancelled
+        await asyncio.shield(task)
 
 
 #
@@ -195,6 +680,16 @@ async def lifespan(app: FastAPI):
     if user_auth_enabled():
         await db.create_db_and_tables(statedir)
 
+    # Limit the number of chunks being downloaded at the same time
+    global download_semaphore, prefetch_semaphore
+    download_semaphore = asyncio.Semaphore(download_concurrency)
+    prefetch_semaphore = asyncio.Semaphore(prefetch_concurrency)
+
+    # Run blocking operations in worker threads
+    global executor
+    executor = concurrent.futures.ThreadPoolExecutor(
+        worker_threads, thread_name_prefix='sub-worker')
+
     # Initialize roots from the broker
     try:
         data = api_utils.get(f'http://{broker}/api/roots')
@@ -227,13 +722,23 @@ async def lifespan(app: FastAPI):
         client = srv_utils.start_client(f'ws://{broker}/pubsub')
         client.subscribe('@new', new_root)
 
-        # Resume following
+        # Resume following (in the background)
         for path in cache.iterdir():
             if path.is_dir():
-                follow(path.name)
+                await follow(path.name, wait=False)
 
     yield
 
+    # Stop following roots
+    for task in follow_tasks.values():
+        task.cancel()
+    await asyncio.gather(*follow_tasks.values(), return_exceptions=True)
+
+    # Close connections to publishers
+    await close_http_clients()
+
+    executor.shutdown(wait=False, cancel_futures=True)
+
     # Disconnect from worker
     if client is not None:
         await srv_utils.disconnect_client(client)
@@ -284,6 +789,7 @@ def get_root(name):
 @app.post('/api/subscribe/{name}')
 async def post_subscribe(
     name: str,
+    wait: bool = True,
     user: db.User = Depends(current_active_user),
 ):
     """
@@ -293,21 +799,87 @@ async def post_subscribe(
     ----------
     name : str
         The name of the root.
+    wait : bool
+        Whether to wait until the datasets in the root are up to date.
+        Otherwise, datasets become available as they are brought up to date,
+        see `get_subscribe_status()`.
 
     Returns
     -------
     str
-        'Ok' if successful.
+        'Ok' if successful.  If waiting and the datasets could not be brought
+        up to date, a 502 error is returned instead.
     """
     if name != '@scratch' or not user:
         get_root(name)  # Not Found
-        follow(name)
+        await follow(name, wait=wait)
+        status = follow_status.get(name)
+        if wait and status is not None and status['state'] == 'failed':
+            raise fastapi.HTTPException(
+                status_code=502,
+                detail=f'Failed to follow root {name}: {status["error"]}')
     return 'Ok'
 
 
+@app.get('/api/subscribe/{name}/status')
+async def get_subscribe_status(
+    name: str,
+    user: db.User = Depends(current_active_user),
+):
+    """
+    Get the progress of bringing the datasets in a root up to date.
+
+    Parameters
+    ----------
+    name : str
+        The name of the root.
+
+    Returns
+    -------
+    dict
+        The ``state`` (``pending``, ``running``, ``done`` or ``failed``), the
+        ``total`` number of datasets in the root, those checked so far
+        (``done``) and those which needed an update (``updated``), and the
+        ``error`` if failed.
+    """
+    get_root(name)  # Not Found
+    status = follow_status.get(name)
+    if status is None:
+        srv_utils.raise_not_found(f'Not subscribed to {name}')
+
+    return status
+
+
+@app.get('/api/stats')
+async def get_stats():
+    """
+    Get statistics about the operation of the subscriber.
+
+    Returns
+    -------
+    dict
+        The statistics about:
+
+        - ``blocking`` operations (like reading or writing datasets), which
+          run in a limited number of worker threads: the number of ``calls``,
+          and the total and maximum time in seconds that they waited for a
+          free worker (``queued`` and ``max_queued``).
+        - ``expr_results``: the number of chunks of lazy expression results
+          which were ``computed``, or ``reused`` from previous computations.
+        - ``reductions``: the number of reductions ``pushed`` down to
+          publishers, or computed here (``local``).
+    """
+    return {'blocking': blocking_stats, 'expr_results': expr_stats,
+            'reductions': reduce_stats}
+
+
 @app.get('/api/list/{name}')
 async def get_list(
     name: str,
+    prefix: str = '',
+    limit: int = None,
+    cursor: str = None,
+    recursive: bool = True,
     user: db.User = Depends(current_active_user),
 ):
     """
@@ -317,32 +889,112 @@ async def get_list(
     ----------
     name : str
         The name of the root.
+    prefix : str
+        Only list datasets whose path starts with this (e.g. ``dir1/``).
+    limit : int
+        The maximum number of datasets to list.
+    cursor : str
+        Only list datasets after this path.  To get the next page of results,
+        use the last path in the previous one.
+    recursive : bool
+        If false, only list the datasets and directories (with a trailing
+        slash) right under the prefix.
 
     Returns
     -------
     list
-        The list of datasets in the root.
+        The sorted list of datasets in the root.
     """
     if user and name == '@scratch':
         rootdir = scratch / str(user.id)
+        if not rootdir.exists():
+            return []
+        paths = await blocking(walk_datasets, rootdir)
+        index = srv_utils.PathIndex(paths)
     else:
         root = get_root(name)
-        rootdir = cache / root.name
+        if not (cache / root.name).exists():
+            srv_utils.raise_not_found(f'Not subscribed to {name}')
+        index = await get_index(root.name)
 
-    if not rootdir.exists():
-        if name == '@scratch':
-            return []
-        srv_utils.raise_not_found(f'Not subscribed to {name}')
+    return index.list(prefix, limit, cursor, recursive)
 
-    return [
-        relpath.with_suffix('') if relpath.suffix == '.b2' else relpath
-        for path, relpath in utils.walk_files(rootdir)
-    ]
+
+@app.get('/api/search')
+async def get_search(
+    text: str,
+    roots: list[str] = fastapi.Query([]),
+    limit: int = 100,
+    user: db.User = Depends(current_active_user),
+):
+    """
+    Search for datasets by their paths.
+
+    Parameters
+    ----------
+    text : str
+        The text that paths must contain.
+    roots : list of str
+        The names of the roots to search in (all subscribed roots if empty).
+        Searching does not subscribe to roots, so every named root must
+        already be subscribed to.
+    limit : int
+        The maximum number of datasets to return.
+
+    Returns
+    -------
+    list
+        The sorted paths (with the root name) of matching datasets in each
+        root, one root after another.
+    """
+    if not roots:
+        roots = [name for name, root in database.roots.items()
+                 if root.subscribed]
+    for root in roots:
+        if root != '@scratch' and not get_root(root).subscribed:
+            srv_utils.raise_not_found(f'Not subscribed to {root}')
+    return await search_datasets(roots, text, limit, user,
+                                 subscribe=False)
+
+
+async def search_datasets(roots, text, limit=None, user=None,
+                          subscribe=True):
+    """
+    Get the paths of datasets in the given roots which contain `text`.
+
+    Roots which are not subscribed to are followed first if `subscribe`
+    is true, and skipped otherwise.
+    """
+    found = []
+    for root in roots:
+        remaining = None if limit is None else limit - len(found)
+        if remaining is not None and remaining <= 0:
+            break
+
+        if user and root == '@scratch':
+            relpaths = await blocking(walk_datasets, scratch / str(user.id))
+            relpaths = sorted(str(relpath) for relpath in relpaths
+                              if text in str(relpath))[:remaining]
+        else:
+            if not get_root(root).subscribed:
+                if not subscribe:
+                    continue
+                await follow(root)
+            if text:
+                index = await get_search_index(root)
+                relpaths = index.search(text, remaining)
+            else:
+                relpaths = (await get_index(root)).list(limit=remaining)
+
+        found.extend(f'{root}/{relpath}' for relpath in relpaths)
+
+    return found
 
 
 @app.get('/api/info/{path:path}')
 async def get_info(
     path: pathlib.Path,
+    if_none_match: srv_utils.HeaderType = None,
     user: db.User = Depends(current_active_user),
 ):
     """
@@ -355,14 +1007,62 @@ async def get_info(
 
     Returns
     -------
-    dict
-        The metadata of the dataset.
+    Response
+        The metadata of the dataset, as JSON with an ``ETag``, or an empty 304
+        response if it matches ``If-None-Match``.
+
+        The metadata of datasets in subscribed roots is kept in memory while
+        their etag in the publisher does not change.  The ETag changes along
+        with the latter (see `info_etag()`).
     """
     abspath, _ = abspath_and_dataprep(path, user=user)
-    return srv_utils.read_metadata(abspath, cache=cache)
+    key = str(path)
+    pub_etag = database.etags.get(key)
+    entry = metadata_cache.get(key)
+    if entry is None or entry[0] != pub_etag:
+        epoch = metadata_epoch
+
+        def read():
+            metadata = read_metadata_locked(abspath, cache=cache)
+            if pub_etag is not None:
+                return metadata, pub_etag
+            stat = abspath.stat()  # not from a publisher, e.g. in scratch
+            return metadata, f'{stat.st_mtime_ns}:{stat.st_size}'
+
+        metadata, version = await blocking(read)
+        data = jsonable_encoder(metadata)
+        body = JSONResponse(data).body
+        entry = (pub_etag, body, info_etag(data, version))
+        # Do not cache metadata which may have been invalidated meanwhile
+        if pub_etag is not None and epoch == metadata_epoch:
+            metadata_cache[key] = entry
+
+    _, body, etag = entry
+    if if_none_match == etag:
+        return responses.Response(status_code=304, headers={'ETag': etag})
+    return responses.Response(body, media_type='application/json',
+                              headers={'ETag': etag})
+
+
+def info_etag(data, version):
+    """
+    Get the ETag of the metadata `data` (as JSON data) of a dataset version.
+
+    The ``cbytes`` and ``cratio`` of the dataset are left out, as they
+    describe its local copy, which changes as more chunks are cached.
+    """
+    def strip(meta):
+        return {k: v for k, v in meta.items() if k not in {'cbytes', 'cratio'}}
 
+    data = strip(data)
+    if isinstance(data.get('schunk'), dict):
+        data['schunk'] = strip(data['schunk'])
+    payload = json.dumps([version, data], sort_keys=True).encode()
+    return f'"{hashlib.md5(payload).hexdigest()}"'
 
-async def partial_download(abspath, path, slice_=None):
+
+async def partial_download(abspath, path, slice_=None, client=None,
+                           nchunks=None):
     """
     Download the necessary chunks of a dataset.
 
@@ -374,66 +1074,248 @@ async def partial_download(abspath, path, slice_=None):
         The path to the dataset.
     slice_ : slice, tuple of slices
         The slice to fetch.
+    client : str
+        If given, the client fetching the slice, whose access pattern is used
+        to prefetch chunks.
+    nchunks : list of int
+        If given, the numbers of the chunks to fetch, instead of those
+        covered by the slice.
 
     Returns
     -------
     None
         When finished, the dataset is available in cache.
     """
-    lock = locks.setdefault(path, asyncio.Lock())
-    async with lock:
-        # Build the list of chunks we need to download from the publisher
+    # Keep the chunks of this dataset in cache until the download finishes
+    release = cache_manager.acquire([abspath])
+    try:
+        nchunks, unavailable, layout = await blocking(get_slice_chunks,
+                                                      abspath, slice_,
+                                                      nchunks)
+        # Make room in cache for the chunks to be downloaded
+        cache_manager.touch(abspath, nchunks)
+        await evict_chunks()
+
+        # Chunks already being downloaded (for this or other requests) are
+        # just waited for, and the remaining missing chunks are downloaded
+        # here.
+        loop = asyncio.get_running_loop()
+        futures = []
+        missing = []
+        for n in nchunks:
+            future = inflight.get((path, n))
+            if future is None:
+                if n not in unavailable:
+                    continue
+                future = loop.create_future()
+                inflight[(path, n)] = future
+                missing.append(n)
+            futures.append(future)
+
+        # Fetch the missing chunks concurrently, each one is stored in cache
+        # as soon as it arrives.  Chunks are requested in batches so that
+        # many small chunks do not cost a request each.  Downloads run in
+        # their own tasks so that other requests waiting for the same chunks
+        # are not affected if this one is cancelled.
+        if missing:
+            nbatches = max(min(dataset_download_concurrency, len(missing)),
+                           math.ceil(len(missing) / download_batch_size))
+            size = math.ceil(len(missing) / nbatches)
+            for i in range(0, len(missing), size):
+                batch = missing[i:i + size]
+                task = asyncio.create_task(download_batch(path, abspath,
+                                                          batch))
+                download_tasks.add(task)
+                task.add_done_callback(download_tasks.discard)
+
+        if client is not None:
+            await prefetch(path, abspath, slice_, client, *layout)
+
+        await asyncio.gather(*[asyncio.shield(future) for future in futures])
+    finally:
+        release()
+
+
+def get_slice_chunks(abspath, slice_=None, nchunks=None):
+    """
+    Get the chunks of a cached dataset covered by a slice.
+
+    Return the numbers of the chunks (or `nchunks` if given), the set of
+    those not available in the cache, and the shape, chunk shape and chunk
+    size (in bytes) of the dataset.
+    """
+    with locked([abspath]):
         array, schunk = srv_utils.open_b2(abspath)
-        if slice_:
-            if not array:
-                if isinstance(slice_[0], slice):
-                    # TODO: support schunk.nitems to avoid computations like these
-                    nitems = schunk.nbytes // schunk.typesize
-                    start, stop, _ = slice_[0].indices(nitems)
-                else:
-                    start, stop = slice_[0], slice_[0] + 1
-                # get_slice_nchunks() does not support slices for schunks yet
-                # TODO: support slices for schunks in python-blosc2
-                nchunks = blosc2.get_slice_nchunks(schunk, (start, stop))
-            else:
-                nchunks = blosc2.get_slice_nchunks(array, slice_)
+        if array is not None:
+            shape, chunks = array.shape, array.chunks
+        else:
+            # TODO: support schunk.nitems to avoid computations like these
+            shape = (schunk.nbytes // schunk.typesize,)
+            chunks = (schunk.chunkshape,)
+        if nchunks is not None:
+            if not all(0 <= n < schunk.nchunks for n in nchunks):
+                raise IndexError('Chunk number out of range')
+        elif slice_:
+            # Only chunks with selected items, even with steps
+            nchunks = api_utils.slice_nchunks(slice_, shape, chunks)
         else:
             nchunks = range(schunk.nchunks)
 
-        # Fetch the chunks
-        for n in nchunks:
-            if not srv_utils.chunk_is_available(schunk, n):
-                await download_chunk(path, schunk, n)
+        unavailable = {int(n) for n in nchunks
+                       if not api_utils.chunk_is_available(schunk, n)}
+
+    return nchunks, unavailable, (shape, chunks, schunk.chunksize)
 
 
-async def download_expr_deps(expr):
+async def download_expr_deps(expr, slice_=None):
     """
     Download the datasets that the lazy expression dataset depends on.
 
     Parameters
     ----------
-    abspath : pathlib.Path
-        The absolute path to the lazy expression dataset.
+    expr : blosc2.LazyExpr
+        The lazy expression.
+    slice_ : slice, tuple of slices
+        The slice of the expression to compute.  If given, only the chunks
+        of operands needed for it are downloaded (when this can be known).
+        If results are cached, whole result chunks are computed (see
+        `materialize_expr()`), so the chunks of operands needed for all of
+        the result chunks covered by the slice are downloaded.
 
     Returns
     -------
     None
         When finished, expression dependencies are available in cache.
     """
+    regions = None
+    if slice_ and cache_expr_results:
+        chunks, _ = blosc2.compute_chunks_blocks(expr.shape, dtype=expr.dtype)
+        regions = [chunk_region(n, expr.shape, chunks) for n
+                   in api_utils.slice_nchunks(slice_, expr.shape, chunks)]
+    elif slice_:
+        regions = [slice_]
+
     coroutines = []
     for ndarr in expr.operands.values():
         relpath = srv_utils.get_relpath(ndarr, cache, scratch)
-        if relpath.parts[0] != '@scratch':
-            abspath = pathlib.Path(ndarr.schunk.urlpath)
-            coroutine = partial_download(abspath, str(relpath))
-            coroutines.append(coroutine)
+        if relpath.parts[0] == '@scratch':
+            continue
+        abspath = pathlib.Path(ndarr.schunk.urlpath)
+        opslices = ([srv_utils.operand_slice(region, expr.shape, ndarr.shape)
+                     for region in regions] if regions is not None else [None])
+        if None in opslices:
+            nchunks = None  # all of the operand
+        else:
+            nchunks = sorted({n for opslice in opslices for n
+                              in api_utils.slice_nchunks(opslice, ndarr.shape,
+                                                         ndarr.chunks)})
+        coroutine = partial_download(abspath, str(relpath), nchunks=nchunks)
+        coroutines.append(coroutine)
 
     await asyncio.gather(*coroutines)
 
 
+def chunk_region(nchunk, shape, chunks):
+    """Get the slices of the items in chunk number `nchunk` of an array."""
+    grid = [math.ceil(n / c) for n, c in zip(shape, chunks)]
+    coords = np.unravel_index(nchunk, grid)
+    return tuple(slice(int(i) * c, min((int(i) + 1) * c, n))
+                 for i, c, n in zip(coords, chunks, shape))
+
+
+def get_expr_key(abspath, expr):
+    """
+    Get a key identifying the current result of the lazy expression `expr`.
+
+    It changes if the expression is saved anew, or if any of its operands
+    changes, according to its etag (for cached datasets) or modification
+    time (for scratch datasets).
+    """
+    def stat_key(path):
+        stat = path.stat()
+        return f'{stat.st_mtime}:{stat.st_size}'
+
+    operands = {}
+    for ndarr in expr.operands.values():
+        relpath = srv_utils.get_relpath(ndarr, cache, scratch)
+        if relpath.parts[0] == '@scratch':
+            etag = stat_key(pathlib.Path(ndarr.schunk.urlpath))
+        else:
+            etag = database.etags.get(str(relpath))
+        operands[str(relpath)] = etag
+
+    return {'expr': stat_key(abspath), 'operands': operands}
+
+
+def materialize_expr(abspath, slice_=None):
+    """
+    Compute the chunks of a lazy expression result covered by the slice.
+
+    Result chunks are kept in a dataset under the results directory, with
+    the same path as the expression in the scratch directory.  They are only
+    computed if missing, or if the result is stale (see `get_expr_key()`).
+    A stale result is replaced by a new file rather than overwritten, as
+    other requests may still be reading it.  The chunks of operands needed
+    for whole result chunks must already be in the cache (see
+    `download_expr_deps()`).
+
+    Return the path to the result dataset.
+    """
+    respath = results / abspath.relative_to(scratch)
+    keypath = respath.with_name(f'{respath.name}.key')
+    with open_locked(abspath) as (expr, _):
+        key = get_expr_key(abspath, expr)
+        shape, dtype = expr.shape, expr.dtype
+
+    with locked([respath]):
+        try:
+            valid = (respath.is_file()
+                     and json.loads(keypath.read_text()) == key)
+        except (OSError, ValueError):
+            valid = False
+        if not valid:
+            respath.parent.mkdir(parents=True, exist_ok=True)
+            tmppath = respath.with_name(f'{respath.name}.tmp')
+            chunks, blocks = blosc2.compute_chunks_blocks(shape, dtype=dtype)
+            blosc2.uninit(shape, dtype, chunks=chunks, blocks=blocks,
+                          urlpath=tmppath, mode='w')
+            os.replace(tmppath, respath)
+            keypath.write_text(json.dumps(key))
+        result = blosc2.open(respath)
+
+        nchunks = (api_utils.slice_nchunks(slice_, shape, result.chunks)
+                   if slice_ else range(result.schunk.nchunks))
+        missing = [n for n in nchunks
+                   if not api_utils.chunk_is_available(result.schunk, n)]
+        chunks = result.chunks
+        del result
+    expr_stats['reused'] += len(nchunks) - len(missing)
+
+    # Chunks are computed one at a time, so that other requests may use the
+    # expression and result datasets meanwhile
+    for nchunk in missing:
+        region = chunk_region(nchunk, shape, chunks)
+        with open_locked(abspath) as (expr, _):
+            data = expr[region]
+        with locked([respath]):
+            blosc2.open(respath, mode='a')[region] = data
+        expr_stats['computed'] += 1
+
+    return respath
+
+
+def remove_expr_result(abspath):
+    """Remove the result of the lazy expression at `abspath`, if any."""
+    respath = results / abspath.relative_to(scratch)
+    with locked([respath]):
+        respath.unlink(missing_ok=True)
+        respath.with_name(f'{respath.name}.key').unlink(missing_ok=True)
+
+
 def abspath_and_dataprep(path: pathlib.Path,
                          slice_: (tuple | None) = None,
-                         user: (db.User | None) = None) -> tuple[
+                         user: (db.User | None) = None,
+                         client: (str | None) = None) -> tuple[
                              pathlib.Path,
                              Callable[[], Awaitable],
                          ]:
@@ -448,27 +1330,50 @@ def abspath_and_dataprep(path: pathlib.Path,
     if user and parts[0] == '@scratch':
         filepath = scratch / str(user.id) / pathlib.Path(*parts[1:])
         abspath = srv_utils.cache_lookup(scratch, filepath)
-        expr = blosc2.open(abspath)
-        if isinstance(expr, blosc2.LazyArray):
-            async def dataprep():
-                return await download_expr_deps(expr)
-        else:
-            async def dataprep():
-                pass
+
+        def open_dataset():
+            with locked([abspath]):
+                return blosc2.open(abspath)
+
+        async def dataprep():
+            # Loading lazy expressions opens their operands, so it is blocking
+            expr = await blocking(open_dataset)
+            if isinstance(expr, blosc2.LazyArray):
+                await download_expr_deps(expr, slice_)
 
     else:
         filepath = cache / path
         abspath = srv_utils.cache_lookup(cache, filepath)
         async def dataprep():
-            return await partial_download(abspath, str(path), slice_)
+            return await partial_download(abspath, str(path), slice_,
+                                          client)
 
     return (abspath, dataprep)
 
 
+async def aiterate(iterable, on_done=None):
+    """
+    Iterate over `iterable` in worker threads, as producing each item may
+    take a while.
+
+    If given, ``on_done()`` is called when iteration ends or is aborted.
+    """
+    iterator = iter(iterable)
+    done = object()
+    try:
+        while (item := await blocking(next, iterator, done)) is not done:
+            yield item
+    finally:
+        if on_done is not None:
+            on_done()
+
+
 @app.get('/api/fetch/{path:path}')
 async def fetch_data(
     path: pathlib.Path,
+    request: Request,
     slice_: str = None,
+    accept: srv_utils.HeaderType = None,
     user: db.User = Depends(current_active_user),
 ):
     """
@@ -487,16 +1392,56 @@ async def fetch_data(
         The (slice of) dataset as a Blosc2 schunk.  When the whole dataset is
         to be downloaded (instead of some slice which does not cover it fully),
         its stored image is served containing all data and metadata (including
-        variable length fields).
+        variable length fields).  Its image supports ``Range`` requests
+        (validated with ``If-Range`` against its ``ETag``), so that
+        interrupted downloads may be resumed.
+
+        If the client accepts the ``api_utils.chunks_media_type``, a slice is
+        sent as a chunk stream instead, which is produced and can be consumed
+        chunk by chunk.
     """
 
     slice_ = api_utils.parse_slice(slice_)
     # Download and update the necessary chunks of the schunk in cache
-    abspath, dataprep = abspath_and_dataprep(path, slice_, user=user)
-    await dataprep()
+    client = (str(user.id) if user
+              else request.client.host if request.client else None)
+    abspath, dataprep = abspath_and_dataprep(path, slice_, user=user,
+                                             client=client)
+
+    # Keep the chunks to be read in cache until they are sent
+    releases = [cache_manager.acquire([abspath])]
+
+    def release():
+        for release_ in releases:
+            release_()
+
+    try:
+        await dataprep()
+
+        def open_dataset():
+            with locked([abspath]):
+                return srv_utils.open_b2(abspath)
+
+        array, schunk = await blocking(open_dataset)
+        if schunk is None:  # lazy expr
+            releases.append(cache_manager.acquire(
+                pathlib.Path(op.schunk.urlpath)
+                for op in array.operands.values()))
+            if cache_expr_results:
+                abspath = await blocking(materialize_expr, abspath, slice_)
+                array, schunk = await blocking(open_dataset)
 
-    array, schunk = srv_utils.open_b2(abspath)
-    typesize = array.dtype.itemsize if array is not None else schunk.typesize
+        return await fetch_response(abspath, array, schunk, slice_, accept,
+                                    release)
+    except BaseException:
+        release()
+        raise
+
+
+async def fetch_response(abspath, array, schunk, slice_, accept, release):
+    """
+    Get the response to `fetch_data()`, which calls ``release()`` when sent.
+    """
     shape = array.shape if array is not None else (len(schunk),)
 
     whole = slice_ is None or slice_ == ()
@@ -510,39 +1455,316 @@ async def fetch_data(
     if whole and schunk is not None:  # whole and not lazy expr
         # Send the data in the file straight to the client,
         # avoiding slicing and re-compression.
-        return FileResponse(abspath, filename=abspath.name,
-                            media_type='application/octet-stream')
+        kind = 'ndarray' if array is not None else 'schunk'
+        return srv_utils.CallbackFileResponse(
+            abspath, filename=abspath.name,
+            media_type='application/octet-stream',
+            headers={api_utils.cframe_type_header: kind}, on_done=release)
+
+    # The data is read, compressed and sent chunk by chunk.  Other requests
+    # may add chunks to the dataset in the meantime, so it is only opened
+    # again if it changed.
+    open_dataset = srv_utils.dataset_opener(abspath)
+
+    def getchunk(nchunk):
+        with locked([abspath]):
+            _, schunk = open_dataset()
+            return schunk.get_chunk(nchunk)
+
+    if array is not None:
+        chunkshape = (array.chunks if schunk is not None
+                      else blosc2.compute_chunks_blocks(array.shape,
+                                                        dtype=array.dtype)[0])
+
+        def read(index):
+            with locked([abspath]):
+                array, _ = open_dataset()
+                return array[index]
+
+        def getitem(index):
+            return api_utils.strided_getitem(read, index, array.shape,
+                                             chunkshape)
+
+        # Slices covering whole chunks are served with the stored chunks
+        result = None
+        if schunk is not None:  # not lazy expr
+            result = srv_utils.aligned_array(getchunk, array.shape,
+                                             array.chunks, array.blocks,
+                                             array.dtype, slice_)
+        if result is None:
+            result = srv_utils.sliced_array(getitem, array.shape,
+                                            array.dtype, slice_)
+    else:
+        def getitem(slice_):
+            with locked([abspath]):
+                _, schunk = open_dataset()
+                return schunk[slice_]
+
+        assert len(slice_) == 1
+        args = (schunk.nbytes // schunk.typesize, schunk.typesize,
+                schunk.chunkshape, slice_[0])
+        result = (srv_utils.aligned_schunk(getchunk, *args)
+                  or srv_utils.sliced_schunk(getitem, *args))
+    meta, chunks = result
+
+    if accept and api_utils.chunks_media_type in accept:
+        downloader = aiterate(srv_utils.iter_chunk_stream(meta, chunks),
+                              on_done=release)
+        return responses.StreamingResponse(
+            downloader, media_type=api_utils.chunks_media_type)
+
+    # Serialization is done either as:
+    # * a serialized NDArray
+    # * a compressed SChunk (bytes)
+    # The frame is written to a temporary file, so that it is not kept in
+    # memory as a whole (it can only be sent once complete).
+    fd, tmppath = tempfile.mkstemp(suffix='.b2', dir=tmpdir)
+    os.close(fd)
+    tmppath = pathlib.Path(tmppath)
 
-    if slice_:
-        if array is not None:
-            array = array[slice_] if array.ndim > 0 else array[()]
+    def on_done():
+        tmppath.unlink(missing_ok=True)
+
+    try:
+        await blocking(srv_utils.chunks_to_file, meta, chunks, tmppath)
+    except BaseException:
+        on_done()
+        raise
+    finally:
+        release()
+
+    kind = 'ndarray' if 'shape' in meta else 'schunk'
+    return srv_utils.CallbackFileResponse(
+        tmppath, media_type='application/octet-stream',
+        headers={api_utils.cframe_type_header: kind}, on_done=on_done)
+
+
+@app.get('/api/chunks/{path:path}')
+async def get_chunks(
+    path: pathlib.Path,
+    nchunks: str = '',
+    user: db.User = Depends(current_active_user),
+):
+    """
+    Get some chunks of a dataset, as stored.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The path to the dataset (not in scratch space).
+    nchunks : str
+        The comma-separated numbers of chunks and inclusive ranges of them
+        (like ``0-9,15,20-30``).
+
+    Returns
+    -------
+    StreamingResponse
+        The chunks as a framed stream (see `api_utils.iter_frames()`), with
+        the chunk number as the index of each frame.  Clients may use them to
+        keep their own copy of the dataset.
+    """
+    try:
+        nchunks = api_utils.parse_chunks(nchunks)
+    except ValueError:
+        srv_utils.raise_bad_request(f'Invalid chunk numbers {nchunks}')
+    if not nchunks:
+        srv_utils.raise_bad_request('Chunk numbers required')
+    if path.parts[0] == '@scratch':
+        srv_utils.raise_bad_request('Only cached datasets have chunks')
+
+    abspath = srv_utils.cache_lookup(cache, cache / path)
+    if abspath.suffix != '.b2nd':
+        srv_utils.raise_bad_request('Only arrays have chunks')
+
+    # Keep the chunks in cache until they are sent
+    release = cache_manager.acquire([abspath])
+    try:
+        try:
+            await partial_download(abspath, str(path), nchunks=nchunks)
+        except IndexError as exc:
+            srv_utils.raise_bad_request(str(exc))
+    except BaseException:
+        release()
+        raise
+
+    open_dataset = srv_utils.dataset_opener(abspath)
+
+    def iterchunks():
+        for nchunk in nchunks:
+            with locked([abspath]):
+                _, schunk = open_dataset()
+                chunk = schunk.get_chunk(nchunk)
+            yield from api_utils.iter_frame(nchunk, chunk)
+
+    return responses.StreamingResponse(aiterate(iterchunks(),
+                                                on_done=release))
+
+
+@app.get('/api/reduce/{path:path}')
+async def reduce_data(
+    path: pathlib.Path,
+    op: str,
+    axis: str = None,
+    slice_: str = None,
+    user: db.User = Depends(current_active_user),
+):
+    """
+    Reduce (a slice of) a dataset along some axes.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The path to the dataset.
+    op : str
+        The reduction, one of ``sum``, ``mean``, ``std``, ``min`` and
+        ``max``.
+    axis : str
+        The comma-separated axes of the (sliced) dataset to reduce (all of
+        them if missing).
+    slice_ : str
+        The slice to reduce.
+
+    Returns
+    -------
+    Response
+        The result as a serialized NDArray.  If some of the chunks of the
+        dataset (or of the operands of a lazy expression) covered by the
+        slice are not in cache, the reduction is computed by the publisher
+        when possible (see `get_pushdown()`).  Otherwise, only the missing
+        chunks are downloaded, and they are reduced one at a time.
+    """
+    if op not in srv_utils.reductions:
+        srv_utils.raise_bad_request(f'Unsupported reduction {op}')
+    try:
+        axis = (tuple(int(a) for a in axis.split(','))
+                if axis else None)
+    except ValueError:
+        srv_utils.raise_bad_request(f'Invalid axis {axis}')
+
+    slice_str, slice_ = slice_, api_utils.parse_slice(slice_)
+    abspath, dataprep = abspath_and_dataprep(path, slice_, user=user)
+
+    # Keep the chunks to be read in cache until reduced
+    releases = [cache_manager.acquire([abspath])]
+    try:
+        def open_dataset():
+            with locked([abspath]):
+                return srv_utils.open_b2(abspath)
+
+        array, schunk = await blocking(open_dataset)
+        if array is None:
+            srv_utils.raise_bad_request('Only arrays can be reduced')
+
+        args = (await blocking(get_pushdown, path, abspath, slice_)
+                if pushdown else None)
+        if args is not None:
+            data = await pushdown_reduce(*args, op, axis, slice_str)
+            if data is not None:
+                reduce_stats['pushed'] += 1
+                return responses.Response(
+                    data, media_type='application/octet-stream')
+
+        await dataprep()
+        if schunk is None:  # lazy expr
+            releases.append(cache_manager.acquire(
+                pathlib.Path(operand.schunk.urlpath)
+                for operand in array.operands.values()))
+            if cache_expr_results:
+                abspath = await blocking(materialize_expr, abspath, slice_)
+                array, schunk = await blocking(open_dataset)
+
+        chunks = (array.chunks if schunk is not None
+                  else blosc2.compute_chunks_blocks(array.shape,
+                                                    dtype=array.dtype)[0])
+
+        def read(index):
+            with open_locked(abspath) as (array, _):
+                return array[index]
+
+        def getitem(index):
+            return api_utils.strided_getitem(read, index, array.shape, chunks)
+
+        try:
+            result = await blocking(srv_utils.reduce_array, getitem,
+                                    array.shape, chunks, array.dtype, op,
+                                    axis, slice_)
+        except (IndexError, ValueError) as exc:
+            srv_utils.raise_bad_request(str(exc))
+        reduce_stats['local'] += 1
+    finally:
+        for release in releases:
+            release()
+
+    data = await blocking(lambda: blosc2.asarray(result).to_cframe())
+    return responses.Response(data, media_type='application/octet-stream')
+
+
+def get_pushdown(path, abspath, slice_=None):
+    """
+    Get what is needed to compute (a slice of) a dataset in its publisher.
+
+    That is the name of the root, and the expression and operands (as paths
+    in the root) of the dataset.  A dataset in cache is its only operand,
+    while lazy expressions may only be computed in the publisher if all
+    their operands are in the same root and have the same shape.
+
+    Return `None` if the dataset may not be computed in the publisher, or if
+    all the chunks needed are already in cache (so that computing it here
+    is cheaper).
+    """
+    with open_locked(abspath) as (array, schunk):
+        if schunk is not None:
+            expression = 'o0'
+            operands = {'o0': (pathlib.Path(path), abspath)}
+        elif isinstance(array, blosc2.LazyExpr):
+            expression = array.expression
+            operands = {}
+            for name, ndarr in array.operands.items():
+                relpath = srv_utils.get_relpath(ndarr, cache, scratch)
+                if (relpath.parts[0] == '@scratch'
+                        or ndarr.shape != array.shape):
+                    return None
+                operands[name] = (relpath,
+                                  pathlib.Path(ndarr.schunk.urlpath))
         else:
-            assert len(slice_) == 1
-            slice_ = slice_[0]
-            if isinstance(slice_, int):
-                # TODO: make SChunk support integer as slice
-                slice_ = slice(slice_, slice_ + 1)
-            schunk = schunk[slice_]
-
-    # Serialization can be done either as:
-    # * a serialized NDArray
-    # * a compressed SChunk (bytes, via blosc2.compress2)
-    data = array if array is not None else schunk
-    if not slice_:
-        # data is still a SChunk, so we need to get either a NumPy array, or a bytes object
-        data = data[()] if array is not None else data[:]
-
-    if isinstance(data, np.ndarray):
-        data = blosc2.asarray(data)
-        data = data.to_cframe()
-    elif isinstance(data, bytes):
-        # A bytes object can still be compressed as a SChunk
-        schunk = blosc2.SChunk(data=data, cparams={'typesize': typesize})
-        data = schunk.to_cframe()
-    downloader = srv_utils.iterchunk(data)
+            return None
+
+    roots = {relpath.parts[0] for relpath, _ in operands.values()}
+    if len(roots) != 1:
+        return None
+    if not any(get_slice_chunks(opabspath, slice_)[1]
+               for _, opabspath in operands.values()):
+        return None
+
+    operands = {name: str(pathlib.Path(*relpath.parts[1:]))
+                for name, (relpath, _) in operands.items()}
+    return roots.pop(), expression, operands
+
 
-    return responses.StreamingResponse(downloader,
-                                       media_type='application/octet-stream')
+async def pushdown_reduce(root, expression, operands, op, axis, slice_):
+    """
+    Reduce (a slice of) an expression in the publisher of its `root`.
+
+    The `slice_` is given as a string.  Return the result as a serialized
+    NDArray, or `None` if the publisher failed to compute it (e.g. because it does
+    not support some operation in the expression, or computations at all) or
+    took longer than `pushdown_timeout` seconds.
+    """
+    host = database.roots[root].http
+    url = f'http://{host}/api/compute'
+    json_ = {'expression': expression, 'operands': operands, 'op': op,
+             'axis': axis, 'slice_': slice_}
+
+    client = get_http_client(host)
+    try:
+        # Reductions may take a while, and nothing is sent until they finish
+        resp = await client.post(url, json=json_, timeout=pushdown_timeout)
+        resp.raise_for_status()
+    except httpx.HTTPError as exc:
+        logger.info(f'Reduction not computed by publisher of {root}: {exc}')
+        return None
+
+    return resp.content
 
 
 def make_lazyexpr(name: str, expr: str, operands: dict[str, str],
@@ -757,25 +1979,13 @@ async def htmx_path_list(
 
     query = {'roots': roots, 'search': search}
     datasets = []
-    for root in roots:
-        if user and root == '@scratch':
-            rootdir = scratch / str(user.id)
-        else:
-            if not get_root(root).subscribed:
-                follow(root)
-            rootdir = cache / root
-
-        for path, relpath in utils.walk_files(rootdir):
-            if relpath.suffix == '.b2':
-                relpath = relpath.with_suffix('')
-            if search in str(relpath):
-                path = f'{root}/{relpath}'
-                url = make_url(request, "html_home", path=path, query=query)
-                datasets.append({
-                    'path': path,
-                    'name': next(names),
-                    'url': url,
-                })
+    for path in await search_datasets(roots, search, user=user):
+        url = make_url(request, "html_home", path=path, query=query)
+        datasets.append({
+            'path': path,
+            'name': next(names),
+            'url': url,
+        })
 
     # Render template
     cmd_url = make_url(request, 'htmx_command')
@@ -810,13 +2020,14 @@ async def htmx_path_info(
     user: db.User = Depends(current_active_user),
 ):
 
+    abspath, _ = abspath_and_dataprep(path, user=user)
     try:
-        abspath, _ = abspath_and_dataprep(path, user=user)
+        # Loading lazy expressions opens their operands
+        meta = await blocking(read_metadata_locked, abspath,
+                              cache=cache, scratch=scratch)
     except FileNotFoundError:
         return htmx_error(request, 'FileNotFoundError: missing operand(s)')
 
-    meta = srv_utils.read_metadata(abspath, cache=cache, scratch=scratch)
-
     vlmeta = getattr(getattr(meta, 'schunk', meta), 'vlmeta', {})
     contenttype = vlmeta.get('contenttype') or guess_dset_ctype(path, meta)
     plugin = plugins.get(contenttype)
@@ -876,78 +2087,8 @@ async def htmx_path_view(
 
     abspath, dataprep = abspath_and_dataprep(path, user=user)
     await dataprep()
-    arr = blosc2.open(abspath)
-
-    # Local variables
-    shape = arr.shape
-    ndims = len(shape)
-    has_ndfields = hasattr(arr, 'fields') and arr.fields != {}
-
-    # Set of dimensions that define the window
-    # TODO Allow the user to choose the window dimensions
-    dims = list(range(ndims))
-    if ndims == 0:
-        view_dims = {}
-    elif ndims == 1 or has_ndfields:
-        view_dims = {dims[-1]}
-    else:
-        view_dims = {dims[-2], dims[-1]}
-
-    # Default values for input params
-    index = (0,) * ndims if index is None else tuple(index)
-    if sizes is None:
-        sizes = [min(dim, 10) if i in view_dims else 1 for i, dim in enumerate(shape)]
-
-    inputs = []
-    tags = []
-    for i, (start, size, size_max) in enumerate(zip(index, sizes, shape)):
-        mod = size_max % size
-        start_max = size_max - (mod or size)
-        inputs.append({
-            'start': start,
-            'start_max': start_max,
-            'size': size,
-            'size_max': size_max,
-            'with_size': i in view_dims,
-        })
-        if inputs[-1]['with_size']:
-            tags.append([k for k in range(start, min(start+size, size_max))])
-
-    if has_ndfields:
-        cols = list(arr.fields.keys())
-        fields = fields or cols[:5]
-        idxs = [cols.index(f) for f in fields]
-        rows = [fields]
-
-        # Get array view
-        if ndims >= 2:
-            arr = arr[index[:-1]]
-            i, isize = index[-1], sizes[-1]
-            arr = arr[i:i + isize]
-            arr = arr.tolist()
-        elif ndims == 1:
-            i, isize = index[0], sizes[0]
-            arr = arr[i:i + isize]
-            arr = arr.tolist()
-        else:
-            arr = [arr[()].tolist()]
-        rows += [[row[i] for i in idxs] for row in arr]
-    else:
-        # Get array view
-        cols = None
-        if ndims >= 2:
-            arr = arr[index[:-2]]
-            i, isize = index[-2], sizes[-2]
-            j, jsize = index[-1], sizes[-1]
-            arr = arr[i:i+isize, j:j+jsize]
-            rows = [tags[-1]] + list(arr)
-        elif ndims == 1:
-            i, isize = index[0], sizes[0]
-            arr = [arr[i:i+isize]]
-            rows = [tags[-1]] + list(arr)
-        else:
-            arr = [[arr[()]]]
-            rows = list(arr)
+    inputs, rows, cols, fields, tags = await blocking(
+        get_path_view, abspath, index, sizes, fields)
 
     # Render
     context = {
@@ -960,6 +2101,89 @@ async def htmx_path_view(
     }
     return templates.TemplateResponse(request, "info_view.html", context)
 
+
+def get_path_view(abspath, index, sizes, fields):
+    """
+    Get the inputs and contents of the view of a dataset for
+    `htmx_path_view()`.
+    """
+    with open_locked(abspath) as (arr, schunk):
+        arr = schunk if arr is None else arr
+
+        # Local variables
+        shape = arr.shape
+        ndims = len(shape)
+        has_ndfields = hasattr(arr, 'fields') and arr.fields != {}
+
+        # Set of dimensions that define the window
+        # TODO Allow the user to choose the window dimensions
+        dims = list(range(ndims))
+        if ndims == 0:
+            view_dims = {}
+        elif ndims == 1 or has_ndfields:
+            view_dims = {dims[-1]}
+        else:
+            view_dims = {dims[-2], dims[-1]}
+
+        # Default values for input params
+        index = (0,) * ndims if index is None else tuple(index)
+        if sizes is None:
+            sizes = [min(dim, 10) if i in view_dims else 1 for i, dim in enumerate(shape)]
+
+        inputs = []
+        tags = []
+        for i, (start, size, size_max) in enumerate(zip(index, sizes, shape)):
+            mod = size_max % size
+            start_max = size_max - (mod or size)
+            inputs.append({
+                'start': start,
+                'start_max': start_max,
+                'size': size,
+                'size_max': size_max,
+                'with_size': i in view_dims,
+            })
+            if inputs[-1]['with_size']:
+                tags.append([k for k in range(start, min(start+size, size_max))])
+
+        if has_ndfields:
+            cols = list(arr.fields.keys())
+            fields = fields or cols[:5]
+            idxs = [cols.index(f) for f in fields]
+            rows = [fields]
+
+            # Get array view
+            if ndims >= 2:
+                arr = arr[index[:-1]]
+                i, isize = index[-1], sizes[-1]
+                arr = arr[i:i + isize]
+                arr = arr.tolist()
+            elif ndims == 1:
+                i, isize = index[0], sizes[0]
+                arr = arr[i:i + isize]
+                arr = arr.tolist()
+            else:
+                arr = [arr[()].tolist()]
+            rows += [[row[i] for i in idxs] for row in arr]
+        else:
+            # Get array view
+            cols = None
+            if ndims >= 2:
+                arr = arr[index[:-2]]
+                i, isize = index[-2], sizes[-2]
+                j, jsize = index[-1], sizes[-1]
+                arr = arr[i:i+isize, j:j+jsize]
+                rows = [tags[-1]] + list(arr)
+            elif ndims == 1:
+                i, isize = index[0], sizes[0]
+                arr = [arr[i:i+isize]]
+                rows = [tags[-1]] + list(arr)
+            else:
+                arr = [[arr[()]]]
+                rows = list(arr)
+
+        return inputs, rows, cols, fields, tags
+
+
 @app.post("/htmx/command/", response_class=HTMLResponse)
 async def htmx_command(
     request: Request,
@@ -1060,6 +2284,7 @@ async def htmx_delete(
     parts[0] = str(user.id)
     path = pathlib.Path(*parts)
     (scratch / path).unlink()
+    await blocking(remove_expr_result, scratch / path)
 
     # Redirect to home
     url = make_url(request, "html_home")
@@ -1078,8 +2303,13 @@ async def html_markdown(
 
     abspath, dataprep = abspath_and_dataprep(path, user=user)
     await dataprep()
-    arr = blosc2.open(abspath)
-    content = arr[:]
+
+    def read():
+        with locked([abspath]):
+            arr = blosc2.open(abspath)
+            return arr[:]
+
+    content = await blocking(read)
     # Markdown
     return markdown.markdown(content.decode('utf-8'))
 
@@ -1115,6 +2345,38 @@ def main():
     global broker
     broker = args.broker
 
+    # Download limits
+    global download_concurrency, dataset_download_concurrency
+    global download_batch_size
+    download_concurrency = conf.get('.download_concurrency',
+                                    download_concurrency)
+    dataset_download_concurrency = conf.get('.dataset_download_concurrency',
+                                            dataset_download_concurrency)
+    download_batch_size = conf.get('.download_batch_size',
+                                   download_batch_size)
+
+    # Connections to publishers
+    global http_max_connections, http_max_keepalive_connections, http_timeout
+    http_max_connections = conf.get('.http_max_connections',
+                                    http_max_connections)
+    http_max_keepalive_connections = conf.get(
+        '.http_max_keepalive_connections', http_max_keepalive_connections)
+    http_timeout = conf.get('.http_timeout', http_timeout)
+
+    # Subscription
+    global follow_concurrency, follow_batch_size
+    follow_concurrency = conf.get('.follow_concurrency', follow_concurrency)
+    follow_batch_size = conf.get('.follow_batch_size', follow_batch_size)
+
+    # Prefetching
+    global prefetch_chunks, prefetch_roots, prefetch_budget
+    global prefetch_concurrency
+    prefetch_chunks = conf.get('.prefetch_chunks', prefetch_chunks)
+    prefetch_roots = conf.get('.prefetch_roots', prefetch_roots)
+    prefetch_budget = conf.get('.prefetch_budget', prefetch_budget)
+    prefetch_concurrency = conf.get('.prefetch_concurrency',
+                                    prefetch_concurrency)
+
     # Init cache
     global statedir, cache
     statedir = args.statedir.resolve()
@@ -1123,6 +2385,12 @@ def main():
     # Use `download_cached()`, `StaticFiles` does not support authorization.
     #app.mount("/files", StaticFiles(directory=cache), name="files")
 
+    # Temporary files (left by a previous run are removed)
+    global tmpdir
+    tmpdir = statedir / 'tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    tmpdir.mkdir()
+
     # Scratch dir
     global scratch
     scratch = statedir / 'scratch'
@@ -1130,10 +2398,39 @@ def main():
     # Use `download_scratch()`, `StaticFiles` does not support authorization.
     #app.mount("/scratch", StaticFiles(directory=scratch), name="scratch")
 
+    # Results of lazy expressions (see `materialize_expr()`)
+    global results, cache_expr_results
+    results = statedir / 'results'
+    results.mkdir(exist_ok=True, parents=True)
+    cache_expr_results = conf.get('.cache_expr_results', cache_expr_results)
+
+    # Reductions
+    global pushdown, pushdown_timeout
+    pushdown = conf.get('.pushdown', pushdown)
+    pushdown_timeout = conf.get('.pushdown_timeout', pushdown_timeout)
+
+    # Cache management
+    global cache_manager
+    cache_manager = srv_utils.CacheManager(
+        cache,
+        budget=conf.get('.cache_budget', cache_budget),
+        root_budgets=conf.get('.cache_root_budgets', cache_root_budgets),
+        pinned=conf.get('.cache_pinned', cache_pinned),
+        compact_ratio=conf.get('.cache_compact_ratio', cache_compact_ratio),
+    )
+    cache_manager.scan()
+    for abspath, nchunks in cache_manager.evict().items():
+        cache_manager.reclaim(abspath, nchunks)
+
+    # Worker threads
+    global worker_threads
+    worker_threads = conf.get('.worker_threads', worker_threads)
+
     # Init database
     global database
     model = models.Subscriber(roots={}, etags={})
-    database = srv_utils.Database(statedir / 'db.json', model)
+    database = srv_utils.open_database(statedir, model,
+                                       conf.get('.database', 'json'))
 
     # Register display plugins
     from .plugins import tomography  # delay module load
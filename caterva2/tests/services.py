@@ -195,11 +195,14 @@ class ManagedServices(Services):
         self._setup()
 
         self._start_proc('broker', check=bro_check(self.configuration))
+        broker = '--broker=%s' % self.get_endpoint('broker')
         for root in self.roots:
             self._start_proc(f'publisher.{root.name}',
                              root.name, self._get_data_path(root),
+                             broker, '--compute',
                              check=pub_check(root.name, self.configuration))
-        self._start_proc('subscriber', check=sub_check(self.configuration))
+        self._start_proc('subscriber', broker,
+                         check=sub_check(self.configuration))
 
     def stop_all(self):
         for proc in self._procs.values():
@@ -220,6 +223,12 @@ class ManagedServices(Services):
     def get_urlbase(self, service):
         return 'http://%s/' % self.get_endpoint(service)
 
+    def get_data_path(self, root_name):
+        for root in self.roots:
+            if root.name == root_name:
+                return self._get_data_path(root)
+        return None
+
 
 class ExternalServices(Services):
     def __init__(self, roots=None, configuration=None):
@@ -255,6 +264,9 @@ class ExternalServices(Services):
         ep = self.get_endpoint(service)
         return 'http://%s/' % ep if ep else None
 
+    def get_data_path(self, root_name):
+        return None  # not known
+
 
 @pytest.fixture(scope='session')
 def services(configuration, examples_dir, examples_hdf5):
@@ -53,6 +53,16 @@ def make_sub_user(services):
     return user
 
 
+def make_sub_jwt_cookie(services, user):
+    username, password = user
+    urlbase = services.get_urlbase('subscriber')
+
+    resp = httpx.post(f'{urlbase}auth/jwt/login',
+                      data=dict(username=username, password=password))
+    resp.raise_for_status()
+    return '='.join(list(resp.cookies.items())[0])
+
+
 @pytest.fixture(scope='session')
 def sub_user(services):
     # TODO: This does not work with external services,
@@ -66,10 +76,5 @@ def sub_jwt_cookie(sub_user, services):
     if not sub_user:
         return None
 
-    username, password = sub_user
-    urlbase = services.get_urlbase('subscriber')
+    return make_sub_jwt_cookie(services, sub_user)
 
-    resp = httpx.post(f'{urlbase}auth/jwt/login',
-                      data=dict(username=username, password=password))
-    resp.raise_for_status()
-    return '='.join(list(resp.cookies.items())[0])
@@ -6,8 +6,12 @@
 # License: GNU Affero General Public License v3.0
 # See LICENSE.txt for details about copyright and rights to use.
 ###############################################################################
+import asyncio
+import concurrent.futures
 import contextlib
+import json
 import pathlib
+import time
 
 import httpx
 
@@ -17,8 +21,10 @@ import pytest
 import caterva2 as cat2
 import numpy as np
 
-from .services import TEST_CATERVA2_ROOT
-from .. import api_utils
+from .services import TEST_CATERVA2_ROOT, ManagedServices
+from .sub_auth import make_sub_jwt_cookie, make_sub_user
+from .. import api_utils, models, utils
+from ..services import srv_utils
 
 
 try:
@@ -44,6 +50,47 @@ def sub_urlbase(services):
     return services.get_urlbase('subscriber')
 
 
+@pytest.fixture(scope='module')
+def isolated_services(services, tmp_path_factory):
+    # A broker and subscriber for tests adding roots, unseen by other tests
+    srvs = ManagedServices(tmp_path_factory.mktemp('services'),
+                           reuse_state=False, roots=[],
+                           configuration=utils.Conf({}))
+    try:
+        srvs.start_all()
+        yield srvs
+    finally:
+        srvs.stop_all()
+    srvs.wait_for_all()
+
+
+@pytest.fixture(scope='module')
+def isolated_jwt_cookie(isolated_services):
+    user = make_sub_user(isolated_services)
+    if not user:
+        return None
+    return make_sub_jwt_cookie(isolated_services, user)
+
+
+def wait_until(check, timeout=10):
+    for _ in range(int(timeout / 0.1)):
+        if check():
+            return
+        time.sleep(0.1)
+    raise TimeoutError('condition not met in time')
+
+
+def add_unavailable_root(srvs, name, auth_cookie):
+    """Add a root whose publisher is not available to the services."""
+    bro_urlbase = srvs.get_urlbase('broker')
+    sub_urlbase = srvs.get_urlbase('subscriber')
+    httpx.post(f'{bro_urlbase}api/roots',
+               json={'name': name, 'http': 'localhost:9'}).raise_for_status()
+    wait_until(lambda: name in cat2.get_roots(sub_urlbase,
+                                              auth_cookie=auth_cookie))
+    return sub_urlbase
+
+
 def my_path(dspath, slice_):
     slice_ = api_utils.slice_to_string(slice_)
     if slice_:
@@ -59,6 +106,205 @@ def test_roots(services, pub_host, sub_urlbase, sub_jwt_cookie):
     assert roots[TEST_CATERVA2_ROOT]['http'] == pub_host
 
 
+def test_download_chunks(services, examples_dir, pub_host):
+    name = 'ds-1d.b2nd'
+    nchunks = [0, 1, 2, 5, 7, 8]
+    params = {'nchunks': api_utils.chunks_to_string(nchunks)}
+    assert params['nchunks'] == '0-2,5,7-8'
+    response = httpx.get(f'http://{pub_host}/api/download-chunks/{name}',
+                         params=params)
+    assert response.status_code == 200
+
+    array = blosc2.open(examples_dir / name)
+    frames = list(api_utils.iter_frames([response.content]))
+    assert [index for index, _ in frames] == nchunks
+    for nchunk, chunk in frames:
+        assert chunk == array.schunk.get_chunk(nchunk)
+
+
+@pytest.mark.parametrize("shape, chunks, blocks", [
+    ((30,), (10,), (3,)),
+    ((100, 4), (10, 4), (3, 4)),
+    ((10, 10), (5, 5), (2, 3)),
+])
+def test_read_chunk_stream_out(shape, chunks, blocks):
+    # Blocks not dividing chunks pad them, which must not overflow `out`
+    nparray = np.arange(np.prod(shape), dtype='i8').reshape(shape)
+    array = blosc2.asarray(nparray, chunks=chunks, blocks=blocks)
+    meta, chunks = srv_utils.aligned_array(array.schunk.get_chunk, shape,
+                                           chunks, blocks, array.dtype)
+    frames = [(-1, json.dumps(meta).encode()), *enumerate(chunks)]
+    buffer = np.full(nparray.size + 64, -1, dtype='i8')
+    out = buffer[:nparray.size].reshape(shape)
+    assert api_utils.read_chunk_stream(frames, out=out) is out
+    np.testing.assert_array_equal(out, nparray)
+    assert (buffer[nparray.size:] == -1).all()
+
+
+def test_dataset_index(tmp_path):
+    from ..services import dirroot, pubroot
+    for name in ['a/x', 'a/y', 'ab', 'b/z']:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(b'')
+    index = pubroot.DatasetIndex(dirroot.DirectoryRoot(tmp_path))
+    assert index.list() == ['a/x', 'a/y', 'ab', 'b/z']
+    assert index.list(prefix='a/') == ['a/x', 'a/y']
+    assert index.list(prefix='a', limit=2, cursor='a/x') == ['a/y', 'ab']
+
+    (tmp_path / 'a/w').write_bytes(b'')
+    index.update(pubroot.PubRoot.Path('a/w'))
+    (tmp_path / 'b/z').unlink()
+    (tmp_path / 'b').rmdir()
+    index.update(pubroot.PubRoot.Path('b'))
+    assert list(map(str, index)) == ['a/w', 'a/x', 'a/y', 'ab']
+
+
+def test_search_index():
+    index = srv_utils.SearchIndex(['a/foo', 'a/bar', 'b/foobar', 'c'])
+    assert index.search('foo') == ['a/foo', 'b/foobar']
+    assert index.search('o', limit=2) == ['a/foo', 'b/foobar']
+    assert index.search('oba') == ['b/foobar']
+    assert index.search('baz') == []
+    index.remove('a/foo')
+    index.remove('c')
+    index.add('c/foo')
+    assert index.search('foo') == ['b/foobar', 'c/foo']
+    assert len(index) == 3
+
+
+def test_list_pages(services, pub_host):
+    url = f'http://{pub_host}/api/list'
+    paths = httpx.get(url).json()
+    assert paths == sorted(paths)
+    assert httpx.get(url, params={'prefix': 'dir1/'}).json() == [
+        path for path in paths if path.startswith('dir1/')]
+
+    pages, cursor = [], None
+    while True:
+        params = {'limit': 3} if cursor is None else {'limit': 3,
+                                                      'cursor': cursor}
+        page = httpx.get(url, params=params).json()
+        pages.extend(page)
+        if len(page) < 3:
+            break
+        cursor = page[-1]
+    assert pages == paths
+
+
+def test_info_bulk(services, pub_host):
+    etag = httpx.get(f'http://{pub_host}/api/info/README.md').headers['etag']
+    etags = {'ds-1d.b2nd': None, 'README.md': etag, 'dir1/ds-2d.b2nd': '"x"',
+             'missing.b2nd': None}
+    response = httpx.post(f'http://{pub_host}/api/info', json=etags)
+    assert response.status_code == 200
+    infos = [json.loads(line) for line in response.iter_lines()]
+    assert [info['path'] for info in infos] == ['ds-1d.b2nd',
+                                                'dir1/ds-2d.b2nd']
+    for info in infos:
+        response = httpx.get(f'http://{pub_host}/api/info/{info["path"]}')
+        assert info['etag'] == response.headers['etag']
+        assert info['metadata'] == response.json()
+
+
+@pytest.mark.parametrize("previous,index,nchunks", [
+    ((slice(0, 10),), (slice(10, 20),), [1, 2, 3]),  # sequential
+    ((slice(0, 10),), (slice(30, 40),), [2, 3]),  # strided
+    ((0, slice(0, 8)), (1, slice(0, 8)), [2, 3, 4]),  # frames
+    ((slice(0, 10),), (slice(10, 30),), None),  # different extent
+    ((0, slice(0, 4)), (1, slice(4, 8)), None),  # several axes
+])
+def test_scan_chunks(previous, index, nchunks):
+    shape, chunks = (100,), (25,)
+    if len(index) == 2:
+        shape, chunks = (6, 8), (2, 4)
+    previous, _ = api_utils.normalize_slice(previous, shape)
+    index, _ = api_utils.normalize_slice(index, shape)
+    shift = srv_utils.slice_shift(previous, index)
+    if nchunks is None:
+        assert shift is None
+    else:
+        assert srv_utils.scan_chunks(index, *shift, shape, chunks, 3) == nchunks
+
+
+def test_cache_eviction(tmp_path):
+    cache = tmp_path / 'cache'
+    data = np.arange(10_000, dtype='int64')
+    for name in ['foo/a.b2nd', 'foo/b.b2nd', 'bar/a.b2nd']:
+        (cache / name).parent.mkdir(parents=True, exist_ok=True)
+        blosc2.asarray(data, chunks=(1000,), blocks=(100,),
+                       urlpath=cache / name, mode='w')
+
+    manager = srv_utils.CacheManager(cache, root_budgets={'foo': 1},
+                                     pinned=['foo/b.*'])
+    manager.scan()
+    release = manager.acquire([cache / 'foo/a.b2nd'])
+    assert not manager.evict()  # in use or pinned
+    release()
+    evicted = manager.evict()
+    assert list(evicted) == [cache / 'foo/a.b2nd']
+    for abspath, nchunks in evicted.items():
+        assert manager.reclaim(abspath, nchunks)  # mostly evicted
+
+    # Evicted chunks are reported as missing, the rest are kept
+    for name, available in [('foo/a.b2nd', False), ('foo/b.b2nd', True),
+                            ('bar/a.b2nd', True)]:
+        array = blosc2.open(cache / name)
+        assert all(api_utils.chunk_is_available(array.schunk, n) == available
+                   for n in range(array.schunk.nchunks))
+        if available:
+            np.testing.assert_array_equal(array[:], data)
+
+
+def test_cache_eviction_in_place(tmp_path):
+    cache = tmp_path / 'cache'
+    abspath = cache / 'foo/a.b2nd'
+    abspath.parent.mkdir(parents=True)
+    data = np.arange(10_000, dtype='int64')
+    blosc2.asarray(data, chunks=(1000,), blocks=(100,), urlpath=abspath)
+
+    # Evicting a few chunks does not rewrite the file
+    array = blosc2.open(abspath)
+    budget = sum(srv_utils.chunk_cbytes(array.schunk, n) for n in range(2, 10))
+    manager = srv_utils.CacheManager(cache, budget=budget)
+    manager.scan()
+    inode = abspath.stat().st_ino
+    for abspath_, nchunks in manager.evict().items():
+        assert not manager.reclaim(abspath_, nchunks)
+    assert abspath.stat().st_ino == inode
+
+    array = blosc2.open(abspath)
+    assert [api_utils.chunk_is_available(array.schunk, n)
+            for n in range(10)] == [False] * 2 + [True] * 8
+    np.testing.assert_array_equal(array[2000:], data[2000:])
+
+
+def test_dataset_opener(tmp_path):
+    abspath = tmp_path / 'a.b2nd'
+    data = np.arange(10_000, dtype='int64')
+    array = blosc2.uninit(data.shape, data.dtype, chunks=(1000,),
+                          blocks=(100,), urlpath=abspath)
+    source = blosc2.asarray(data, chunks=(1000,), blocks=(100,))
+    array.schunk.update_chunk(0, source.schunk.get_chunk(0))
+
+    open_dataset = srv_utils.dataset_opener(abspath)
+    handles = open_dataset()
+    assert open_dataset() is handles
+
+    # Stale handles are replaced when chunks are added
+    for nchunk in range(1, 10):
+        array.schunk.update_chunk(nchunk, source.schunk.get_chunk(nchunk))
+    newarray, _ = open_dataset()
+    assert newarray is not handles[0]
+    np.testing.assert_array_equal(newarray[:], data)
+
+    # Replaced files are not read
+    blosc2.asarray(data, chunks=(1000,), blocks=(100,),
+                   urlpath=tmp_path / 'b.b2nd')
+    (tmp_path / 'b.b2nd').replace(abspath)
+    with pytest.raises(FileNotFoundError):
+        open_dataset()
+
+
 def test_lazyexpr(services, sub_urlbase, sub_jwt_cookie):
     if not sub_jwt_cookie:
         pytest.skip("authentication support needed")
@@ -89,6 +335,203 @@ def test_lazyexpr(services, sub_urlbase, sub_jwt_cookie):
     np.testing.assert_array_equal(a[:], b[:])
 
 
+def test_lazyexpr_missing_operand(services, sub_urlbase, sub_jwt_cookie):
+    if not sub_jwt_cookie:
+        pytest.skip("authentication support needed")
+
+    headers = {'Cookie': sub_jwt_cookie}
+    data = blosc2.asarray(np.arange(10)).to_cframe()
+    httpx.post(f'{sub_urlbase}htmx/upload/', headers=headers,
+               files={'file': ('my_operand.b2nd', data)}).raise_for_status()
+    lxpath = cat2.lazyexpr('my_expr_missing', 'a + 1',
+                           {'a': '@scratch/my_operand.b2nd'}, sub_urlbase,
+                           auth_cookie=sub_jwt_cookie)
+    httpx.delete(f'{sub_urlbase}htmx/delete/@scratch/my_operand.b2nd',
+                 headers=headers).raise_for_status()
+    try:
+        response = httpx.get(f'{sub_urlbase}htmx/path-info/{lxpath}',
+                             headers=headers)
+        assert response.status_code == 400
+        assert 'missing operand(s)' in response.text
+    finally:
+        httpx.delete(f'{sub_urlbase}htmx/delete/{lxpath}',
+                     headers=headers).raise_for_status()
+
+
+def test_lazyexpr_result(services, sub_urlbase, sub_jwt_cookie):
+    if not sub_jwt_cookie:
+        pytest.skip("authentication support needed")
+    state_dir = getattr(services, 'state_dir', None)
+    if state_dir is None:
+        pytest.skip("subscriber state directory needed")
+
+    oppt = f'{TEST_CATERVA2_ROOT}/ds-1d.b2nd'
+    a = cat2.fetch(oppt, sub_urlbase, auth_cookie=sub_jwt_cookie)
+    lxpath = cat2.lazyexpr('my_expr_result', 'a + 1', {'a': oppt},
+                           sub_urlbase, auth_cookie=sub_jwt_cookie)
+    cat2.fetch(lxpath, sub_urlbase, auth_cookie=sub_jwt_cookie)
+    [respath] = (state_dir / 'subscriber/results').glob(
+        '*/my_expr_result.b2nd')
+
+    # Stale results are replaced
+    cat2.lazyexpr('my_expr_result', 'a + 2', {'a': oppt}, sub_urlbase,
+                  auth_cookie=sub_jwt_cookie)
+    b = cat2.fetch(lxpath, sub_urlbase, auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal(a + 2, b)
+    assert not respath.with_name(f'{respath.name}.tmp').exists()
+
+    # Results are removed with their expression
+    httpx.delete(f'{sub_urlbase}htmx/delete/{lxpath}',
+                 headers={'Cookie': sub_jwt_cookie}).raise_for_status()
+    assert not respath.exists()
+    assert not respath.with_name(f'{respath.name}.key').exists()
+
+
+@pytest.mark.parametrize("slice_,shape,opshape,opslice", [
+    ((slice(2, 4), 5), (10, 10), (10, 10), (slice(2, 4), slice(5, 6))),
+    (slice(None, None, -2), (10, 10), (10, 10),
+     (slice(1, 10, 2), slice(0, 10))),
+    ((slice(1, 8, 3), slice(2, 2)), (10, 10), (10, 10),
+     (slice(1, 8, 3), slice(0, 0))),
+    ((slice(2, 4), -1), (10, 10), (1, 10), (slice(None), slice(9, 10))),
+    ((slice(2, 4), slice(1, 3)), (10, 10), (10,), (slice(1, 3),)),
+    ((slice(2, 4),), (10,), (10, 10), None),  # reduced operand
+])
+def test_operand_slice(slice_, shape, opshape, opslice):
+    assert srv_utils.operand_slice(slice_, shape, opshape) == opslice
+
+
+def test_lazyexpr_slice(services, sub_urlbase, sub_jwt_cookie):
+    if not sub_jwt_cookie:
+        pytest.skip("authentication support needed")
+
+    oppt = f'{TEST_CATERVA2_ROOT}/dir2/ds-4d.b2nd'
+    cat2.subscribe(TEST_CATERVA2_ROOT, sub_urlbase,
+                   auth_cookie=sub_jwt_cookie)
+    lxpath = cat2.lazyexpr('my_expr_slice', 'a * 2', {'a': oppt}, sub_urlbase,
+                           auth_cookie=sub_jwt_cookie)
+    slice_ = '1,0:3,1:2'
+    a = cat2.fetch(oppt, sub_urlbase, slice_, auth_cookie=sub_jwt_cookie)
+    b = cat2.fetch(lxpath, sub_urlbase, slice_, auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal(a * 2, b)
+    b = cat2.reduce(lxpath, 'sum', sub_urlbase, axis=0, slice_=slice_,
+                    auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal((a * 2).sum(axis=0), b)
+
+    # Result chunks are reused
+    stats = httpx.get(f'{sub_urlbase}api/stats').json()['expr_results']
+    b = cat2.fetch(lxpath, sub_urlbase, slice_, auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal(a * 2, b)
+    stats2 = httpx.get(f'{sub_urlbase}api/stats').json()['expr_results']
+    assert stats2['computed'] == stats['computed']
+    assert stats2['reused'] > stats['reused']
+
+    # Until the expression changes
+    cat2.lazyexpr('my_expr_slice', 'a * 3', {'a': oppt}, sub_urlbase,
+                  auth_cookie=sub_jwt_cookie)
+    b = cat2.fetch(lxpath, sub_urlbase, slice_, auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal(a * 3, b)
+
+    # Result chunks computed for the slice are right as a whole
+    b = cat2.fetch(lxpath, sub_urlbase, auth_cookie=sub_jwt_cookie)
+    a = cat2.fetch(oppt, sub_urlbase, auth_cookie=sub_jwt_cookie)
+    np.testing.assert_array_equal(a * 3, b)
+
+
+def test_stats(services, sub_urlbase, sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)['ds-1d.b2nd']
+    ds[:10]
+    stats = httpx.get(f'{sub_urlbase}api/stats').json()['blocking']
+    assert stats['calls'] > 0
+    assert 0 <= stats['max_queued'] <= stats['queued']
+
+
+def test_subscribe_failed(isolated_services, isolated_jwt_cookie):
+    sub_urlbase = add_unavailable_root(isolated_services, 'unavailable',
+                                       isolated_jwt_cookie)
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        cat2.subscribe('unavailable', sub_urlbase,
+                       auth_cookie=isolated_jwt_cookie)
+    assert excinfo.value.response.status_code == 502
+
+
+def test_subscribe_status(services, sub_urlbase, sub_jwt_cookie):
+    assert cat2.subscribe(TEST_CATERVA2_ROOT, sub_urlbase,
+                          auth_cookie=sub_jwt_cookie, wait=False) == 'Ok'
+    url = f'{sub_urlbase}api/subscribe/{TEST_CATERVA2_ROOT}/status'
+    headers = {'Cookie': sub_jwt_cookie} if sub_jwt_cookie else None
+    for _ in range(50):
+        status = httpx.get(url, headers=headers).json()
+        if status['state'] not in {'pending', 'running'}:
+            break
+        time.sleep(0.1)
+    assert status['state'] == 'done'
+    nodes = cat2.get_list(TEST_CATERVA2_ROOT, sub_urlbase,
+                          auth_cookie=sub_jwt_cookie)
+    assert status['done'] == status['total'] == len(nodes)
+
+
+def test_root_pages(services, sub_urlbase, sub_user):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    nodes = myroot.node_list
+    assert nodes == sorted(nodes)
+    assert list(myroot.iter_nodes(page_size=2)) == nodes
+    assert list(myroot.iter_nodes(prefix='dir1/')) == [
+        node for node in nodes if node.startswith('dir1/')]
+    top = list(myroot.iter_nodes(recursive=False, page_size=2))
+    assert 'dir1/' in top and 'dir2/' in top and 'ds-1d.b2nd' in top
+    assert not any('/' in node.rstrip('/') for node in top)
+
+
+def test_search(services, sub_urlbase, sub_user, sub_jwt_cookie):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    nodes = myroot.node_list
+    headers = {'Cookie': sub_jwt_cookie} if sub_jwt_cookie else None
+    params = {'text': '-2d', 'roots': [TEST_CATERVA2_ROOT]}
+    found = httpx.get(f'{sub_urlbase}api/search', params=params,
+                      headers=headers).json()
+    assert found == [f'{TEST_CATERVA2_ROOT}/{node}' for node in nodes
+                     if '-2d' in node]
+    params['limit'] = 1
+    assert httpx.get(f'{sub_urlbase}api/search', params=params,
+                     headers=headers).json() == found[:1]
+
+
+def test_search_unsubscribed(isolated_services, isolated_jwt_cookie):
+    # A root known to the subscriber but never subscribed to
+    sub_urlbase = add_unavailable_root(isolated_services, 'unsubscribed',
+                                       isolated_jwt_cookie)
+    headers = ({'Cookie': isolated_jwt_cookie} if isolated_jwt_cookie
+               else None)
+    response = httpx.get(f'{sub_urlbase}api/search',
+                         params={'text': '', 'roots': ['unsubscribed']},
+                         headers=headers)
+    assert response.status_code == 404
+    roots = cat2.get_roots(sub_urlbase, auth_cookie=isolated_jwt_cookie)
+    assert not roots['unsubscribed']['subscribed']
+
+
+def test_info_etag(services, sub_urlbase, sub_user, sub_jwt_cookie):
+    cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase, user_auth=sub_user)
+    path = f'{TEST_CATERVA2_ROOT}/ds-1d.b2nd'
+    url = f'{sub_urlbase}api/info/{path}'
+    headers = {'Cookie': sub_jwt_cookie} if sub_jwt_cookie else {}
+    response = httpx.get(url, headers=headers)
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert response.json() == cat2.get_info(path, sub_urlbase,
+                                            auth_cookie=sub_jwt_cookie)
+
+    response = httpx.get(url, headers=headers | {'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    response = httpx.get(url, headers=headers | {'If-None-Match': '"x"'})
+    assert response.status_code == 200
+
+
 def test_root(services, sub_urlbase, sub_user):
     myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
                        user_auth=sub_user)
@@ -138,14 +581,27 @@ def test_dataset_step_diff_1(services, examples_dir, sub_urlbase, sub_user):
     ds = myroot['ds-hello.b2frame']
     assert ds.name == 'ds-hello.b2frame'
     assert ds.urlbase == sub_urlbase
-    # We don't support step != 1
-    with pytest.raises(Exception) as e_info:
-        _ = ds[::2]
-        assert str(e_info.value) == 'Only step=1 is supported'
+
+    example = examples_dir / ds.name
+    a = blosc2.open(example)[:]
+    assert ds[::2] == a[::2]
+    assert ds[100:1:-3] == a[100:1:-3]
+
+
+@pytest.mark.parametrize("slice_,shape,chunks,nchunks", [
+    (slice(5, 1000, 250), (1000,), (100,), [0, 2, 5, 7]),
+    (slice(None, None, -50), (1000,), (100,), list(range(10))),
+    ((slice(0, 10, 5), slice(None, None, 10)), (10, 20), (5, 5),
+     [0, 2, 4, 6]),
+    ((1, slice(1, 4, 2)), (3, 4), (2, 3), [0, 1]),
+])
+def test_slice_nchunks(slice_, shape, chunks, nchunks):
+    assert api_utils.slice_nchunks(slice_, shape, chunks) == nchunks
 
 
 @pytest.mark.parametrize("slice_", [1, slice(None, 1), slice(0, 10), slice(10, 20), slice(None),
-                                    slice(1, 5, 1)])
+                                    slice(1, 5, 1), slice(5, 1000, 250),
+                                    slice(None, None, -3)])
 def test_index_dataset_1d(slice_, services, examples_dir, sub_urlbase,
                           sub_user):
     myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
@@ -161,7 +617,9 @@ def test_index_dataset_1d(slice_, services, examples_dir, sub_urlbase,
 
 
 @pytest.mark.parametrize("slice_", [1, slice(None, 1), slice(0, 10), slice(10, 20), slice(None),
-                                    slice(1, 5, 1), (slice(None, 10), slice(None, 20))])
+                                    slice(1, 5, 1), (slice(None, 10), slice(None, 20)),
+                                    (slice(None, None, 2), slice(None, None, -3)),
+                                    (1, slice(2, None, 2))])
 @pytest.mark.parametrize("name", ['dir1/ds-2d.b2nd', 'dir2/ds-4d.b2nd'])
 def test_index_dataset_nd(slice_, name, services, examples_dir, sub_urlbase,
                           sub_user):
@@ -174,6 +632,307 @@ def test_index_dataset_nd(slice_, name, services, examples_dir, sub_urlbase,
     np.testing.assert_array_equal(ds.fetch(slice_), a[slice_])
 
 
+def test_index_dataset_concurrent(services, examples_dir, sub_urlbase,
+                                  sub_user):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    ds = myroot['ds-1d-b.b2nd']
+    a = blosc2.open(examples_dir / ds.name)[:]
+
+    # Overlapping slices share chunks being downloaded at the same time
+    slices = [slice(i * 50, i * 50 + 300) for i in range(15)]
+    with concurrent.futures.ThreadPoolExecutor(len(slices)) as executor:
+        results = list(executor.map(ds.fetch, slices))
+    for slice_, result in zip(slices, results):
+        np.testing.assert_array_equal(result, a[slice_])
+
+
+@pytest.mark.parametrize("name,slices", [
+    ('ds-1d.b2nd', [slice(10, 20), slice(15, 250), 3, slice(None, None, -7)]),
+    ('dir1/ds-2d.b2nd', [(slice(2, 7), slice(3, 12)), (1, slice(None, None, 3)),
+                         ()]),
+    ('ds-1d-fields.b2nd', [slice(0, 150)]),
+])
+def test_fetch_cache(name, slices, services, examples_dir, sub_urlbase,
+                     sub_user, tmp_path):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user, cache=tmp_path)
+    ds = myroot[name]
+    a = blosc2.open(examples_dir / ds.name)[()]
+    for slice_ in slices:
+        np.testing.assert_array_equal(ds[slice_], a[slice_])
+
+    # Chunks are kept in the cache, along with the etag of the dataset
+    cached = blosc2.open(tmp_path / ds.path)
+    etag = (tmp_path / f'{ds.path}.etag').read_text()
+    nchunks = {n for slice_ in slices
+               for n in api_utils.slice_nchunks(slice_, a.shape, cached.chunks)}
+    assert nchunks == {n for n in range(cached.schunk.nchunks)
+                       if api_utils.chunk_is_available(cached.schunk, n)}
+    for slice_ in slices:
+        np.testing.assert_array_equal(ds[slice_], a[slice_])
+    assert (tmp_path / f'{ds.path}.etag').read_text() == etag
+
+
+def test_fetch_cache_changes(services, sub_urlbase, sub_user, tmp_path):
+    datadir = services.get_data_path(TEST_CATERVA2_ROOT)
+    if datadir is None:
+        pytest.skip("publisher data directory needed")
+
+    name = 'ds-cache-changes.b2nd'
+    data = np.arange(1000, dtype='int64')
+    blosc2.asarray(data, chunks=(100,), blocks=(10,),
+                   urlpath=datadir / name, mode='w')
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user, cache=tmp_path)
+    try:
+        wait_until(lambda: name in list(myroot))
+        ds = myroot[name]
+        cat2.fetch(ds.path, sub_urlbase, auth_cookie=ds.auth_cookie)
+        np.testing.assert_array_equal(ds[:], data)
+
+        # Same metadata, different data: the cache is invalidated
+        blosc2.asarray(data + 1000, chunks=(100,), blocks=(10,),
+                       urlpath=datadir / name, mode='w')
+        wait_until(lambda: cat2.fetch(ds.path, sub_urlbase,
+                                      auth_cookie=ds.auth_cookie)[0] == 1000)
+        np.testing.assert_array_equal(ds[:], data + 1000)
+    finally:
+        (datadir / name).unlink()
+        wait_until(lambda: name not in list(myroot))
+
+
+@pytest.mark.parametrize("name", ['ds-1d-fields.b2nd', 'ds-2d-fields.b2nd'])
+def test_index_dataset_fields(name, services, examples_dir, sub_urlbase,
+                              sub_user):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    ds = myroot[name]
+    a = blosc2.open(examples_dir / name)[:]
+    np.testing.assert_array_equal(ds[5:15], a[5:15])
+    np.testing.assert_array_equal(ds[7], a[7])
+
+
+@pytest.mark.parametrize("slice_", [1, slice(10, 20), (slice(2, 5), 3)])
+def test_fetch_cframe(slice_, services, examples_dir, sub_urlbase,
+                      sub_user, sub_jwt_cookie):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)['dir1/ds-2d.b2nd']
+    a = blosc2.open(examples_dir / ds.name)[:]
+
+    # Clients not accepting chunk streams get a Blosc2 frame
+    params = {'slice_': api_utils.slice_to_string(slice_)}
+    data = httpx.get(ds.get_download_url(), params=params,
+                     headers={'Cookie': sub_jwt_cookie} if sub_user else None)
+    assert data.status_code == 200
+    assert data.headers['Content-Type'] == 'application/octet-stream'
+    assert data.headers[api_utils.cframe_type_header] == 'ndarray'
+    b = blosc2.ndarray_from_cframe(data.content)
+    np.testing.assert_array_equal(b[()], a[slice_])
+
+
+@pytest.mark.parametrize("name, slice_", [
+    ('ds-1d.b2nd', None),
+    ('ds-1d.b2nd', slice(10, 950)),
+    ('dir1/ds-2d.b2nd', (slice(2, 7), slice(3, 12))),
+    ('ds-1d-fields.b2nd', slice(0, 150)),
+])
+def test_fetch_out_lazy(name, slice_, services, examples_dir, sub_urlbase,
+                        sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)[name]
+    a = blosc2.open(examples_dir / name)[()]
+    expected = a[slice_] if slice_ is not None else a
+
+    out = np.zeros(expected.shape, expected.dtype)
+    assert ds.fetch(slice_, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+    lazy = ds.fetch(slice_, lazy=True)
+    assert isinstance(lazy, blosc2.NDArray)
+    np.testing.assert_array_equal(lazy[()], expected)
+
+    with pytest.raises(ValueError):
+        ds.fetch(slice_, out=np.zeros(expected.shape, np.int8))
+
+    # Buffers whose layout does not match that of chunks get copies
+    out = np.zeros(expected.shape[::-1], expected.dtype).T
+    assert ds.fetch(slice_, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize("name, slice_", [
+    ('dir1/ds-2d.b2nd', None),
+    ('dir1/ds-2d.b2nd', (slice(2, 7), slice(3, 12))),
+])
+def test_fetch_cache_out(name, slice_, services, examples_dir, sub_urlbase,
+                         sub_user, tmp_path):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user, cache=tmp_path)[name]
+    a = blosc2.open(examples_dir / name)[()]
+    expected = a[slice_] if slice_ is not None else a
+    out = np.zeros(expected.shape, expected.dtype)
+    assert ds.fetch(slice_, out=out) is out
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_fetch_schunk_out_lazy(services, examples_dir, sub_urlbase, sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)['ds-hello.b2frame']
+    data = blosc2.open(examples_dir / ds.name)[:]
+
+    out = bytearray(len(data))
+    assert ds.fetch(out=out) is out
+    assert out == data
+    assert ds.fetch(lazy=True)[:] == data
+
+
+def test_async_root(services, examples_dir, sub_urlbase, sub_user, tmp_path):
+    a = blosc2.open(examples_dir / 'ds-1d.b2nd')[:]
+    slices = [slice(i, i + 10) for i in range(0, 1000, 100)]
+
+    async def run():
+        async with cat2.AsyncRoot(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                                  user_auth=sub_user) as root:
+            nodes = [path async for path in root.iter_nodes()]
+            ds = root['ds-1d.b2nd']
+            assert isinstance(ds, cat2.AsyncDataset)
+            assert isinstance(root['README.md'], cat2.AsyncFile)
+            meta, *data = await asyncio.gather(
+                ds.get_info(), *(ds.fetch(sl) for sl in slices))
+            mean = await ds.reduce('mean', slice_=slice(0, 100))
+            with chdir_ctxt(tmp_path):
+                path = await root['README.md'].download()
+            return nodes, meta, data, mean, path
+
+    nodes, meta, data, mean, path = asyncio.run(run())
+    assert set(nodes) == set(str(f.relative_to(examples_dir))
+                             for f in examples_dir.rglob('*') if f.is_file())
+    assert meta['shape'] == list(a.shape)
+    for slice_, b in zip(slices, data):
+        np.testing.assert_array_equal(b, a[slice_])
+    assert mean == a[:100].mean()
+    assert ((tmp_path / path).read_bytes()
+            == (examples_dir / 'README.md').read_bytes())
+
+
+@pytest.mark.parametrize("backend", ['json', 'sqlite'])
+def test_database(backend, tmp_path):
+    initial = models.Subscriber(roots={}, etags={})
+    database = srv_utils.open_database(tmp_path, initial, backend)
+    database.roots['foo'] = models.Root(name='foo', http='localhost:8001')
+    database.etags['foo/a.b2nd'] = 'x'
+    database.etags['foo/b.b2nd'] = 'y'
+    database.save()
+    # Changes in place and deletions
+    database.roots.get('foo').subscribed = True
+    del database.etags['foo/a.b2nd']
+    database.save()
+
+    database = srv_utils.open_database(tmp_path, initial, backend)
+    assert database.data == models.Subscriber(
+        roots={'foo': models.Root(name='foo', http='localhost:8001',
+                                  subscribed=True)},
+        etags={'foo/b.b2nd': 'y'})
+
+
+def test_database_import(tmp_path):
+    initial = models.Publisher(etags={})
+    database = srv_utils.open_database(tmp_path, initial)
+    database.etags['a.b2nd'] = 'x'
+    database.save()
+    database = srv_utils.open_database(tmp_path, initial, 'sqlite')
+    assert dict(database.etags) == {'a.b2nd': 'x'}
+
+
+@pytest.mark.parametrize("name,slice_", [
+    ('dir1/ds-2d.b2nd', (slice(5, 10), slice(5, 20))),
+    ('dir1/ds-2d.b2nd', slice(0, 5)),
+    ('dir1/ds-3d.b2nd', (slice(0, 2), slice(0, 3))),
+])
+def test_fetch_aligned(name, slice_, services, examples_dir, sub_urlbase,
+                       sub_user, sub_jwt_cookie):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)[name]
+    a = blosc2.open(examples_dir / ds.name)
+    np.testing.assert_array_equal(ds[slice_], a[slice_])
+
+    # Slices covering whole chunks keep the chunk and block shapes
+    params = {'slice_': api_utils.slice_to_string(slice_)}
+    data = httpx.get(ds.get_download_url(), params=params,
+                     headers={'Cookie': sub_jwt_cookie} if sub_user else None)
+    assert data.status_code == 200
+    b = blosc2.ndarray_from_cframe(data.content)
+    assert b.chunks == a.chunks
+    assert b.blocks == a.blocks
+    np.testing.assert_array_equal(b[()], a[slice_])
+
+
+@pytest.mark.parametrize("name,op,axis,slice_", [
+    ('ds-1d.b2nd', 'sum', None, None),
+    ('dir1/ds-2d.b2nd', 'mean', 0, None),
+    ('dir1/ds-3d.b2nd', 'std', (0, 2), (slice(1, 3), slice(0, 3))),
+    ('dir2/ds-4d.b2nd', 'max', -1, (1, slice(0, 3))),
+    ('dir1/ds-2d.b2nd', 'min', None, (2,)),
+])
+def test_reduce(name, op, axis, slice_, services, examples_dir, sub_urlbase,
+                sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)[name]
+    a = blosc2.open(examples_dir / ds.name)
+    a = a[slice_] if slice_ else a[()]
+    result = ds.reduce(op, axis=axis, slice_=slice_)
+    np.testing.assert_allclose(result, getattr(np, op)(a, axis=axis))
+
+
+def test_reduce_error(services, sub_urlbase, sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)['dir1/ds-2d.b2nd']
+    for op, axis in [('median', None), ('sum', 2), ('sum', (0, 0))]:
+        with pytest.raises(httpx.HTTPStatusError) as exc_info:
+            ds.reduce(op, axis=axis)
+        assert exc_info.value.response.status_code == 400
+
+
+def test_compute(services, examples_dir, pub_host):
+    url = f'http://{pub_host}/api/compute'
+    a = blosc2.open(examples_dir / 'dir1/ds-3d.b2nd')[()]
+    request = {'expression': 'sin(x) + x * 2', 'operands': {
+        'x': 'dir1/ds-3d.b2nd'}, 'op': 'sum', 'axis': [1], 'slice_': '1:3'}
+    response = httpx.post(url, json=request)
+    assert response.status_code == 200
+    result = blosc2.ndarray_from_cframe(response.content)[()]
+    np.testing.assert_allclose(result, (np.sin(a) + a * 2)[1:3].sum(axis=1))
+
+    # Only whitelisted operations are allowed
+    request['expression'] = 'x.__class__'
+    assert httpx.post(url, json=request).status_code == 400
+
+
+def test_reduce_pushdown(services, examples_dir, sub_urlbase, sub_user):
+    ds = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                   user_auth=sub_user)['dir1/ds-3d.b2nd']
+    a = blosc2.open(examples_dir / ds.name)[()]
+
+    def get_stats():
+        return httpx.get(f'{sub_urlbase}api/stats').json()['reductions']
+
+    # Reductions are computed by the publisher or here, depending on
+    # whether chunks are cached (e.g. by previous tests)
+    stats = get_stats()
+    np.testing.assert_array_equal(ds.reduce('max', axis=0), a.max(axis=0))
+    stats2 = get_stats()
+    assert (stats2['pushed'] + stats2['local']
+            == stats['pushed'] + stats['local'] + 1)
+
+    # Once all chunks are in cache, reductions are computed here
+    ds[:]
+    np.testing.assert_array_equal(ds.reduce('min', axis=2), a.min(axis=2))
+    stats3 = get_stats()
+    assert stats3['local'] == stats2['local'] + 1
+    assert stats3['pushed'] == stats2['pushed']
+
+
 @pytest.mark.parametrize("name", ['ds-1d.b2nd', 'dir1/ds-2d.b2nd'])
 def test_download_b2nd(name, services, examples_dir, sub_urlbase,
                        sub_user, sub_jwt_cookie, tmp_path):
@@ -271,6 +1030,65 @@ def test_download_regular_file(services, examples_dir, sub_urlbase,
     assert a[:] == b[:].decode()
 
 
+def test_download_range(services, examples_dir, sub_urlbase,
+                        sub_user, sub_jwt_cookie):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    urlpath = myroot['ds-1d.b2nd'].get_download_url()
+    headers = {'Cookie': sub_jwt_cookie} if sub_user else {}
+    whole = httpx.get(urlpath, headers=headers)
+    assert whole.headers['accept-ranges'] == 'bytes'
+    etag = whole.headers['etag']
+
+    response = httpx.get(urlpath, headers=headers | {'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.content == whole.content[10:20]
+
+    # A matching ETag gets the range, a stale one gets the whole file
+    response = httpx.get(urlpath, headers=headers | {'Range': 'bytes=10-19',
+                                                     'If-Range': etag})
+    assert response.status_code == 206
+    assert response.content == whole.content[10:20]
+    response = httpx.get(urlpath, headers=headers | {'Range': 'bytes=10-19',
+                                                     'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.content == whole.content
+
+
+@pytest.mark.parametrize("resume,nranges,stale", [
+    (True, 1, False),
+    (True, 3, False),
+    (True, 2, True),  # the file changed, download it again
+    (False, 4, False),
+])
+def test_download_resume(resume, nranges, stale, services, examples_dir, sub_urlbase,
+                         sub_user, sub_jwt_cookie, tmp_path):
+    myroot = cat2.Root(TEST_CATERVA2_ROOT, urlbase=sub_urlbase,
+                       user_auth=sub_user)
+    ds = myroot['ds-1d.b2nd']
+    urlpath = ds.get_download_url()
+    headers = {'Cookie': sub_jwt_cookie} if sub_user else {}
+    whole = httpx.get(urlpath, headers=headers)
+
+    # Leave an interrupted download behind
+    localpath = tmp_path / ds.path
+    localpath.parent.mkdir(parents=True)
+    partpath = localpath.with_name(localpath.name + '.part')
+    partpath.write_bytes(b'x' * 100 if stale else whole.content[:100])
+    etag = '"stale"' if stale else whole.headers['etag']
+    state = {'etag': etag, 'is_b2': False,
+             'size': len(whole.content), 'missing': [[100, None]]}
+    partpath.with_name(partpath.name + '.json').write_text(json.dumps(state))
+
+    with chdir_ctxt(tmp_path):
+        path = ds.download(resume=resume, nranges=nranges)
+        assert path == ds.path
+        assert not partpath.exists()
+        b = blosc2.open(path)
+        a = blosc2.open(examples_dir / ds.name)
+        np.testing.assert_array_equal(a[:], b[:])
+
+
 @pytest.mark.parametrize("name", ['ds-1d.b2nd',
                                   'ds-hello.b2frame',
                                   'README.md'])